@@ -29,6 +29,9 @@ rm.LS.matplotlib.use('Agg')
 #             then we wil display PNG images instead of call plt.show()
 #
 
+# The DRC-EQ is computed in process (the same Agg backend applies)
+import roomEQ as rEQ
+
 class RoommeasureGUI(Tk):
 
     ### MAIN WINDOW
@@ -70,7 +73,7 @@ class RoommeasureGUI(Tk):
         takes    = list(range(1,21))
         sweeps   = [2**15, 2**16, 2**17, 2**18]
         timers   = ['manual', '3', '5', '10']
-        taps     = [2**13, 2**14, 2**15, 2**16]
+        taps     = [2**13, 2**14, 2**15, 2**16, 2**17, 2**18, 2**19, 2**20]
 
         ### VARS
         self.var_beep       = IntVar()
@@ -85,6 +88,13 @@ class RoommeasureGUI(Tk):
         self.meas_trigger = threading.Event()
         self.var_msg      = StringVar()
 
+        # Live recording levels from the rm.LS streaming engine
+        rm.LS.level_callback = self.show_rec_levels
+
+        # Live averages convergence from the rm background analysis
+        self.var_avg      = StringVar()
+        rm.avg_callback   = self.show_avg_convergence
+
         ### MAIN CONFIG WIDGETS FRAME
         content =  ttk.Frame( self, padding=(10,10,12,12) )
 
@@ -140,6 +150,9 @@ class RoommeasureGUI(Tk):
                                                     'bold') )
         lbl_schro        = ttk.Label(content, text='smooth Schroeder')
         self.ent_schro   = ttk.Entry(content,                     width=5)
+        lbl_avg          = ttk.Label(content, text='average')
+        self.cmb_avg     = ttk.Combobox(content, values=rm.AVG_MODES, width=7,
+                                                 state='readonly')
 
         # - RUN SECTION
         btn_selfol       = ttk.Button(content, text='RESULTS FOLDER:',
@@ -163,6 +176,7 @@ class RoommeasureGUI(Tk):
         frm_msg          = ttk.Frame(content, borderwidth=2, relief='solid')
         self.lbl_msg     = ttk.Label(frm_msg, textvariable=self.var_msg,
                                               font=(None, 32))
+        self.lbl_avg     = ttk.Label(frm_msg, textvariable=self.var_avg)
 
         #### FILTER CALCULATION SECTION
         lbl_drc          = ttk.Label(content, text='DRC-EQ FILTER:',
@@ -222,6 +236,8 @@ class RoommeasureGUI(Tk):
         lbl_plot.grid(          row=5,  column=4, sticky=W )
         lbl_schro.grid(         row=6,  column=4, sticky=E )
         self.ent_schro.grid(    row=6,  column=5, sticky=W )
+        lbl_avg.grid(           row=7,  column=4, sticky=E )
+        self.cmb_avg.grid(      row=7,  column=5, sticky=W )
 
         # run
         lbl_timer.grid(         row=8,  column=0, sticky=E, pady=6)
@@ -237,6 +253,7 @@ class RoommeasureGUI(Tk):
         frm_msg.grid(           row=11, column=0, sticky=W+E, columnspan=6,
                                                               pady=12 )
         self.lbl_msg.grid(                        sticky=W )
+        self.lbl_avg.grid(                        sticky=W )
 
         # drc eq
         lbl_drc.grid(           row=12, column=0, sticky=W, pady=6 )
@@ -284,6 +301,24 @@ class RoommeasureGUI(Tk):
                 self.var_msg.set('')
 
 
+    def show_rec_levels(self, progress, peak_dBFS, rms_dBFS):
+        """ displays the rm.LS live recording levels
+        """
+        tmp = '  '.join( [f'{x:.1f}' for x in peak_dBFS] )
+        self.var_msg.set(f'recording {progress:3d} %   peak dBFS: {tmp}')
+
+
+    def show_avg_convergence(self, ch, stats, delta):
+        """ displays how the rm average of a channel is converging
+        """
+        if stats.n > 1:
+            self.var_avg.set(f'{ch} {rm.avgMode} average of {stats.n} locations:  '
+                             f'changed {delta:.2f} dB RMS,  '
+                             f'spread {stats.std.mean():.1f} dB')
+        else:
+            self.var_avg.set(f'{ch} average of 1 location')
+
+
     def selectMicPath(self):
         # Mac OS el filtro filetypes no funciona bien
         #filetypes = [('Text', 'txt'), ('CAL', 'cal'), ('FRD', 'frd'), ('All', '*')]
@@ -404,7 +439,10 @@ class RoommeasureGUI(Tk):
             self.btn_go['state'] = 'disabled'
             self.btn_close['state'] = 'disabled'
 
-            rm.LS.do_meas(plot_mic=True)
+            if not rm.LS.do_meas(plot_mic=True):
+                self.var_msg.set(f'ABORTED: {rm.LS.meas_abort_msg}')
+                self.btn_close['state'] = 'normal'
+                return
 
             # Checking TIME CLEARANCE:
             if not rm.LS.TimeClearanceOK:
@@ -587,13 +625,21 @@ class RoommeasureGUI(Tk):
         # Disabling the GO! & CLOSE buttons while measuring
         self.btn_go['state'] = 'disabled'
         self.btn_close['state'] = 'disabled'
+        self.var_avg.set('')
 
         # Ordering the meas loop:
         rm.do_meas_loop(e_trigger, msg)
 
         # Smoothing curve and saving to disk:
         self.var_msg.set('SMOOTHING AND SAVING TO DISK ...')
-        rm.do_averages()
+        try:
+            rm.do_averages()
+        except RuntimeError as e:
+            print(f'(!) {e}')
+            self.var_msg.set('(!) SOME TAKES FAILED TO BE ANALYSED, please measure again')
+            self.btn_go['state'] = 'normal'
+            self.btn_close['state'] = 'normal'
+            return
         self.var_msg.set('DONE! Ready to calculate the DRC-EQ filters below')
 
         # Ending the rm.LS dummy Agg backend plotting
@@ -629,6 +675,7 @@ class RoommeasureGUI(Tk):
             print(f'auto timer:     {rm.timer}')
             print(f'Beep:           {rm.doBeep}')
             print(f'Schroeder:      {rm.Schro} (for smoothed meas curve)')
+            print(f'average:        {rm.avgMode}')
             print(f'Output folder   {rm.folder}')
 
 
@@ -644,6 +691,7 @@ class RoommeasureGUI(Tk):
             takes       =   int(self.cmb_locat.get())
             sweeplength =   int(self.cmb_sweep.get())
             Schro       =   float(self.ent_schro.get())
+            avgMode     =   self.cmb_avg.get()
 
             rjaddr      =   self.ent_rjaddr.get()
             rjuser      =   self.ent_rjuser.get()
@@ -669,6 +717,9 @@ class RoommeasureGUI(Tk):
             # - smoothing
             rm.Schro         = Schro
 
+            # - averaging
+            rm.avgMode       = avgMode
+
             # - output folder
             if rm.folder:
                 # - alerting on existing .frd files under <folder>
@@ -733,8 +784,7 @@ class RoommeasureGUI(Tk):
 
     # Help for DRC-EQ
     def help_eq(self):
-        from roomEQ import __doc__ as eq_doc
-        self.helpW( help_text=eq_doc, disable_items=[self.btn_eqhlp])
+        self.helpW( help_text=rEQ.__doc__, disable_items=[self.btn_eqhlp])
 
 
     # Configure DRC EQ LIMITS (roomEQ command line args)
@@ -807,7 +857,6 @@ class RoommeasureGUI(Tk):
 
         # taps
         taps     = int(self.cmb_drctaps.get())
-        taps_exp = int( rm.np.log2(taps) )
 
         # ref level
         if self.ent_reflev.get() == 'auto':
@@ -841,51 +890,61 @@ class RoommeasureGUI(Tk):
         tmp= self.cmb_ch.get()
         channels = [c for c in tmp]
 
-        # roomEQ command line args
-        args =  f'-fs={fs} -e={taps_exp} -schro={schro} -doPCM -doWAV'
-        args += f' -WAVfmt=int{self.cmb_wavbits.get()}'
-        args += f' -wLoct={self.var_wLowSpan.get()}'
-        args += f' -wLfc={self.var_wLowFc.get()}'
-        args += f' -wHfc={self.var_wHighFc.get()}'
-        args += f' -wHoct={self.var_wHighSpan.get()}'
-
-        if reflev:
-            args += f' -ref={reflev}'
+        # roomEQ parameters
+        params = dict( fs       = int(fs),
+                       m        = taps,
+                       fSchro   = float(schro),
+                       noPos    = noPos,
+                       wLoct    = self.var_wLowSpan.get(),
+                       wLfc     = self.var_wLowFc.get(),
+                       wHfc     = self.var_wHighFc.get(),
+                       wHoct    = self.var_wHighSpan.get() )
 
-        if noPos:
-            args += f' -noPos'
+        ref_level = float(reflev) if reflev else None
 
-        rEQ_path = __file__.replace( os.path.basename(__file__), 'roomEQ.py')
-
-        frd_paths = ''
+        frd_paths = []
         for ch in channels:
             frd_path   = f'{UHOME}/{self.ent_folder.get()}/{ch}_avg.frd'
             if os.path.isfile(frd_path):
-                frd_paths += f' "{frd_path}"'
+                frd_paths.append(frd_path)
             else:
                 self.var_msg.set(f'\'{ch}\' channel avg freq. response file NOT found')
                 return
 
-        cmdline = f'{rEQ_path} {frd_paths.strip()} {args}'
+        # Running roomEQ in backgroung ... ...
+        print( f'(GUI) running roomEQ: {frd_paths} {params}' )
+        job_drc = threading.Thread( target=self.do_drc_process,
+                                    args=(frd_paths, ref_level, params),
+                                    daemon=True )
+        job_drc.start()
 
-        # display temporary messages
-        msgs = (f'running roomEQ ...',
-                f'DRC FIRs at: {self.ent_folder.get().split("/")[-1]}'
-                f'/{self.cmb_drcfs.get()}'
-                f'_{int(taps/1024)}Ktaps'
-                )
 
-        job_tmp_msgs = threading.Thread( target=self.tmp_msgs,
-                                        args=(msgs, 5),
-                                        daemon=True               )
-        job_tmp_msgs.start()
+    # DRC-EQ procedure and SAVING of FIRs
+    def do_drc_process(self, frd_paths, ref_level, params):
 
-        # Running roomEQ.py in a shell in backgroung ... ...
-        print( f'(GUI) running: {cmdline}' )
-        Popen( cmdline, shell=True)
+        self.btn_drc['state'] = 'disabled'
+        self.var_msg.set('running roomEQ ...')
 
-        # Open desktop file manager
-        self.open_file_manager(f'{UHOME}/{self.ent_folder.get()}')
+        rEQ.doPCM   = True
+        rEQ.doWAV   = True
+        rEQ.WAVfmt  = f'int{self.cmb_wavbits.get()}'
+
+        try:
+            rEQ.process(frd_paths, ref_level, **params)
+            self.var_msg.set( f'DRC FIRs at: {self.ent_folder.get().split("/")[-1]}'
+                              f'/{params["fs"]}_{int(params["m"]/1024)}Ktaps' )
+
+            # Open desktop file manager
+            self.open_file_manager(f'{UHOME}/{self.ent_folder.get()}')
+
+        except Exception as e:
+            print( f'(GUI) roomEQ error: {e}' )
+            self.var_msg.set('roomEQ ERROR :-/')
+
+        # Ending the roomEQ dummy Agg backend plotting
+        rm.LS.plt.close('all')
+
+        self.btn_drc['state'] = 'normal'
 
 
 def macOS_launcher_patch():
@@ -935,6 +994,7 @@ if __name__ == '__main__':
     app.var_beep.set(1)
     # - Schroeder freq for smoothing result curve:
     app.ent_schro.insert(0, '200')
+    app.cmb_avg.set(rm.avgMode)
     # - Output folder
     #app.ent_folder.insert(0, 'roommeas')
 
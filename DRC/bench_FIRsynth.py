@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Rafael Sánchez
+# This file is part of 'Rsantct.DRC', yet another DRC FIR toolkit.
+
+"""
+    Benchmarks the roomEQ FIR synthesis: time and peak memory (RSS) per
+    FIR length, from a synthetic room EQ curve.
+
+    Every length is run in its own process, so that its peak RSS is not
+    masked by the previous ones.
+
+    Usage:
+
+        bench_FIRsynth.py  [options]
+
+            -e=a,b,...  Exponents 2^XX for the FIR lengths in taps
+                        (default 14,15,16,17,18,19,20)
+
+            -fs=        FIR sampling freq (default 96000 Hz)
+
+            -long       Uses the long FIR synthesis for every length,
+                        (default only for longer than roomEQ.long_fir)
+"""
+
+import os
+import sys
+import time
+import resource
+import subprocess
+from contextlib import redirect_stdout
+import numpy as np
+
+import roomEQ
+
+
+def get_peak_rss_MB():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives KB, macOS bytes
+    if sys.platform == 'darwin':
+        return rss / 2**20
+    return rss / 2**10
+
+
+def get_eq_curve():
+    """ A room like EQ curve, some room modes below 300 Hz
+    """
+    freq = np.logspace(np.log10(2), np.log10(96000), 1000)
+    eq   = np.zeros(freq.shape)
+    for fc, gain in ((32, -12), (45, 6), (68, -9), (110, -6), (230, 3)):
+        eq += gain / ( 1 + ( (freq - fc) / (fc / 10) )**2 )
+    return freq, eq
+
+
+def bench(e, fs, long):
+    """ Runs a FIR synthesis, prints its time and the RSS increase
+    """
+    if long:
+        roomEQ.long_fir = 0
+
+    freq, eq = get_eq_curve()
+    rss0 = get_peak_rss_MB()
+
+    # (the roomEQ prints are not wanted in the results table)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        t0 = time.time()
+        _, _, imp = roomEQ.synthesize_fir(freq, eq, 2**e, fs)
+        dt = time.time() - t0
+
+    path = 'long' if 2**e > roomEQ.long_fir else 'tools'
+    print( f'{e:>4d}  {2**e:>9d}  {path:>6s}  {dt:>9.3f}  '
+           f'{get_peak_rss_MB():>9.1f}  {get_peak_rss_MB() - rss0:>9.1f}  '
+           f'{imp.dtype}' )
+
+
+if __name__ == '__main__':
+
+    exps = list(range(14, 21))
+    fs   = 96000
+    long = False
+    one  = False
+
+    for opc in sys.argv[1:]:
+
+        if opc[:3] == '-e=':
+            exps = [int(x) for x in opc[3:].split(',')]
+
+        elif opc[:4] == '-fs=':
+            fs = int(opc[4:])
+
+        elif opc == '-long':
+            long = True
+
+        # (internal) a single length run
+        elif opc == '-one':
+            one = True
+
+        else:
+            print(__doc__)
+            sys.exit()
+
+    # The child process for a single length
+    if one:
+        bench(exps[0], fs, long)
+        sys.exit()
+
+    print( f'FIR synthesis at {fs} Hz' )
+    print( f'{"e":>4s}  {"taps":>9s}  {"path":>6s}  {"time (s)":>9s}  '
+           f'{"RSS (MB)":>9s}  {"+RSS (MB)":>9s}  dtype' )
+
+    for e in exps:
+        args = [sys.executable, __file__, f'-e={e}', f'-fs={fs}', '-one']
+        if long:
+            args.append('-long')
+        subprocess.run(args)
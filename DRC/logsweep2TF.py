@@ -39,6 +39,19 @@
                    |        Optional reference loop for
       in  R ---<---+        time clearance checkup.
 
+      in  3 ------<-------  MIC #2  )
+      in  4 ------<-------  MIC #3  ) Optional multi mic mode
+      ...                           )
+
+
+    MESM wiring (measuring L and R with a single playback):
+
+      out L ------>-------  Left  loudspeaker
+
+      out R ------>-------  Right loudspeaker
+
+      in  L ------<-------  MIC
+
 
     Usage:      python3 logsweep2TF.py  [options ... ...]
 
@@ -52,13 +65,72 @@
     -eXX                Power of 2 that determines the total lenght N of the
                         test log-sweep. Default 2^18 = 256K samples ~ 4 sec
 
+    -eauto              Chooses the shortest N from a quick probe (a silence
+                        plus a short sweep), so that the expected S/N ratio
+                        reaches 60 dB and the room decay fits in the
+                        ending silence (up to 2^20).
+
 
     -noclearance        Ommit time clearance validation.
 
+    -single             Single precision (float32) FFT computing, it saves
+                        memory and time when using long sweeps.
+
     -nosmooth           Don't smooth freq response. Default smooth at 1/24 oct
 
     -auxplots           plot aux graphs (work in progress)
 
+    -blocking           Use the blocking sd.playrec instead of the streaming
+                        play/rec engine.
+
+    -noabort            Do not abort the recording when clipping is detected.
+
+    -multimic           Every extra input channel (3, 4, ...) is treated as
+                        another mic location, all of them deconvolved in a
+                        single batch, see DUT_FRDs.
+
+    -mesm               Multiple Exponential Sweep Method: L and R loudspeakers
+                        are driven with time offset sweeps in a single playback,
+                        then both TFs are separated after deconvolution.
+                        The R delay holds a 0.5 s room decay plus the lead of
+                        the R harmonics, so a long enough sweep is needed,
+                        e.g. -e20 at 48 KHz. (see the MESM wiring above)
+
+    -noise=XX           Seconds of silence captured before the sweep to get the
+                        noise floor and the S/N ratio by freq, default 0.5 s.
+                        (-noise=0 disables it)
+
+    -repeats=K          Plays K back to back sweeps in a single stream, then
+                        the captures are synchronously averaged, so gaining
+                        10*log10(K) dB of S/N ratio in noisy rooms.
+
+    -gate=XX            Gated (quasi anechoic) FRD from the impulse response,
+                        windowed XX ms after the main arrival.
+
+    -fdw=XX             Gated FRD by using a frequency dependent window,
+                        XX cycles long at every frequency.
+
+    -thd=K              Harmonic distortion analysis up to the K order,
+                        default 5 (H2...H5), -thd=0 disables it.
+
+    -chunked            Bounded memory mode for very long sweeps (e.g. -e22):
+                        the sweep is rendered on the fly and the capture is
+                        deconvolved block by block, so neither the sweep nor
+                        the recording are kept in memory. Only a 2^17 samples
+                        window of the impulse response is kept, so the sound
+                        card latency plus the room decay must fit in it.
+                        (-mesm and -repeats are not available)
+
+    -mls                Periodic Maximum Length Sequence excitation instead of
+                        the log sweep, deconvolved by a fast Hadamard transform.
+                        It is quick, so useful for live monitoring and mic
+                        positioning, but the room decay must fit in a period
+                        (2^XX - 1) and the harmonic distortion is not separated.
+                        -repeats=K averages K periods after a first one.
+
+    -multitone          Periodic multitone excitation (every bin, pink weighted,
+                        Schroeder phased), the same as -mls above.
+
 """
 #-------------------------------------------------------------------------------
 #-------------------------------- CREDITS: -------------------------------------
@@ -82,6 +154,7 @@
 #---------------------------- IMPORTING MODULES: -------------------------
 import  os
 import  sys
+import  threading
 from    time        import time
 import  sounddevice as sd
 from    fmt         import Fmt
@@ -97,7 +170,10 @@ import  matplotlib.pyplot as plt
 
 from    matplotlib.ticker   import EngFormatter
 from    numpy               import *                                # for code clarity
-from    scipy.signal        import correlate as signal_correlate    # to differentiate from numpy
+from    scipy.fft           import rfft, irfft, rfftfreq            # real input FFTs, also float32
+from    scipy.fft           import ifft
+from    scipy               import sparse
+from    scipy.signal        import max_len_seq
 
 # scipy.signal.correlate shows a FutureWarning, we do inhibit it:
 import  warnings
@@ -105,7 +181,6 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 UHOME = os.path.expanduser("~")
 sys.path.append(f'{UHOME}/audiotools')
-from    smoothSpectrum import smoothSpectrum as smooth
 import  tools
 
 #-------------------------------------------------------------------------------
@@ -117,6 +192,13 @@ checkClearence      = True
 
 printInfo           = True
 
+use_stream          = True      # callback driven play/rec (else sd.playrec)
+abortOnClip         = True      # abort recording if clipping is detected
+clipLevel           = 0.999     # abs sample value considered as clipping
+level_callback      = None      # An optional function(progress, peak_dBFS, rms_dBFS)
+                                # to monitor the recording, e.g. from a GUI.
+meas_abort_msg      = ''        # why the last measurement was aborted
+
 do_plot             = True      # recorded, time clearance, freq response plots
 aux_plot            = False     # currently only for the prepared sweep plot
 png_folder          = f'{UHOME}/DRC'
@@ -133,7 +215,31 @@ sig_frac    = 0.5               # Fraction of full scale applied to play the swe
 fs          = 48000             # Must ensure that sound driver accepts.
 N           = 2**18             # Lenght of the total sequence, make this
                                 # larger if there is insufficient time clearance
+f_start     = 5.0               # Sweep start freq (it will end at fs/2)
 clipWarning = -3.0              # dBFS warning when capturing
+precision   = 'double'          # 'double' (float64) or 'single' (float32) FFTs
+repeats     = 1                 # Back to back sweeps to be averaged per measurement
+noise_secs  = 0.5               # Leading silence to measure the noise floor (0: off)
+multimic    = False             # Extra input channels are extra mic locations
+mesm        = False             # L and R measured with time offset sweeps
+mesm_delay  = 0.0               # R sweep delay, as a fraction of N (must be < 1/4),
+                                # 0: the shortest one holding mesm_decay
+mesm_decay  = 0.5               # Room decay (s) every MESM IR window has to hold
+mesm_pre_ms = 2.0               # IR window margin before each sweep arrival
+chunked     = False             # Bounded memory deconvolution for very long sweeps
+chunk_frames = 2**15            # Chunked mode processing block
+chunk_ir_len = 2**17            # Chunked mode deconvolved IR window length
+chunk_pre    = 2**10            # Chunked mode IR window margin before the arrival
+gate_ms     = 0.0               # Fixed IR gate after the arrival for the gated FRD (0: off)
+fdw_cycles  = 0.0               # Freq dependent IR gate in cycles (0: off, else
+                                # it takes precedence over gate_ms)
+gate_pre_ms = 1.0               # IR gate fade in before the arrival
+harmonics   = 5                 # Harmonic distortion up to this order (< 2: off)
+excitation  = 'sweep'           # 'sweep', 'mls' or 'multitone' (periodic ones)
+auto_length = False             # Choose N from a quick noise and decay probe
+target_snr  = 60.0              # dB, the S/N ratio wanted when auto_length
+probe_e     = 15                # The auto_length probe sweep is 2^probe_e long
+max_e       = 20                # The longest sweep auto_length can choose
 
 system_type = 'electronic'      # 'acoustic', 'electronic', 'level-dependent'
 Po          = 2e-5              # SPL reference pressure
@@ -165,6 +271,17 @@ S_adc = 1.0
 ## S_dac=+1.148;        % USB Dual Pre peak volts out for digital Full Scale
 ## S_adc=+1.49;         % USB Dual Pre JV pot minimum (gain=3, Windows 7)
 
+#-------------------------------------------------------------------------------
+#----------------------------- SWEEP PLANS: ------------------------------------
+#-------------------------------------------------------------------------------
+sweep_plans = {}                # Already prepared SweepPlan's, by key
+sweep_plan  = None              # The SweepPlan in use, see prepare_sweep()
+sweep_generators = {}           # Already prepared SweepGenerator's, by key
+xcorr_dec   = 16                # Coarse time clearance xcorr decimation
+X           = None              # The last time clearance xcorr, see get_offset_xcorr()
+frd_operators = {}              # Already built FRD reduction operators, by key
+excitation_plans = {}           # Already prepared MLS and multitone plans, by key
+
 
 def plot_mic_compensation(hz, mic_db, raw_db, corrected_db):
     """
@@ -220,28 +337,224 @@ def set_mic_response():
 
 
 def get_mic_corrected_response(raw_frd, doplot=False):
+    """ see SweepSession.get_mic_corrected_response()
+    """
+    return SweepSession().get_mic_corrected_response(raw_frd, doplot)
+
+
+class StreamPlayRec:
+    """ A callback driven full duplex play/rec engine.
 
-    # extract freq and mag arrays from the given `xfrd` tuple
-    raw_freq, raw_db = raw_frd
+        The played signal is fed block by block, and the captured samples
+        are written into a preallocated ring buffer. Live peak and RMS levels
+        are updated on every block, and the recording is aborted as soon as
+        clipping or a sound card dropout (xrun) is detected.
 
-    # extract freq and mag arrays from the `mic_response` 2D array
-    mic_freq = mic_response[:, 0]
-    mic_db   = mic_response[:, 1]
+        When accumulating, every lap around the ring buffer is summed to the
+        previous ones, so a periodic test signal is synchronously averaged
+        with no more memory than a single period.
+    """
+
+    def __init__(self, playSignal, in_channels, samplerate, buffer_frames=0,
+                       accumulate=False, lead_frames=0, abortOnClip=True,
+                       clipLevel=0.999, level_callback=None):
+        """ playSignal:     array having a column per output channel
+            in_channels:    number of capture channels
+            samplerate:     the stream fs
+            buffer_frames:  ring buffer length (default the played length)
+            accumulate:     sum the captured laps instead of overwriting them
+            lead_frames:    leading captured frames to be kept apart in <lead>,
+                            e.g. a silence to measure the noise floor
+            abortOnClip, clipLevel, level_callback: as the module ones
+        """
+
+        self.fs         = samplerate
+        self.play       = ascontiguousarray(playSignal, dtype=float32)
+        self.nframes    = self.play.shape[0]
+        self.out_channels = self.play.shape[1]
+        self.lead_frames = lead_frames
+        self.lead       = zeros((lead_frames, in_channels), dtype=float32)
+        self.size       = buffer_frames or (self.nframes - lead_frames)
+        self.accumulate = accumulate
+        self.rec        = zeros((self.size, in_channels),
+                                dtype=float64 if accumulate else float32)
+        self.pos        = 0                         # frames captured so far
+        self.peak       = zeros(in_channels)        # peak hold
+        self.rms        = zeros(in_channels)        # last block RMS
+        self.abort_msg  = ''
+        self.done       = threading.Event()
+        self.poll       = 0.2                       # run() waiting loop (s)
+        self.abortOnClip    = abortOnClip
+        self.clipLevel      = clipLevel
+        self.level_callback = level_callback
+
+
+    def _render(self, n):
+        """ returns the next <n> frames to be played
+        """
+        return self.play[self.pos : self.pos + n]
+
+
+    def _consume(self):
+        """ called from the run() waiting loop, nothing to do here
+        """
+        pass
+
+
+    def _write(self, block):
+        """ writes a block into the ring buffer (the leading frames apart)
+        """
+        k = min([block.shape[0], max([0, self.lead_frames - self.pos])])
+        if k:
+            self.lead[self.pos : self.pos + k] = block[:k]
+            block = block[k:]
+
+        i = (self.pos + k - self.lead_frames) % self.size
+        n = min([block.shape[0], self.size - i])
+        if self.accumulate:
+            self.rec[i:i+n] += block[:n]
+            self.rec[:block.shape[0]-n] += block[n:]
+        else:
+            self.rec[i:i+n] = block[:n]
+            self.rec[:block.shape[0]-n] = block[n:]
+
+
+    def callback(self, indata, outdata, frames, time, status):
+
+        if status.input_overflow or status.output_underflow:
+            self.abort_msg = f'sound card dropout ({status})'
+
+        if self.abort_msg:
+            raise sd.CallbackAbort
+
+        n = min([frames, self.nframes - self.pos])
+
+        outdata[:n]  = self._render(n)
+        outdata[n:]  = 0
+
+        block = indata[:n]
+        self._write(block)
+
+        peak      = abs(block).max(axis=0)
+        self.peak = maximum(self.peak, peak)
+        self.rms  = sqrt( mean(block.astype(float64)**2, axis=0) )
+
+        self.pos += n
+
+        if self.abortOnClip and (peak >= self.clipLevel).any():
+            self.abort_msg = f'CLIPPING on input channel(s) {where(peak >= self.clipLevel)[0].tolist()}'
+            raise sd.CallbackAbort
+
+        if self.pos >= self.nframes:
+            raise sd.CallbackStop
 
-    # Interpolate mic response to the given raw_freq points.
-    # As log spaced audio freq points can be widely separated, it is
-    # preferred to interpolate over the logarithm of the frequency.
-    mic_db_interp = interp(log10(raw_freq), log10(mic_freq), mic_db)
 
-    # Finally, correct the given frd with the mic_frd
-    corrected_db = raw_db - mic_db_interp
+    def levels_dBFS(self):
+        """ returns (peak, rms) dBFS arrays, one value per input channel
+        """
+        with errstate(divide='ignore'):
+            return 20 * log10(self.peak), 20 * log10(self.rms)
 
-    print(f'{Fmt.GREEN}MIC correction was applied.{Fmt.END}')
 
-    if doplot:
-        plot_mic_compensation(raw_freq, mic_db_interp, raw_db, corrected_db)
+    def run(self):
+        """ Plays and records, reporting levels while waiting for the end.
+            Returns the captured ring buffer, or None if aborted.
+        """
 
-    return raw_freq, corrected_db
+        stream = sd.Stream( samplerate  = self.fs,
+                            channels    = (self.rec.shape[1], self.out_channels),
+                            dtype       = 'float32',
+                            callback    = self.callback,
+                            finished_callback = self.done.set )
+
+        with stream:
+
+            while not self.done.wait(self.poll):
+                self._consume()
+                progress = min([100, int(100 * self.pos / self.nframes)])
+                peak, rms = self.levels_dBFS()
+                if self.level_callback:
+                    self.level_callback(progress, peak, rms)
+                else:
+                    print( f'    {progress:3d} %   peak (dBFS): {around(peak, 1)}'
+                           f'   RMS (dBFS): {around(rms, 1)}      ', end='\r' )
+
+            # The sweep segment is complete, so do not wait for draining the
+            # output buffers, the recorded data can be processed right now.
+            stream.abort()
+
+        self._consume()
+        print()
+
+        if self.abort_msg:
+            return None
+
+        return self.rec
+
+
+class ChunkedPlayRec(StreamPlayRec):
+    """ A StreamPlayRec whose played sweep is rendered on the fly by a
+        SweepGenerator, and whose captured blocks are handed to a
+        ChunkedDeconvolver as soon as they arrive, so that the ring buffer
+        only needs a few processing blocks whatever the sweep length is.
+    """
+
+    def __init__(self, generator, gains, in_channels, deconvolver, block,
+                       abortOnClip=True, clipLevel=0.999, level_callback=None):
+        """ generator:      a SweepGenerator
+            gains:          the sweep gain for every output channel
+            in_channels:    number of capture channels
+            deconvolver:    a ChunkedDeconvolver
+            block:          frames to be handed every time to the deconvolver
+            abortOnClip, clipLevel, level_callback: as the module ones
+        """
+
+        self.fs         = generator.fs
+        self.gen        = generator
+        self.gains      = array(gains, dtype=float32)
+        self.nframes    = generator.N
+        self.out_channels = len(gains)
+        self.lead_frames = 0
+        self.size       = 8 * block
+        self.accumulate = False
+        self.rec        = zeros((self.size, in_channels), dtype=float32)
+        self.pos        = 0                         # frames captured so far
+        self.rpos       = 0                         # frames deconvolved so far
+        self.peak       = zeros(in_channels)
+        self.rms        = zeros(in_channels)
+        self.abort_msg  = ''
+        self.done       = threading.Event()
+        self.poll       = 0.05
+        self.deconv     = deconvolver
+        self.block      = block
+        self.abortOnClip    = abortOnClip
+        self.clipLevel      = clipLevel
+        self.level_callback = level_callback
+
+
+    def _render(self, n):
+        s = self.gen.tapsweep( arange(self.pos, self.pos + n) ).astype(float32)
+        return s[:, newaxis] * self.gains
+
+
+    def _consume(self):
+        """ deconvolves the captured blocks waiting in the ring buffer
+        """
+
+        while not self.abort_msg:
+
+            pos = self.pos
+            if pos - self.rpos > self.size - self.block:
+                self.abort_msg = 'deconvolution overrun, try a greater chunk_frames'
+                return
+
+            n = min([self.block, pos - self.rpos])
+            if n == 0 or (n < self.block and not self.done.is_set()):
+                return
+
+            idx = arange(self.rpos, self.rpos + n) % self.size
+            self.deconv.feed( self.rec[idx] )
+            self.rpos += n
 
 
 def get_avail_input_channels():
@@ -254,6 +567,12 @@ def get_avail_input_channels():
     return n
 
 
+def get_mic_inputs(input_channels):
+    """ see SweepSession.get_mic_inputs()
+    """
+    return SweepSession().get_mic_inputs(input_channels)
+
+
 def choose_soundcard():
 
     result = False
@@ -321,6 +640,8 @@ def do_print_info():
     print( 'N:              ' + str(N) + ' (test signal total lenght in samples)' )
     print( 'Duration:       ' + str( round((N/float(fs)), 2)) + ' s (N/fs)' )
     print( 'Time clearance: ' + str( round(N/(4.0*fs), 2) ) )
+    if repeats > 1:
+        print( f'Repeats:        {repeats} sweeps (+{round(10 * log10(repeats), 1)} dB S/N)' )
     print( 'System_type:    ' + system_type )
     print()
     return
@@ -387,69 +708,80 @@ def plot_system_response():
     #axDUT = plt.subplot2grid(shape=(3, 2), loc=(0, 0))
     #axTCL = plt.subplot2grid(shape=(3, 2), loc=(0, 1))
     #axFRE = plt.subplot2grid(shape=(3, 2), loc=(1, 0), colspan=2, rowspan=2)
-    axDUT = plt.subplot2grid(shape=(2, 2), loc=(0, 0))
-    axTCL = plt.subplot2grid(shape=(2, 2), loc=(0, 1))
-    axFRE = plt.subplot2grid(shape=(2, 2), loc=(1, 0), colspan=2)
+    if dut is None:
+        # (i) The chunked mode does not keep the captured waveforms
+        axFRE = plt.subplot2grid(shape=(2, 2), loc=(0, 0), colspan=2, rowspan=2)
 
-    #--- time domain vectors
-    vSamples = arange(0,N)                  # samples vector
-    vTimes   = vSamples / float(fs)         # samples to time conversion
-
-    #--- DUT and REFERENCE LOOP time domain plot
-    axREF = axDUT.twinx()
-
-    # Safe amplitudes
-    for axtmp in (axDUT, axREF):
-        for a in (-0.5, +0.5):
-            axtmp.plot(vTimes, full(vTimes.shape,  a), label='',
-                       linestyle='dashed', linewidth=0.5, color='gray')
-        for a in (-1.0, +1.0):
-            axtmp.plot(vTimes, full(vTimes.shape,  a), label='',
-                       linestyle='dashed', linewidth=0.5, color='maroon')
-
-    # DUT waveform
-    axDUT.plot(vTimes, dut, 'blue', linewidth=0.5, label='DUT')
-
-    # REF waveform
-    axREF.plot(vTimes, ref, 'grey', linewidth=0.5, label='REF')
-
-    axDUT.grid()
-    axDUT.set_ylim(-3.5, 1.5)
-    axDUT.set_yticks([-1, -.5, 0 , .5, 1])
-    axREF.set_ylim(-1.5, 3.5)               # Sliding the dut and ref Y scales
-    axREF.set_yticks([-1, -.5, 0 , .5, 1])
-    axDUT.legend(loc='upper left')
-    axREF.legend(loc='lower left')
-    axDUT.set_xlabel('time [s]')
-    axDUT.set_title('Recorded sweeps')
-
-    #--- X cross correlation (Time Clearance)
-    t  = vTimes
-    t -= N/2.0 / fs                         # Centering the X ideal peak at 0 ms
-    maxX = max(abs(X))
-    ylim = 1000                             # Expected X >~ 1000
-    if maxX > ylim:
-        ylim += ylim * (maxX // ylim)
-    axTCL.set_ylim(-ylim, +ylim)
-    axTCL.plot(t, X, color="black", label='xcorr pb/rec')
-    axTCL.grid()
-    axTCL.legend()
-    axTCL.set_xlabel('time (s)')
-    axTCL.set_title(f'Time Clearance:\nrecorder lags  player <---o---> ' \
-                    f'recorder leads player', fontsize='medium')
-
-    # A warning text box
-    msg = ''
-    if maxX < 200:
-        msg = 'bad spike shape'
-    elif maxX < 500:
-        msg = 'poor spike shape'
-    if msg:
-        # (these are matplotlib.patch.Patch properties)
-        props = dict(boxstyle='round', facecolor='silver', alpha=0.3)
-        axTCL.text( 0.0, -250.0,
-                 msg,
-                 bbox=props)
+    else:
+        if X is None:
+            # (i) No time clearance xcorr with periodic excitations
+            axDUT = plt.subplot2grid(shape=(2, 2), loc=(0, 0), colspan=2)
+        else:
+            axDUT = plt.subplot2grid(shape=(2, 2), loc=(0, 0))
+            axTCL = plt.subplot2grid(shape=(2, 2), loc=(0, 1))
+        axFRE = plt.subplot2grid(shape=(2, 2), loc=(1, 0), colspan=2)
+
+        #--- time domain vectors
+        vSamples = arange(dut.size)             # samples vector
+        vTimes   = vSamples / float(fs)         # samples to time conversion
+
+        #--- DUT and REFERENCE LOOP time domain plot
+        axREF = axDUT.twinx()
+
+        # Safe amplitudes
+        for axtmp in (axDUT, axREF):
+            for a in (-0.5, +0.5):
+                axtmp.plot(vTimes, full(vTimes.shape,  a), label='',
+                           linestyle='dashed', linewidth=0.5, color='gray')
+            for a in (-1.0, +1.0):
+                axtmp.plot(vTimes, full(vTimes.shape,  a), label='',
+                           linestyle='dashed', linewidth=0.5, color='maroon')
+
+        # DUT waveform
+        axDUT.plot(vTimes, dut, 'blue', linewidth=0.5, label='DUT')
+
+        # REF waveform
+        axREF.plot(vTimes, ref, 'grey', linewidth=0.5, label='REF')
+
+        axDUT.grid()
+        axDUT.set_ylim(-3.5, 1.5)
+        axDUT.set_yticks([-1, -.5, 0 , .5, 1])
+        axREF.set_ylim(-1.5, 3.5)               # Sliding the dut and ref Y scales
+        axREF.set_yticks([-1, -.5, 0 , .5, 1])
+        axDUT.legend(loc='upper left')
+        axREF.legend(loc='lower left')
+        axDUT.set_xlabel('time [s]')
+        axDUT.set_title(f'Recorded {excitation}')
+
+        #--- X cross correlation (Time Clearance)
+        if X is not None:
+            #    (i) X comes decimated from get_offset_xcorr()
+            t  = arange(X.size) * (N / X.size) / float(fs)
+            t -= N/2.0 / fs                         # Centering the X ideal peak at 0 ms
+            maxX = max(abs(X))
+            ylim = 1000                             # Expected X >~ 1000
+            if maxX > ylim:
+                ylim += ylim * (maxX // ylim)
+            axTCL.set_ylim(-ylim, +ylim)
+            axTCL.plot(t, X, color="black", label='xcorr pb/rec')
+            axTCL.grid()
+            axTCL.legend()
+            axTCL.set_xlabel('time (s)')
+            axTCL.set_title(f'Time Clearance:\nrecorder lags  player <---o---> ' \
+                            f'recorder leads player', fontsize='medium')
+
+            # A warning text box
+            msg = ''
+            if maxX < 200:
+                msg = 'bad spike shape'
+            elif maxX < 500:
+                msg = 'poor spike shape'
+            if msg:
+                # (these are matplotlib.patch.Patch properties)
+                props = dict(boxstyle='round', facecolor='silver', alpha=0.3)
+                axTCL.text( 0.0, -250.0,
+                         msg,
+                         bbox=props)
 
     #--- Freq Response graph
     F, dut_mag = DUT_FRD
@@ -462,9 +794,24 @@ def plot_system_response():
                 linestyle=':', linewidth=2.0,  color='purple')
 
     # plot curves
-    axFRE.semilogx( F, dut_mag, color='blue', label='DUT' )
+    axFRE.semilogx( F, dut_mag, color='blue', label=DUT_labels[0] )
     axFRE.semilogx( F, ref_mag, color='gray', label='REF' )
 
+    # MESM and/or multimic extra curves
+    for label, (_, mag) in zip(DUT_labels[1:], DUT_FRDs[1:]):
+        axFRE.semilogx( F, mag, linewidth=0.75, label=label )
+
+    # Noise floor
+    if NOISE_FRD:
+        axFRE.semilogx( *NOISE_FRD, color='gray', linestyle=':', linewidth=1,
+                        label='noise floor' )
+
+    # IR gated curve
+    if DUT_GATED_FRD:
+        Fg, gated_mag = DUT_GATED_FRD
+        axFRE.semilogx( Fg, gated_mag, color='blue', linestyle='--',
+                        linewidth=1, label=f'{DUT_labels[0]} {get_gate_label()}' )
+
     # formatting
     tmp = '' if not using_mic_response else ' (mic corrected)'
     axFRE.set_title(f'Freq. response{tmp}')
@@ -491,9 +838,45 @@ def plot_system_response():
 
 
 def plot_aux_graphs():
-    """ Aux graphs (currently only for the prepared sweep plot)
+    """ Aux graphs (currently the prepared sweep plot, the DUT ETC and
+        the harmonic distortion)
     """
 
+    # ---- Energy Time Curve
+    fig_etc, axETC = plt.subplots(figsize=(4.5, 2.6))  # in inches
+    t = (arange(DUT_ETC.size) - DUT_arrival) / float(fs) * 1e3
+    axETC.plot(t, DUT_ETC, color='blue', linewidth=0.5, label='DUT ETC')
+    axETC.grid()
+    axETC.set_xlim(-10, 200)
+    axETC.set_ylim(-80, 5)
+    axETC.set_xlabel('time from arrival [ms]')
+    axETC.set_ylabel('dB')
+    axETC.legend()
+    axETC.set_title(f'Energy Time Curve (delay {round(DUT_delay*1e3, 2)} ms)')
+    plt.savefig(f'{png_folder}/ETC.png')
+
+    # ---- Harmonic distortion
+    if THD_FRD:
+        fig_hd, axHD = plt.subplots(figsize=(6, 3))  # in inches
+        F, H1_dB = DUT_FRD
+        axHD.semilogx(F, H1_dB, color='blue', label='H1')
+        for k, (_, mag) in HD_FRDs.items():
+            axHD.semilogx(F, mag, linewidth=0.75, label=f'H{k}')
+        axHD.semilogx(F, THD_FRD[1], color='black', linestyle='--', label='THD')
+        axHD.grid(True, which="both", ls="-", alpha=0.5)
+        axHD.set_xlim(20, 20000)
+        axHD.set_ylim(-100, 10)
+        axHD.set_xlabel('fundamental freq (Hz)')
+        axHD.set_ylabel('dB')
+        axHD.legend(fontsize='small')
+        axHD.set_title('Harmonic distortion')
+        plt.tight_layout()
+        plt.savefig(f'{png_folder}/distortion.png')
+
+    # (i) The chunked mode does not keep the sweeps
+    if chunked or excitation != 'sweep':
+        return
+
     vSamples = arange(0,N)                  # samples vector
     vTimes   = vSamples / float(fs)         # samples to time conversion
 
@@ -510,22 +893,162 @@ def plot_aux_graphs():
     print( "--- Plotting aux graphs..." )
 
 
-def fft_to_FRD(wholeFFT, smooth_Noct=0):
+def get_fft_dtypes():
+    """ returns the (real, complex) dtypes as per the selected <precision>
+    """
+    return SweepSession().get_fft_dtypes()
+
+
+def get_FRD_operator(N, fs, FRDpoints, Noct):
+    """ Returns (f, M), where f are the <FRDpoints> logspaced frequencies and
+        M is a sparse matrix that maps a N/2 + 1 bins half spectrum magnitude
+        straight to the 1/Noct smoothed logspaced one.
+
+        M is the product of:
+
+        - the linear interpolation from the rfft bins onto the
+          tools.logspaced_semispectrum() frequencies,
 
-    # Frequencies
-    f = linspace(0, int(fs/2), int(N/2) )
+        - the 1/Noct oct gaussian smoothing, as per smoothSpectrum
+          (sigma = fc / Noct / pi, normalized weights),
 
-    # Taking the magnitude from the positive freqs fft part
-    mag = abs( wholeFFT[0 : int(N/2)] )
+        both being linear, so they are computed only once per key.
+    """
+
+    key = (N, fs, FRDpoints, Noct)
+
+    if key in frd_operators:
+        return frd_operators[key]
+
+    flin = rfftfreq(N, d=1.0/fs)
+
+    # The logspaced freqs as usual
+    f, _ = tools.logspaced_semispectrum(flin, ones(flin.size), FRDpoints)
+
+    # Linear interpolation, two bins per logspaced point
+    j = clip( searchsorted(flin, f) - 1, 0, flin.size - 2 )
+    w = clip( (f - flin[j]) / (flin[j+1] - flin[j]), 0.0, 1.0 )
+    rows = arange(f.size)
+    A = sparse.csr_matrix( ( concatenate((1 - w, w)),
+                             (concatenate((rows, rows)), concatenate((j, j + 1))) ),
+                           shape=(f.size, flin.size) )
+
+    if Noct:
+        # Gaussian weights, dropping the negligible ones beyond 5 sigmas
+        sigma = f / Noct / pi
+        d = (f[newaxis, :] - f[:, newaxis]) / sigma[:, newaxis]
+        G = where( abs(d) < 5, exp(-d**2 / 2), 0.0 )
+        G /= G.sum(axis=1, keepdims=True)
+        M = sparse.csr_matrix(G) @ A
+    else:
+        M = A
+
+    frd_operators[key] = (f, M.tocsr())
 
-    # reducing the fft linspaced spectrum into a logspaced one
-    f, mag = tools.logspaced_semispectrum(f, mag, FRDpoints)
+    return frd_operators[key]
 
-    # Smoothing
-    if smooth_Noct:
-        mag = smooth(f, mag, Noct=smooth_Noct)
 
-    return (f, mag)
+def fft_to_FRD(semiFFT, smooth_Noct=0):
+    """ see SweepSession.fft_to_FRD()
+    """
+    return SweepSession().fft_to_FRD(semiFFT, smooth_Noct)
+
+
+class SweepPlan:
+    """ The session stuff derived from a given test sweep, so that it is
+        computed only once and then reused by every measurement:
+
+            key:            (N, fs, f_start, f_stop, sig_frac, precision)
+            sweep:          A raw sweep.
+            tapsweep:       The sequence to be played: faded sweep + a zeroes tail
+            indexf1:        Index of pre-tapper end freq in tapsweep
+            LWINDOSWEEP:    Half spectrum (rfft) of the LF windowed sweep,
+                            scaled by sig_frac
+            INVSWEEP:       Its reciprocal, so that deconvolving becomes a product
+            Ls:             Time (s) for the sweep freq to increase by a factor e
+    """
+
+    def __init__(self, N, fs, f_start, f_stop, sig_frac, precision='double'):
+
+        self.key        = (N, fs, f_start, f_stop, sig_frac, precision)
+        self.N          = N
+        self.fs         = fs
+
+        rtype, ctype    = (float32, complex64) if precision == 'single' \
+                          else (float64, complex128)
+
+        # The played tapsweep (len=N) will be compund of
+        # a logsweep (len=N-Npad) plus a zeros tail (len=Npad).
+        Npad = int(N/4.0)
+        Ns   = N - Npad                             # most of array is used for sweep ;-)
+
+        ts   = linspace(0, Ns/float(fs), Ns)        # sweep's time points array
+
+        #--- tapered sweep window:
+        # Parameters to define a window to make a tapered sweep version,
+        # fade in until f1 then fade out from f2 on:
+        f1          = 10.0                          # end of turnon half-Hann
+        f2          = 0.91 * fs / 2                 # beginning of turnoff half-Hann
+        Ts          = Ns/float(fs)                  # sweep duration. Lenght N-Npad samples.
+        Ls          = Ts / log(f_stop/f_start)      # time for frequency to increase by factor e
+
+        indexf1 = int(round(fs * Ls * log(f1/f_start) ) + 1) # end of starting taper
+        indexf2 = int(round(fs * Ls * log(f2/f_start) ) + 1) # beginning of ending taper
+
+        print( "--- Calculating logsweep from ", int(f_start), "to", int(f_stop), "Hz" )
+        sweep       = zeros(N)                      # initialize
+        sweep[0:Ns] = sin( 2*pi * f_start * Ls * (exp(ts/Ls) - 1) )
+        #
+        #  /\/\/\/\/\/\/\/\----  this is the LOGSWEEP + Npad, with total lenght N.
+
+        window   = ones(N)
+        # pre-taper
+        window[0:indexf1]  = 0.5 * (1 - cos(pi * arange(0, indexf1)    / indexf1     ) )
+        # post-taper
+        window[indexf2:Ns] = 0.5 * (1 + cos(pi * arange(0, Ns-indexf2) / (Ns-indexf2)) )
+        window[Ns:N]       = 0      # Zeropad end of sweep
+
+        # Here the LOGSWEEP tapered at each end for output to DAC
+        tapsweep = window * sweep
+
+        # pending to find out the meaning fo this:
+        print( f'f_start * Ls: {str(round(f_start*Ls, 2))}  Ls: {str(round(Ls,2))}')
+
+        #--- The deconvolution spectrum, only LF pre-tapered
+        lwindo = ones(N)
+        lwindo[0:indexf1] = 0.5 * ( 1 - cos ( pi * arange(0,indexf1) / indexf1 ) )
+        lwindosweep = lwindo * sweep
+
+        print( '--- Calculating the sweep spectrum for deconvolution' )
+        self.LWINDOSWEEP = rfft(lwindosweep.astype(rtype)) * sig_frac  # sig_frac ~ atten
+        self.INVSWEEP    = (1.0 / self.LWINDOSWEEP).astype(ctype)
+
+        self.sweep      = sweep
+        self.tapsweep   = tapsweep
+        self.indexf1    = indexf1
+        self.Ls         = Ls
+
+
+    def inverse(self, offset=0):
+        """ Returns the inverse sweep spectrum as if the sweep was delayed
+            <offset> samples, i.e. the freq domain equivalent to
+            roll(lwindosweep, offset), so no new FFT is needed.
+        """
+
+        if not offset:
+            return self.INVSWEEP
+
+        # roll(x, offset) <--> X * exp(-j*2*pi*k*offset/N),
+        # so its reciprocal needs the opposite phase ramp.
+        k = arange(self.INVSWEEP.size)
+        ramp = exp(+2j * pi * k * offset / self.N).astype(self.INVSWEEP.dtype)
+        return self.INVSWEEP * ramp
+
+
+def get_sweep_key():
+    """ The sweep plan key as per the current parameters
+    """
+    return SweepSession().get_sweep_key()
 
 
 def prepare_sweep():
@@ -533,264 +1056,1602 @@ def prepare_sweep():
             sweep:      A raw sweep.
             tapsweep:   The sequence to be played: faded sweep + a zeroes tail
             indexf1:    Index of pre-tapper end freq in tapsweep
+            sweep_plan: The SweepPlan in use, it includes the above ones
+                        and the sweep spectrum for deconvolution.
+
+        Plans are cached by key (N, fs, f_start, f_stop, sig_frac, precision),
+        so preparing again an already known sweep does not compute anything.
     """
-    global sweep, tapsweep, indexf1
+    global sweep, tapsweep, indexf1, sweep_plan
+
+    session = SweepSession()
 
+    if session.get_sweep_key() in sweep_plans:
+        print( f'--- Reusing the prepared logsweep (N: {N}, fs: {fs})' )
 
-    # The played tapsweep (len=N) will be compund of
-    # a logsweep (len=N-Npad) plus a zeros tail (len=Npad).
-    Npad = int(N/4.0)
-    Ns   = N - Npad                             # most of array is used for sweep ;-)
+    sweep_plan = session.get_sweep_plan()
+    sweep      = sweep_plan.sweep
+    tapsweep   = sweep_plan.tapsweep
+    indexf1    = sweep_plan.indexf1
 
-    ts   = linspace(0, Ns/float(fs), Ns)        # sweep's time points array
+    print( 'Finished sweep generation...\n' )
 
-    #--- tapered sweep window:
-    # Parameters to define a window to make a tapered sweep version,
-    # fade in until f1 then fade out from f2 on:
-    f_start     = 5.0                           # beginning of turnon half-Hann
-    f1          = 10.0                          # end of turnon half-Hann
-    f2          = 0.91 * fs / 2                 # beginning of turnoff half-Hann
-    f_stop      = fs/2.0                        # end of turnoff half-Hann
-    Ts          = Ns/float(fs)                  # sweep duration. Lenght N-Npad samples.
-    Ls          = Ts / log(f_stop/f_start)      # time for frequency to increase by factor e
 
-    indexf1 = int(round(fs * Ls * log(f1/f_start) ) + 1) # end of starting taper
-    indexf2 = int(round(fs * Ls * log(f2/f_start) ) + 1) # beginning of ending taper
+class SweepGenerator:
+    """ The same tapered logsweep as in SweepPlan, but rendered on demand at
+        any given sample indexes, so no N length array is ever needed.
+        Also renders the analytic inverse filter (Farina), i.e. the time
+        reversed LF windowed sweep, +6 dB/oct amplitude modulated so that
+        sweep * inverse becomes a delayed band limited dirac.
 
-    print( "--- Calculating logsweep from ", int(f_start), "to", int(f_stop), "Hz" )
-    sweep       = zeros(N)                      # initialize
-    sweep[0:Ns] = sin( 2*pi * f_start * Ls * (exp(ts/Ls) - 1) )
-    #
-    #  /\/\/\/\/\/\/\/\----  this is the LOGSWEEP + Npad, with total lenght N.
+            key:        (N, fs, f_start, f_stop)
+            Ns:         The sweep length (the N - Npad zeros tail)
+            gain:       |LWINDOSWEEP * INVERSE| around 1 KHz, to normalize
+                        the deconvolved response
+    """
 
-    window   = ones(N)
-    # pre-taper
-    window[0:indexf1]  = 0.5 * (1 - cos(pi * arange(0, indexf1)    / indexf1     ) )
-    # post-taper
-    window[indexf2:Ns] = 0.5 * (1 + cos(pi * arange(0, Ns-indexf2) / (Ns-indexf2)) )
-    window[Ns:N]       = 0      # Zeropad end of sweep
+    def __init__(self, N, fs, f_start, f_stop):
 
-    # Here the LOGSWEEP tapered at each end for output to DAC
-    tapsweep = window * sweep
+        self.key        = (N, fs, f_start, f_stop)
+        self.N          = N
+        self.fs         = fs
+        self.f_start    = f_start
 
-    # pending to find out the meaning fo this:
-    print( f'f_start * Ls: {str(round(f_start*Ls, 2))}  Ls: {str(round(Ls,2))}')
+        self.Npad       = int(N/4.0)
+        self.Ns         = N - self.Npad
+        Ts              = self.Ns/float(fs)
+        self.dt         = Ts / (self.Ns - 1)        # as per linspace(0, Ts, Ns)
+        self.Ls         = Ts / log(f_stop/f_start)
 
-    print( 'Finished sweep generation...\n' )
+        f1              = 10.0
+        f2              = 0.91 * fs / 2
+        self.indexf1    = int(round(fs * self.Ls * log(f1/f_start) ) + 1)
+        self.indexf2    = int(round(fs * self.Ls * log(f2/f_start) ) + 1)
 
+        print( f'--- Preparing the on demand logsweep (N: {N}, fs: {fs})' )
+        self.gain       = self._gain( geomspace(707.0, 1414.0, 16) )
 
-def get_offset_xcorr(sweep, dut, ref):
+
+    def _raw(self, n):
+        """ the raw sweep at the given int array of sample indexes
+        """
+        inside = (n >= 0) & (n < self.Ns)
+        t = clip(n, 0, self.Ns - 1) * self.dt
+        return where(inside, sin(2*pi * self.f_start * self.Ls * (exp(t/self.Ls) - 1)), 0.0)
+
+
+    def _pretaper(self, n):
+        return where(n < self.indexf1,
+                     0.5 * (1 - cos(pi * clip(n, 0, None) / self.indexf1)), 1.0)
+
+
+    def _posttaper(self, n):
+        m = self.Ns - self.indexf2
+        return where(n >= self.indexf2,
+                     0.5 * (1 + cos(pi * clip(n - self.indexf2, 0, m) / m)), 1.0)
+
+
+    def tapsweep(self, n):
+        """ the sequence to be played
+        """
+        return self._raw(n) * self._pretaper(n) * self._posttaper(n)
+
+
+    def lwindosweep(self, n):
+        """ the sweep used for deconvolution, only LF pre-tapered
+        """
+        return self._raw(n) * self._pretaper(n)
+
+
+    def inverse(self, n):
+        """ the inverse filter, its dirac comes at sample Ns - 1
+        """
+        tau = self.Ns - 1 - n
+        return self.lwindosweep(tau) * exp( clip(tau - (self.Ns - 1), None, 0)
+                                            * self.dt / self.Ls )
+
+
+    def _gain(self, freqs, block=2**14):
+        """ |DTFT(lwindosweep) * DTFT(inverse)| RMS averaged over the given
+            freqs, computed block by block.
+            (i) A single freq would catch the sweep spectrum ripple.
+        """
+        w = 2 * pi * freqs / self.fs
+        S = zeros(freqs.size, dtype=complex128)
+        I = zeros(freqs.size, dtype=complex128)
+        for n0 in range(0, self.Ns, block):
+            n  = arange(n0, min([n0 + block, self.Ns]))
+            e  = exp(-1j * outer(n, w))
+            S += self.lwindosweep(n) @ e
+            I += self.inverse(n) @ e
+        return sqrt( mean( abs(S * I)**2 ) )
+
+
+def get_sweep_generator():
+    """ The SweepGenerator as per the current parameters, cached by key
     """
-    Determines CLEARANCE based on the offset found between recorded and played signals.
-    The offset is estimated by using crosscorrelation within them.
+    return SweepSession().get_sweep_generator()
+
 
-    If the offset exceeds the ending silence (Npad zeros), then information will be lost
-    and CLEARANCE warning appears.
+class ChunkedDeconvolver:
+    """ Linear deconvolution of the captured signals by the SweepGenerator
+        inverse filter, computed block by block in the freq domain as
+        an overlap-save, but only the <ir_len> output samples starting <pre>
+        samples before the expected dirac are accumulated.
 
-    returns: offset, TimeClearanceOK
+        Memory does not depend on N, it is about the <ir_len> window plus
+        a few <block> + <ir_len> long FFT buffers.
 
+            h:  the deconvolved window, a row per captured channel
     """
 
-    global X  # global scoped for plotting later
+    def __init__(self, generator, channels, block, ir_len, pre):
 
-    ### Matlab code:
-    # lags = N/2                    % large enough to catch most delays
-    #                                 (!) no usable en Numpy.correlate
-    ## if max(ref) < 0.1*max(dut)   % automatic reference selection
-    ##    X=xcorr(sweep,dut,lags);  % in case reference is low, use data itself
-    ##else
-    ##    X=xcorr(sweep,ref,lags);  % this uses recorded reference
-    ##end
-    ## [~,nmax]=max(abs(X));
+        self.gen    = generator
+        self.W      = ir_len
+        self.L      = block + ir_len                # FFT length
+        self.n0     = generator.Ns - 1 - pre        # output index of h[:, 0]
+        self.m0     = 0                             # input samples fed so far
+        self.h      = zeros((channels, ir_len))
 
-    # Correlate with an automatic reference selection:
-    # (i) For offset estimation, it is preferred to take an undisturbed signal.
-    #     The mic captured signal maybe too noisy to be able to be correlated.
-    #     If not enough signal in ref channel, will use the mic channel instead.
 
-    myref = ref
-    if max(ref) < 0.1 * max(dut):  # but if no signal on ref, use data itself
-        myref = dut
-        print('(!) Bad level on REF ch, using DUT ch itself to estimate clearance')
+    def feed(self, x):
+        """ x: a captured block (up to <block> frames), a column per channel
+        """
 
-    print( '--- Determining record/play delay using crosscorrelation '
-           '(can take a while ...)' )
+        B = x.shape[0]
 
-    timestamp = time()
+        # The inverse filter segment reaching the output window from this block
+        q0  = self.n0 - self.m0 - B + 1
+        inv = self.gen.inverse( arange(q0, q0 + self.L) )
 
-    ### (i) scipy.signal.correlate doesn't use the parameter 'lags' as in Matlab
-    #      (numpy.correlate is too slow, will use scipy.signal equivalent)
+        if inv.any():
+            # circular convolution, the first B-1 samples are aliased
+            y = irfft( rfft(x.T, n=self.L, axis=-1) * rfft(inv), n=self.L, axis=-1 )
+            self.h += y[:, B-1 : B-1 + self.W]
 
-    X = signal_correlate(sweep, myref, mode="same")
-    offset = int(N/2) - argmax(X)
+        self.m0 += B
 
-    print( "Computed in " + str( round(time() - timestamp, 1) ) + " s" )
 
-    print( 'Record offset: ' +  str(offset) + ' samples' + \
-          ' (' +  str( round( offset/float(fs), 3) ) + ' s)' )
-    if offset < 0:
-        print( '(i) Negative offset means player lags recorder!' )
+def fwht(x):
+    """ Fast Walsh-Hadamard transform along the last axis (2^m long),
+        natural (Sylvester) order, unnormalized, by additions only.
+    """
+    n = x.shape[-1]
+    h = 1
+    while h < n:
+        y = x.reshape(x.shape[:-1] + (n // (2*h), 2, h))
+        a, b = y[..., 0, :], y[..., 1, :]
+        x = stack((a + b, a - b), axis=-2).reshape(x.shape)
+        h *= 2
+    return x
+
+
+class MLSPlan:
+    """ A Maximum Length Sequence excitation, period P = N - 1 samples:
+
+            signal:     one period of +/-1 values
+            state:      the m bits LFSR state that follows every sample,
+                        i.e. where each captured sample goes into the
+                        Hadamard domain
+            coeff:      the Hadamard domain index for every IR sample
+
+        The circular crosscorrelation of the captured period with the MLS
+        becomes a permutation, a fast Walsh-Hadamard transform and
+        another permutation, so no multiplies are needed.
+    """
 
-    Npad=int(N/4.0)
-    if abs(offset) > Npad:
-        TimeClearanceOK = False
-    else:
-        TimeClearanceOK = True
+    def __init__(self, N, fs, precision='double'):
 
-    return offset, TimeClearanceOK
+        self.key    = ('mls', N, fs, precision)
+        self.N      = N
+        self.period = N - 1
 
+        rtype, _    = (float32, complex64) if precision == 'single' \
+                      else (float64, complex128)
 
-def do_meas(plot_mic=False):
+        m = int(log2(N))
+        P = self.period
+
+        print( f'--- Calculating the MLS of order {m} (period {P} samples)' )
+        b, _ = max_len_seq(m)
+        b = b.astype(int64)
+
+        # Every nonzero m bits window b[n:n+m] appears once per period
+        state = zeros(P, dtype=int64)
+        for j in range(m):
+            state |= roll(b, -j) << j
+
+        # b[n-k] is a parity of the state at n, its mask for every lag k
+        # comes from the samples whose state is a single bit (2^j)
+        where_state = zeros(N, dtype=int64)
+        where_state[state] = arange(P)
+        k = arange(P)
+        coeff = zeros(P, dtype=int64)
+        for j in range(m):
+            coeff |= b[(where_state[1 << j] - k) % P] << j
+
+        self.signal = (1.0 - 2.0 * b).astype(rtype)
+        self.state  = state
+        self.coeff  = coeff
+        self.rtype  = rtype
+
+
+    def impulse(self, y):
+        """ The periodic impulse response (P samples) from the captured
+            period <y>, or a stack of them (a row per channel)
+        """
+        P = self.period
+        Y = zeros(y.shape[:-1] + (self.N,), dtype=self.rtype)
+        Y[..., self.state] = y
+        c = fwht(Y)[..., self.coeff]
+        # (i) the MLS crosscorrelation has a -sum(h) bias, and sum(c) == sum(h)
+        return (c + c.sum(axis=-1, keepdims=True)) / (P + 1)
+
+
+class MultitonePlan:
+    """ A periodic multitone excitation, period N samples:
+
+            signal:     one period, peak normalized
+            SPECTRUM:   its half spectrum
+            INV:        the reciprocal on the excited bins (all except DC)
+
+        Tones are on every rfft bin, weighted as the log sweep is (pink,
+        flat below f_start), and Schroeder phased for a low crest factor.
     """
-    Compute globals about DUT Device-Under-Test and REFerence measurements.
 
-        dut,    ref             Time domain captured waveforms
+    def __init__(self, N, fs, f_start, precision='double'):
 
-        DUT_TF, REF_TF          Freq domain Transfer Functions (whole complex FFTs)
+        self.key    = ('multitone', N, fs, f_start, precision)
+        self.N      = N
+        self.period = N
 
-        DUT_FRD, REF_FRD        Freq Response Data rendered over the configured
-                                <FRDpoints> frequency logspaced points.
-                                These are given as tuples (freq, mag)
+        rtype, ctype = (float32, complex64) if precision == 'single' \
+                       else (float64, complex128)
+
+        print( f'--- Calculating the multitone (period {N} samples)' )
+        k  = arange(N//2 + 1)
+        k0 = max([1, int(ceil(f_start * N / fs))])
+        A  = zeros(k.size)
+        A[1:] = 1.0 / sqrt( maximum(k[1:], k0) )
+
+        # Schroeder phases: phi_n = -2*pi * sum_l<n (n - l) * p_l
+        p   = A**2 / sum(A**2)
+        phi = -2 * pi * ( k * (cumsum(p) - p) - (cumsum(k * p) - k * p) )
+
+        X = A * exp(1j * phi)
+        X[-1] = abs(X[-1])                          # a real Nyquist bin
+        x = irfft(X, n=N)
+        peak = max(abs(x))
+
+        self.signal     = (x / peak).astype(rtype)
+        self.SPECTRUM   = X / peak
+        self.INV        = where(A > 0, 1.0 / where(A > 0, self.SPECTRUM, 1), 0).astype(ctype)
 
-        TimeClearanceOK         Boolean about the detected time clearance
 
+    def impulse(self, y):
+        """ The periodic impulse response (N samples) from the captured
+            period <y>, or a stack of them (a row per channel)
+        """
+        return irfft(rfft(y, axis=-1) * self.INV, n=self.N, axis=-1)
+
+
+def get_excitation_plan():
+    """ The MLSPlan or MultitonePlan as per the current <excitation> and
+        parameters, cached by key.
     """
+    return SweepSession().get_excitation_plan()
 
-    global dut, ref, mic_response
-    global DUT_TF, REF_TF
-    global DUT_FRD, REF_FRD
-    global TimeClearanceOK
 
-    #---------------------------------------------------------------------------
-    # ---- SPL calibration as per system type
-    #---------------------------------------------------------------------------
-    if system_type == 'acoustic':
-        CF = Vw / (power_amp_gain * mic_cal * mic_preamp_gain * Po)
-    elif system_type == 'electronic':
-        CF = 1 / electronic_gain
-    elif system_type == 'level-dependent':
-        CF = 1 / (sig_frac * mic_cal * mic_preamp_gain * Po)
+def get_gate_label():
+    if fdw_cycles:
+        return f'FDW {fdw_cycles} cycles'
     else:
-        print( "(!) Please check system_type for CF" )
-        return zeros(N)
+        return f'gated {gate_ms} ms'
+
+
+def gate_window(pre, post):
+    """ A half Hann fade in <pre> samples long, then a half Hann fade out
+        <post> samples long.
+    """
+    return concatenate(( 0.5 * (1 - cos(pi * arange(pre) / pre)),
+                         0.5 * (1 + cos(pi * arange(post) / post)) ))
+
+
+class Capture:
+    """ The outcome of a SweepSession.record() take, i.e. everything that
+        its analyse() needs, no play/rec stuff:
+
+            kind:           'sweep', 'chunked' or 'periodic'
+            input_channels: sound card inputs
+            mic_inputs:     the ones used as mics, see get_mic_inputs()
+            z:              the captured period (the averaged one if repeats),
+                            a column per input (None in chunked mode)
+            noise:          the captured leading silence, a column per input
+            h:              the deconvolved IR window (chunked mode only),
+                            a row per input
+            peak:           peak dBFS, one value per input (chunked mode only)
+            clearance:      (offset, TimeClearanceOK, X) once computed, see
+                            SweepSession.get_clearance()
+    """
+
+    def __init__(self, kind, input_channels, mic_inputs,
+                       z=None, noise=None, h=None, peak=None):
+
+        self.kind           = kind
+        self.input_channels = input_channels
+        self.mic_inputs     = mic_inputs
+        self.z              = z
+        self.noise          = noise
+        self.h              = h
+        self.peak           = peak
+        self.clearance      = None
+
+
+class SweepSession:
+    """ A measurement session having its own explicit state: a snapshot of
+        the module parameters when it is created (any of them can be given
+        as a keyword argument instead). So the play/rec part and the analysis
+        part are apart:
+
+            capture = session.record()              # a Capture, or None
+            results = session.analyse(capture)      # a dictionary
+
+        and neither of them reads or writes the module globals, so a take
+        can be analysed in a thread while the next one is being recorded,
+        and several sessions having different parameters can live together.
+
+        The results dictionary keys are named as the do_meas() globals, and
+        the module level functions are delegated to a session built from the
+        current module parameters, e.g. do_meas() just publishes the results.
+    """
+
+    params = ( 'fs', 'N', 'f_start', 'sig_frac', 'precision', 'repeats',
+               'noise_secs', 'multimic', 'mesm', 'mesm_delay', 'mesm_decay',
+               'mesm_pre_ms', 'chunked', 'chunk_frames', 'chunk_ir_len', 'chunk_pre',
+               'gate_ms', 'fdw_cycles', 'gate_pre_ms', 'harmonics',
+               'excitation', 'checkClearence', 'use_stream', 'clipWarning',
+               'abortOnClip', 'clipLevel', 'level_callback',
+               'system_type', 'Po', 'power_amp_gain', 'mic_cal',
+               'mic_preamp_gain', 'Vw', 'electronic_gain', 'S_dac', 'S_adc',
+               'FRDpoints', 'Noct', 'xcorr_dec',
+               'mic_response', 'using_mic_response' )
+
+
+    def __init__(self, **kwargs):
+
+        g = globals()
+        for name in self.params:
+            setattr(self, name, kwargs.pop(name, g[name]))
+
+        if kwargs:
+            raise TypeError(f'unknown SweepSession parameters: {list(kwargs)}')
+
+        self.abort_msg  = ''                        # why the last take was aborted
+
 
     #---------------------------------------------------------------------------
-    #---------- 2. data gathering: send out sweep, record system output --------
+    # Prepared stuff, shared by sessions through the module caches
     #---------------------------------------------------------------------------
+    def get_fft_dtypes(self):
+        """ returns the (real, complex) dtypes as per the <precision>
+        """
+        if self.precision == 'single':
+            return float32, complex64
+        else:
+            return float64, complex128
 
-    # Prepare test signal array
-    input_channels = get_avail_input_channels()
-    if  input_channels == 1:
-        testSignal = array([sig_frac * tapsweep])                       # [ch0]
-    else:
-        # Antiphased signals on channels avoids codec midtap modulation.
-        # 'sig_frac' means the applied attenuation
-        testSignal = array([sig_frac * tapsweep, sig_frac * -tapsweep]) # [ch0, ch1]
-
-    print( '--- Starting recording ...' )
-    print( '(i) Some sound cards act strangely. Check carefully!' )
-
-    # Setting sound device interface
-    sd.default.samplerate = fs
-    sd.default.channels = input_channels
-    rec_dev_name = sd.query_devices(sd.default.device[0], kind='input' )['name']
-    pbk_dev_name = sd.query_devices(sd.default.device[1], kind='output')['name']
-
-    print(f'{Fmt.BLUE}    in:  {rec_dev_name}')
-    print(f'    out: {pbk_dev_name}')
-    print(f'    fs: {sd.default.samplerate} {Fmt.BOLD}CHANNELS: {input_channels}{Fmt.END}' )
-
-    # Full duplex Play/Rec
-    # (i) .transpose because the player needs an array having a column per channel.
-    #     'blocking' waits to finish.
-    z = sd.playrec(testSignal.transpose(), channels=input_channels, blocking=True)
-    dut = z[:, 0]                               # DUT --> LEFT CHANNEL
-    if  input_channels == 1:
-        ref = (0.5 * sig_frac * tapsweep).transpose()
-    else:
-        ref = z[:, 1]                           # REF --> RIGHT CHANNEL
 
-    #N = len(dut)   # This seems to be redundant ¿?
-    print( 'Finished recording.' )
+    def get_sweep_key(self):
+        return (self.N, self.fs, self.f_start, self.fs/2.0, self.sig_frac, self.precision)
+
 
-    #-------------  Checking time domain SAMPLES RECORDING LEVELS -------------
-    print( "--- Checking time domain SAMPLES RECORDING LEVELS:" )
-    maxdBFS_dut = 20 * log10( max( abs( dut ) ) )
-    maxdBFS_ref = 20 * log10( max( abs( ref ) ) )
-    # LSB: Less Significant Bit
-    dut_RMS_LSBs = round(sqrt( 2**30 * sum(dut**2) / N ), 2)
-    ref_RMS_LSBs = round(sqrt( 2**30 * sum(ref**2) / N ), 2)
+    def get_sweep_plan(self):
+        """ The SweepPlan as per the session parameters, cached by key
+        """
+        key = self.get_sweep_key()
+        if key not in sweep_plans:
+            sweep_plans[key] = SweepPlan(*key)
+        return sweep_plans[key]
 
-    alert_dut = '           '
-    if maxdBFS_dut >= clipWarning:
-        alert_dut = 'WARNING (!)'
-    alert_ref = '           '
-    if maxdBFS_ref >= clipWarning:
-        alert_ref = 'WARNING (!)'
 
-    print( f'DUT channel max level: {round(maxdBFS_dut, 1):6} dBFS {alert_dut} RMS_LSBs: {dut_RMS_LSBs}')
-    print( f'REF channel max level: {round(maxdBFS_ref, 1):6} dBFS {alert_ref} RMS_LSBs: {ref_RMS_LSBs}')
+    def get_sweep_generator(self):
+        """ The SweepGenerator as per the session parameters, cached by key
+        """
+        key = (self.N, self.fs, self.f_start, self.fs/2.0)
+        if key not in sweep_generators:
+            sweep_generators[key] = SweepGenerator(*key)
+        return sweep_generators[key]
+
+
+    def get_excitation_plan(self):
+        """ The MLSPlan or MultitonePlan as per the session <excitation> and
+            parameters, cached by key.
+        """
+        if self.excitation == 'mls':
+            key = ('mls', self.N, self.fs, self.precision)
+        else:
+            key = ('multitone', self.N, self.fs, self.f_start, self.precision)
+
+        if key not in excitation_plans:
+            if self.excitation == 'mls':
+                excitation_plans[key] = MLSPlan(*key[1:])
+            else:
+                excitation_plans[key] = MultitonePlan(*key[1:])
+
+        return excitation_plans[key]
+
+
+    def get_mesm_lead(self):
+        """ How long (samples) the <harmonics> order harmonic of a sweep arrives
+            before its linear response in the IR, i.e. Ls*ln(K), see SweepPlan.
+        """
+        Ls = (self.N - int(self.N / 4.0)) / log(self.fs / 2.0 / self.f_start)
+        return int(ceil(Ls * log(max([self.harmonics, 2]))))
+
+
+    def get_mesm_min_delay(self):
+        """ The shortest R sweep delay (samples) that holds the <mesm_decay> in
+            the L window, plus the R harmonics arriving before the R response.
+        """
+        pre = int(self.mesm_pre_ms / 1000 * self.fs)
+        return int(self.mesm_decay * self.fs) + self.get_mesm_lead() + pre
+
+
+    def get_mesm_delay(self):
+        """ The delay in samples of the R sweep when using MESM, by default the
+            shortest one, see get_mesm_min_delay().
+
+            Raises ValueError if <mesm_delay> is too short, or if the delayed
+            R sweep does not end inside the Npad ending silence.
+        """
+        N    = self.N
+        Dmin = self.get_mesm_min_delay()
+        D    = int(N * self.mesm_delay) if self.mesm_delay else Dmin
+
+        if D < Dmin:
+            raise ValueError( f'MESM delay {D} samples is too short, {Dmin} needed '
+                              f'for a {self.mesm_decay} s decay and the R harmonics' )
+        if D >= int(N / 4.0):
+            raise ValueError( f'MESM delay {D} samples does not fit in the N/4 '
+                              f'ending silence, a longer sweep is needed' )
+        return D
+
+
+    def get_mic_inputs(self, input_channels):
+        """ The input channel indexes used as mics: the LEFT one (DUT), then in
+            multimic mode every extra one beyond the RIGHT (REF) channel.
+        """
+        if self.multimic:
+            return [0] + list(range(2, input_channels))
+        return [0]
+
+
+    def get_CF(self):
+        """ SPL calibration factor as per system type (None if unknown)
+        """
+        if self.system_type == 'acoustic':
+            return self.Vw / (self.power_amp_gain * self.mic_cal *
+                              self.mic_preamp_gain * self.Po)
+        elif self.system_type == 'electronic':
+            return 1 / self.electronic_gain
+        elif self.system_type == 'level-dependent':
+            return 1 / (self.sig_frac * self.mic_cal * self.mic_preamp_gain * self.Po)
+        else:
+            return None
+
 
     #---------------------------------------------------------------------------
-    #------------- 3. Determine if time clearance: -----------------------------
-    # Checks if ound card play/rec delay is lower than the zeropad silence
-    # at the signal end. Will use crosscorrelation
+    # Play / Rec
     #---------------------------------------------------------------------------
-    offset = 0              # ideal record/play delay
-    TimeClearanceOK = True
-    if checkClearence:
-        offset, TimeClearanceOK = get_offset_xcorr(sweep=sweep, dut=dut, ref=ref)
+    def play_rec(self, testSignal, input_channels, period, lead_frames=0):
+        """ Plays <testSignal> (a row per output channel) and records:
+
+                - the <lead_frames> first captured frames apart,
+                - the following ones, a sequence of <period> long periods
+                  that are synchronously averaged.
+
+            returns (lead, z), a column per input, or None if aborted
+        """
+
+        sd.default.samplerate = self.fs
+        sd.default.channels = input_channels
+
+        repeated = testSignal.shape[1] - lead_frames > period
+
+        # (i) .transpose because the player needs an array having a column per channel.
+        # (i) When repeating, the periods are aligned by the known period
+        #     length, then synchronously averaged in the time domain, so only
+        #     a single FFT is needed.
+        if self.use_stream:
+            engine = StreamPlayRec(testSignal.transpose(), input_channels, self.fs,
+                                   buffer_frames=period, accumulate=repeated,
+                                   lead_frames=lead_frames,
+                                   abortOnClip=self.abortOnClip,
+                                   clipLevel=self.clipLevel,
+                                   level_callback=self.level_callback)
+            z = engine.run()
+            if z is None:
+                self.abort_msg = engine.abort_msg
+                print(f'{Fmt.RED}(!) Recording ABORTED: {self.abort_msg}{Fmt.END}')
+                return None
+            if repeated:
+                z = z / ((testSignal.shape[1] - lead_frames) // period)
+            return engine.lead, z
+
+        else:
+            # 'blocking' waits to finish.
+            z = sd.playrec(testSignal.transpose(), channels=input_channels, blocking=True)
+            lead, z = z[:lead_frames], z[lead_frames:]
+            return lead, z.reshape(-1, period, input_channels).mean(axis=0)
+
+
+    def record(self):
+        """ Plays and records a take as per the session parameters.
+            Returns a Capture, or None if aborted, see <abort_msg>.
+        """
+
+        self.abort_msg = ''
+
+        if self.get_CF() is None:
+            print( "(!) Please check system_type for CF" )
+            self.abort_msg = 'bad system_type'
+            return None
+
+        # MLS and multitone are measured in their own way
+        if self.excitation != 'sweep':
+            return self.record_periodic()
+
+        # Very long sweeps are processed on the fly, no sweep plan is needed
+        if self.chunked:
+            return self.record_chunked()
+
+        return self.record_sweep()
+
+
+    def record_sweep(self):
+
+        N         = self.N
+        sig_frac  = self.sig_frac
+        tapsweep  = self.get_sweep_plan().tapsweep
+
+        # Prepare test signal array
+        input_channels = get_avail_input_channels()
+        if self.mesm:
+            try:
+                D = self.get_mesm_delay()
+            except ValueError as e:
+                print(f'{Fmt.RED}(!) {e}{Fmt.END}')
+                self.abort_msg = str(e)
+                return None
+            # Time offset sweeps, both loudspeakers are measured at once
+            testSignal = array([sig_frac * tapsweep,
+                                sig_frac * roll(tapsweep, D)])                      # [L, R]
+        elif  input_channels == 1:
+            testSignal = array([sig_frac * tapsweep])                       # [ch0]
+        else:
+            # Antiphased signals on channels avoids codec midtap modulation.
+            # 'sig_frac' means the applied attenuation
+            testSignal = array([sig_frac * tapsweep, sig_frac * -tapsweep]) # [ch0, ch1]
+
+        # K back to back periods, all of them played in a single stream
+        if self.repeats > 1:
+            testSignal = tile(testSignal, self.repeats)
+            print( f'--- Will average {self.repeats} back to back sweeps' )
+
+        # A leading silence in the same stream to measure the noise floor
+        Nnoise = min([int(self.noise_secs * self.fs), N])
+        if Nnoise:
+            testSignal = concatenate( (zeros((testSignal.shape[0], Nnoise)), testSignal),
+                                      axis=1 )
+
+        print( '--- Starting recording ...' )
+        print( '(i) Some sound cards act strangely. Check carefully!' )
+
+        # Setting sound device interface
+        rec_dev_name = sd.query_devices(sd.default.device[0], kind='input' )['name']
+        pbk_dev_name = sd.query_devices(sd.default.device[1], kind='output')['name']
+
+        print(f'{Fmt.BLUE}    in:  {rec_dev_name}')
+        print(f'    out: {pbk_dev_name}')
+        print(f'    fs: {self.fs} {Fmt.BOLD}CHANNELS: {input_channels}{Fmt.END}' )
+
+        # Full duplex Play/Rec
+        tmp = self.play_rec(testSignal, input_channels, N, lead_frames=Nnoise)
+        if tmp is None:
+            return None
+        noise, z = tmp
+
+        mic_inputs = self.get_mic_inputs(input_channels)
+        duts = z[:, mic_inputs]                     # all mics, DUT first
+        dut = z[:, 0]                               # DUT --> LEFT CHANNEL
+        if  input_channels == 1 or self.mesm:       # no REF loop available
+            ref = (0.5 * sig_frac * tapsweep).transpose()
+        else:
+            ref = z[:, 1]                           # REF --> RIGHT CHANNEL
+
+        #N = len(dut)   # This seems to be redundant ¿?
+        print( 'Finished recording.' )
+
+        #-------------  Checking time domain SAMPLES RECORDING LEVELS -------------
+        print( "--- Checking time domain SAMPLES RECORDING LEVELS:" )
+        maxdBFS_dut = 20 * log10( max( abs( dut ) ) )
+        maxdBFS_ref = 20 * log10( max( abs( ref ) ) )
+        # LSB: Less Significant Bit
+        dut_RMS_LSBs = round(sqrt( 2**30 * sum(dut**2) / N ), 2)
+        ref_RMS_LSBs = round(sqrt( 2**30 * sum(ref**2) / N ), 2)
+
+        alert_dut = '           '
+        if maxdBFS_dut >= self.clipWarning:
+            alert_dut = 'WARNING (!)'
+        alert_ref = '           '
+        if maxdBFS_ref >= self.clipWarning:
+            alert_ref = 'WARNING (!)'
+
+        print( f'DUT channel max level: {round(maxdBFS_dut, 1):6} dBFS {alert_dut} RMS_LSBs: {dut_RMS_LSBs}')
+        print( f'REF channel max level: {round(maxdBFS_ref, 1):6} dBFS {alert_ref} RMS_LSBs: {ref_RMS_LSBs}')
+
+        for i, ch in enumerate(mic_inputs[1:]):
+            maxdBFS = 20 * log10( max( abs( duts[:, i+1] ) ) )
+            alert   = 'WARNING (!)' if maxdBFS >= self.clipWarning else '           '
+            print( f'MIC#{i+2} (in {ch+1}) max level: {round(maxdBFS, 1):6} dBFS {alert}')
+
+        return Capture('sweep', input_channels, mic_inputs, z=z, noise=noise)
+
+
+    def record_chunked(self):
+        """ The record() flavour for very long sweeps, having bounded memory:
+
+            - The sweep is rendered on the fly while playing.
+
+            - The captured blocks are deconvolved as soon as they arrive, by
+              the analytic inverse filter, see ChunkedDeconvolver.
+
+            So the Capture has the deconvolved IR window instead of the
+            captured waveforms.
+        """
+
+        if self.mesm or self.repeats > 1:
+            print(f'{Fmt.RED}(!) -mesm and -repeats are not available in chunked mode{Fmt.END}')
+            self.abort_msg = 'not available in chunked mode'
+            return None
+
+        gen = self.get_sweep_generator()
+
+        input_channels = get_avail_input_channels()
+        if  input_channels == 1:
+            gains = [self.sig_frac]
+        else:
+            # Antiphased signals as in record_sweep()
+            gains = [self.sig_frac, -self.sig_frac]
+
+        print( '--- Starting recording (chunked mode) ...' )
+        sd.default.samplerate = self.fs
+        sd.default.channels = input_channels
+
+        deconv = ChunkedDeconvolver(gen, input_channels, self.chunk_frames,
+                                    self.chunk_ir_len, self.chunk_pre)
+        engine = ChunkedPlayRec(gen, gains, input_channels, deconv, self.chunk_frames,
+                                abortOnClip=self.abortOnClip,
+                                clipLevel=self.clipLevel,
+                                level_callback=self.level_callback)
+        if engine.run() is None:
+            self.abort_msg = engine.abort_msg
+            print(f'{Fmt.RED}(!) Recording ABORTED: {self.abort_msg}{Fmt.END}')
+            return None
+
+        print( 'Finished recording.' )
+
+        #-------------  Checking time domain SAMPLES RECORDING LEVELS -------------
+        print( "--- Checking time domain SAMPLES RECORDING LEVELS:" )
+        mic_inputs = self.get_mic_inputs(input_channels)
+        peak, _ = engine.levels_dBFS()
+        for i, ch in enumerate(mic_inputs):
+            alert = 'WARNING (!)' if peak[ch] >= self.clipWarning else '           '
+            name  = 'DUT channel' if i == 0 else f'MIC#{i+1} (in {ch+1})'
+            print( f'{name} max level: {round(peak[ch], 1):6} dBFS {alert}')
+
+        return Capture('chunked', input_channels, mic_inputs, h=deconv.h, peak=peak)
+
+
+    def record_periodic(self):
+        """ The record() flavour for the periodic excitations, MLS or multitone,
+            see get_excitation_plan(): a first period is played to get the
+            steady state, then <repeats> periods are captured and
+            synchronously averaged.
+        """
+
+        if self.mesm or self.chunked:
+            print(f'{Fmt.RED}(!) -mesm and -chunked are not available with {self.excitation}{Fmt.END}')
+            self.abort_msg = f'not available with {self.excitation}'
+            return None
+
+        plan = self.get_excitation_plan()
+        P    = plan.period
+
+        input_channels = get_avail_input_channels()
+        x = self.sig_frac * plan.signal
+        if  input_channels == 1:
+            testSignal = array([x])
+        else:
+            # Antiphased signals as in record_sweep()
+            testSignal = array([x, -x])
+
+        # The leading silence for the noise floor, the steady state period,
+        # then the captured ones
+        Nnoise = min([int(self.noise_secs * self.fs), P])
+        testSignal = concatenate( (zeros((testSignal.shape[0], Nnoise)),
+                                   tile(testSignal, self.repeats + 1)), axis=1 )
+
+        print( f'--- Starting recording ({self.excitation}, {self.repeats} periods) ...' )
+
+        tmp = self.play_rec(testSignal, input_channels, P, lead_frames=Nnoise + P)
+        if tmp is None:
+            return None
+        lead, z = tmp
+
+        print( 'Finished recording.' )
+
+        #-------------  Checking time domain SAMPLES RECORDING LEVELS -------------
+        print( "--- Checking time domain SAMPLES RECORDING LEVELS:" )
+        mic_inputs = self.get_mic_inputs(input_channels)
+        for i, ch in enumerate(mic_inputs):
+            peak  = 20 * log10( max( abs( z[:, ch] ) ) )
+            alert = 'WARNING (!)' if peak >= self.clipWarning else '           '
+            name  = 'DUT channel' if i == 0 else f'MIC#{i+1} (in {ch+1})'
+            print( f'{name} max level: {round(peak, 1):6} dBFS {alert}')
+
+        return Capture('periodic', input_channels, mic_inputs, z=z, noise=lead[:Nnoise])
+
 
     #---------------------------------------------------------------------------
-    #-------------- 4. Calculate TFs using Frequency Domain Ratios (*) ---------
-    #                   UCASE used for freq domain variables.
-    #                   All frequency variables are meant to be voltage spectra
+    # Analysis
     #---------------------------------------------------------------------------
-    lwindo = ones(N)
-    # LF pre-taper
-    lwindo[0:indexf1] = 0.5 * ( 1 - cos ( pi * arange(0,indexf1) / indexf1 ) )
-    lwindosweep = lwindo * sweep
-    # remove play-record delay by shifting computer sweep array:
-    #%sweep=circshift(sweep,-offset);            # commented out in original code
-    #lwindosweep=circshift(lwindosweep,-offset); # then replaced by this line
-    lwindosweep = roll(lwindosweep, -offset)
-
-    # FFT: from time domain (lcase) to freq domain (UCASE)
-    LWINDOSWEEP = S_dac * fft.fft(lwindosweep) * sig_frac   # sig_frac ~ atten
-    REF         = S_adc * fft.fft(ref)
-    DUT         = S_adc * fft.fft(dut)         * CF         # Calibration Factor
-
-    # The DECONVOLUTION (i.e ~ freq domain division) provides the TF of DUT
-    # (*) Above referred as 'Frequency Domain Ratios'
-    DUT_TF   = DUT / LWINDOSWEEP
-    REF_TF   = REF / LWINDOSWEEP
-
-    # The original code Logsweep1quasi.m continues finding the loudspeaker
-    # quasi-anechoic response, by using markers to windowing the recorded
-    # time domain signal.
-    # Here we don't need that, because we use the stationary in-room
-    # loudspeaker response.
-
-    # Getting a smoothed FRD (freq response data) from the measured TFs (fft)
-    DUT_FRD = fft_to_FRD(DUT_TF, smooth_Noct=Noct)
-    REF_FRD = fft_to_FRD(REF_TF, smooth_Noct=Noct)
-
-    # Converting magnitudes to dB
-    dut_freq, dut_mag = DUT_FRD
-    ref_freq, ref_mag = REF_FRD
-    DUT_FRD = (dut_freq, 20 * log10(dut_mag))
-    REF_FRD = (ref_freq, 20 * log10(ref_mag))
-
-    # Our default flat mic response has 0.0 dB values
-    if using_mic_response:
-        DUT_FRD = get_mic_corrected_response(DUT_FRD, plot_mic)
+    def get_clearance(self, capture):
+        """ The play/rec offset and the time clearance of a Capture, as
+            (offset, TimeClearanceOK, X), X being the xcorr to be plotted
+            (None if not computed).
+
+            It is computed once then kept in the capture, so that a take can
+            be quickly validated right after being recorded, and analysed later.
+        """
+
+        if capture.clearance is not None:
+            return capture.clearance
+
+        N = self.N
+        k = 1 if capture.input_channels > 1 else 0  # the REF loop if available
+
+        if capture.kind == 'chunked':
+            gen    = self.get_sweep_generator()
+            offset = int(argmax(abs(capture.h[k]))) - self.chunk_pre
+            print( f'Record offset: {offset} samples ({round(offset/float(self.fs), 3)} s)' )
+            capture.clearance = ( offset,
+                                  abs(offset) <= min([gen.Npad, self.chunk_ir_len/2 - self.chunk_pre]),
+                                  None )
+
+        elif capture.kind == 'periodic':
+            P      = self.get_excitation_plan().period
+            h      = self.get_excitation_plan().impulse(capture.z[:, k])
+            offset = int(argmax(abs(h)))
+            if offset > P / 2:
+                offset -= P                         # recorder leads player
+            print( f'Record offset: {offset} samples ({round(offset/float(self.fs), 3)} s)' )
+            capture.clearance = (offset, abs(offset) <= int(N/4.0), None)
+
+        else:
+            #---------------------------------------------------------------------------
+            #------------- 3. Determine if time clearance: -----------------------------
+            # Checks if ound card play/rec delay is lower than the zeropad silence
+            # at the signal end. Will use crosscorrelation
+            #---------------------------------------------------------------------------
+            offset = 0              # ideal record/play delay
+            TimeClearanceOK = True
+            X = None
+            if self.checkClearence:
+                dut = capture.z[:, 0]
+                if self.mesm:
+                    # no REF loop, the L sweep is found in the DUT capture itself
+                    offset, TimeClearanceOK, X = self.get_offset_xcorr(
+                                            dut=dut, ref=dut, delay=self.get_mesm_delay() )
+                else:
+                    if  capture.input_channels == 1:
+                        ref = 0.5 * self.sig_frac * self.get_sweep_plan().tapsweep
+                    else:
+                        ref = capture.z[:, 1]
+                    offset, TimeClearanceOK, X = self.get_offset_xcorr(dut=dut, ref=ref)
+                # The delayed R sweep in MESM mode reduces the ending silence
+                if self.mesm and abs(offset) > int(N/4.0) - self.get_mesm_delay():
+                    TimeClearanceOK = False
+            capture.clearance = (offset, TimeClearanceOK, X)
+
+        return capture.clearance
+
+
+    def analyse(self, capture, plot_mic=False):
+        """ Computes the results from a Capture, see do_meas() about them.
+            Returns a dictionary named as the do_meas() globals.
+        """
+
+        res = {}
+        CF  = self.get_CF()
+
+        if capture.kind == 'chunked':
+            NOISE_TFs = self.analyse_chunked(capture, CF, res)
+        elif capture.kind == 'periodic':
+            NOISE_TFs = self.analyse_periodic(capture, CF, res)
+        else:
+            NOISE_TFs = self.analyse_sweep(capture, CF, res)
+
+        res['DUT_TF'] = res['DUT_TFs'][0]
+
+        # The original code Logsweep1quasi.m continues finding the loudspeaker
+        # quasi-anechoic response, by using markers to windowing the recorded
+        # time domain signal.
+        # Here we don't need that, because we use the stationary in-room
+        # loudspeaker response.
+
+        self.set_FRDs(res, plot_mic)
+        self.set_noise_FRDs(res, NOISE_TFs)
+        self.set_IRs(res)
+        self.set_harmonics(res)
+
+        return res
+
+
+    def analyse_sweep(self, capture, CF, res):
+        """ Fills <res> with the TFs stuff from a sweep Capture, returns the
+            noise floor TFs (or None)
+        """
+
+        N         = self.N
+        plan      = self.get_sweep_plan()
+        z         = capture.z
+        mic_inputs = capture.mic_inputs
+
+        duts = z[:, mic_inputs]                     # all mics, DUT first
+        dut  = z[:, 0]
+        if  capture.input_channels == 1 or self.mesm:
+            ref = (0.5 * self.sig_frac * plan.tapsweep).transpose()
+        else:
+            ref = z[:, 1]
+
+        # Time clearance by crosscorrelation
+        offset, TimeClearanceOK, X = self.get_clearance(capture)
+
+        #---------------------------------------------------------------------------
+        #-------------- 4. Calculate TFs using Frequency Domain Ratios (*) ---------
+        #                   UCASE used for freq domain variables.
+        #                   All frequency variables are meant to be voltage spectra
+        #---------------------------------------------------------------------------
+        # The sweep spectrum comes from the prepared sweep plan, and the
+        # play-record delay is removed by a phase ramp instead of shifting the
+        # computer sweep array and transforming it again:
+        #%sweep=circshift(sweep,-offset);            # commented out in original code
+        #lwindosweep=circshift(lwindosweep,-offset); # then replaced by this line
+        # (i) Our offset is positive when the recorder lags, so the sweep is
+        #     delayed the same, i.e. the sound card latency is removed from the
+        #     deconvolved impulse response (see set_IRs).
+        INVSWEEP = plan.inverse(offset) / self.S_dac
+
+        # FFT: from time domain (lcase) to freq domain (UCASE)
+        # (i) Real input FFTs, so only the positive freqs half spectrum is computed.
+        rtype, _    = self.get_fft_dtypes()
+        # (i) All mics are transformed in a single batch, a row per mic.
+        REF         = self.S_adc * rfft(ref.astype(rtype, copy=False))
+        DUTs        = self.S_adc * rfft(duts.T.astype(rtype), axis=-1) * CF  # Calibration Factor
+
+        # The DECONVOLUTION (i.e ~ freq domain division) provides the TF of DUT
+        # (*) Above referred as 'Frequency Domain Ratios'
+        DUT_TFs  = DUTs * INVSWEEP
+        REF_TF   = REF  * INVSWEEP
+
+        # The noise floor as if it was captured along the whole N length, and
+        # averaged as the repeated sweeps are, then 'deconvolved' the same.
+        Nnoise = capture.noise.shape[0]
+        if Nnoise:
+            NOISEs    = self.S_adc * rfft(capture.noise[:, mic_inputs].T.astype(rtype),
+                                          n=N, axis=-1) * CF
+            NOISE_TFs = NOISEs * sqrt(N / Nnoise / self.repeats) * INVSWEEP
+        else:
+            NOISE_TFs = None
+
+        # MESM, separating L and R from every mic TF
+        mic_labels = ['DUT'] + [f'MIC#{i+2}' for i in range(len(mic_inputs) - 1)]
+        if self.mesm:
+            DUT_TFs    = self.separate_mesm(DUT_TFs)
+            DUT_labels = [f'{m} {ch}' for m in mic_labels for ch in ('L', 'R')]
+            # the same mic noise for both channels
+            if NOISE_TFs is not None:
+                NOISE_TFs = repeat(NOISE_TFs, 2, axis=0)
+        else:
+            DUT_labels = mic_labels
+
+        res.update( dut=dut, ref=ref, X=X, TimeClearanceOK=TimeClearanceOK,
+                    DUT_TFs=DUT_TFs, REF_TF=REF_TF, DUT_labels=DUT_labels )
+
+        return NOISE_TFs
+
+
+    def analyse_chunked(self, capture, CF, res):
+        """ Fills <res> with the TFs stuff from a chunked Capture.
+            The time domain <dut> and <ref> waveforms are not kept (None).
+            The TFs have <chunk_ir_len>/2 + 1 bins.
+        """
+
+        gen        = self.get_sweep_generator()
+        mic_inputs = capture.mic_inputs
+
+        # Deconvolved impulse responses, normalized as per analyse_sweep() TFs
+        h = capture.h * self.S_adc / (self.sig_frac * gen.gain * self.S_dac)
+
+        #------------- Time clearance from the impulse response arrival -----------
+        offset, TimeClearanceOK, _ = self.get_clearance(capture)
+
+        #------------- TFs ---------------------------------------------------------
+        # (i) The sound card latency is removed as in analyse_sweep()
+        H = rfft(roll(h, -(self.chunk_pre + offset), axis=-1), axis=-1)
+        DUT_TFs    = H[mic_inputs] * CF
+        DUT_labels = ['DUT'] + [f'MIC#{i+2}' for i in range(len(mic_inputs) - 1)]
+        if capture.input_channels > 1:
+            REF_TF = H[1]
+        else:
+            REF_TF = full(H.shape[-1], 0.5)         # as the analyse_sweep() dummy ref
+
+        res.update( dut=None, ref=None, X=None, TimeClearanceOK=TimeClearanceOK,
+                    DUT_TFs=DUT_TFs, REF_TF=REF_TF, DUT_labels=DUT_labels )
+
+        return None
+
+
+    def analyse_periodic(self, capture, CF, res):
+        """ Fills <res> with the TFs stuff from a periodic Capture:
+
+            The averaged period is deconvolved into a periodic impulse
+            response, the MLS one by a fast Walsh-Hadamard transform.
+            <dut> and <ref> are the averaged captured period. There is no
+            xcorr (X is None), the time clearance is checked from the impulse
+            response arrival, and the room decay must fit in a period.
+        """
+
+        N          = self.N
+        plan       = self.get_excitation_plan()
+        P          = plan.period
+        z          = capture.z
+        mic_inputs = capture.mic_inputs
+        scale      = self.S_adc / (self.sig_frac * self.S_dac)
+
+        dut = z[:, 0]
+        if  capture.input_channels == 1:
+            ref = 0.5 * self.sig_frac * plan.signal # as the analyse_sweep() dummy ref
+        else:
+            ref = z[:, 1]
+
+        # Periodic impulse responses, normalized as per analyse_sweep() TFs
+        rtype, _ = self.get_fft_dtypes()
+        h = plan.impulse(z.T.astype(rtype)) * scale
+
+        #------------- Time clearance from the impulse response arrival -----------
+        offset, TimeClearanceOK, _ = self.get_clearance(capture)
+
+        #------------- TFs ---------------------------------------------------------
+        # (i) The sound card latency is removed as in analyse_sweep()
+        H = rfft(roll(h, -offset, axis=-1), n=N, axis=-1)
+        DUT_TFs    = H[mic_inputs] * CF
+        DUT_labels = ['DUT'] + [f'MIC#{i+2}' for i in range(len(mic_inputs) - 1)]
+        if capture.input_channels > 1:
+            REF_TF = H[1]
+        else:
+            REF_TF = full(H.shape[-1], 0.5)
+
+        # The noise floor through the same deconvolution, as if it was a whole
+        # period, and averaged as the captured periods are.
+        Nnoise = capture.noise.shape[0]
+        if Nnoise:
+            n = zeros((len(mic_inputs), P), dtype=rtype)
+            n[:, :Nnoise] = capture.noise[:, mic_inputs].T
+            NOISE_TFs = rfft(plan.impulse(n), n=N, axis=-1) * CF * scale \
+                        * sqrt(P / Nnoise / self.repeats)
+        else:
+            NOISE_TFs = None
+
+        res.update( dut=dut, ref=ref, X=None, TimeClearanceOK=TimeClearanceOK,
+                    DUT_TFs=DUT_TFs, REF_TF=REF_TF, DUT_labels=DUT_labels )
+
+        return NOISE_TFs
+
+
+    def separate_mesm(self, TFs):
+        """ Splits every row from a stack of MESM deconvolved TFs into
+            its L and R TFs, so returning a stack twice as high:
+            [mic1_L, mic1_R, mic2_L, mic2_R, ...]
+
+            The exponential sweep maps every sweep delay into the same delay in
+            the deconvolved impulse response, so the R response arrives D samples
+            after the L one, and both are separated by time windowing the IR.
+            The R harmonics arrive before the R response, so the L window ends
+            before the highest order one, see get_mesm_delay().
+        """
+
+        N   = self.N
+        D   = self.get_mesm_delay()
+        W   = D - self.get_mesm_lead()              # L and R windows length
+        pre = int(self.mesm_pre_ms / 1000 * self.fs)
+
+        # Fade in along the pre-arrival margin, and fade out the last 1/8
+        fade_out = int(W / 8)
+        window = ones(W)
+        window[:pre]       = 0.5 * (1 - cos(pi * arange(pre) / pre))
+        window[-fade_out:] = 0.5 * (1 + cos(pi * arange(fade_out) / fade_out))
+
+        h = irfft(TFs, n=N, axis=-1)
+
+        result = []
+        for ir in h:
+
+            # The L arrival, then the R one is expected D samples later
+            e = abs(ir)
+            a = argmax(e + roll(e, -D))
+
+            for start in (a - pre, a + D - pre):
+                segment = take(ir, arange(start, start + W), mode='wrap') * window
+                result.append( rfft(segment, n=N) )
+
+        return array(result)
+
+
+    def get_offset_xcorr(self, dut, ref, sweep=None, delay=0):
+        """
+        Determines CLEARANCE based on the offset found between recorded and played signals.
+        The offset is estimated by using crosscorrelation within them.
+
+        If <delay> is given, <ref> also has a copy of the sweep delayed by it
+        (the MESM R sweep), so the offset is the one of the earlier sweep.
+
+        If the offset exceeds the ending silence (Npad zeros), then information will be lost
+        and CLEARANCE warning appears.
+
+        The crosscorrelation is computed coarse to fine:
+
+            - coarse: from the low band only (below fs / 2 / xcorr_dec) of the
+              cached sweep plan spectrum and the captured one, so that a short
+              irfft renders the correlation decimated by <xcorr_dec>.
+
+            - fine: full rate correlation just at the lags around the coarse peak.
+
+        returns: offset, TimeClearanceOK, X (the decimated xcorr for plotting)
+
+        """
+
+        N    = self.N
+        plan = self.get_sweep_plan()
+        if sweep is None:
+            sweep = plan.sweep
+
+        ### Matlab code:
+        # lags = N/2                    % large enough to catch most delays
+        #                                 (!) no usable en Numpy.correlate
+        ## if max(ref) < 0.1*max(dut)   % automatic reference selection
+        ##    X=xcorr(sweep,dut,lags);  % in case reference is low, use data itself
+        ##else
+        ##    X=xcorr(sweep,ref,lags);  % this uses recorded reference
+        ##end
+        ## [~,nmax]=max(abs(X));
+
+        # Correlate with an automatic reference selection:
+        # (i) For offset estimation, it is preferred to take an undisturbed signal.
+        #     The mic captured signal maybe too noisy to be able to be correlated.
+        #     If not enough signal in ref channel, will use the mic channel instead.
+
+        myref = ref
+        if max(ref) < 0.1 * max(dut):  # but if no signal on ref, use data itself
+            myref = dut
+            print('(!) Bad level on REF ch, using DUT ch itself to estimate clearance')
+
+        print( '--- Determining record/play delay using crosscorrelation' )
+
+        timestamp = time()
+
+        ### (i) scipy.signal.correlate doesn't use the parameter 'lags' as in Matlab,
+        #       and the full N x N correlation was too slow to be done at every take.
+
+        # Coarse: circular correlation from the low band of the spectrums,
+        # c[k] = sum(sweep[m] * myref[m + k]), so its peak is found at k = offset
+        D       = self.xcorr_dec
+        M       = int(N / D)
+        MYREF   = rfft(myref[:N])
+        C       = conj(plan.LWINDOSWEEP[:int(M/2) + 1]) * MYREF[:int(M/2) + 1]
+        c       = irfft(C, n=M) / D
+
+        # (i) Matlab's max(abs(X)), the REF loop could be phase inverted
+        #     If a delayed sweep copy is expected, both peaks are looked for.
+        e = abs(c)
+        k = argmax(e + roll(e, -int(round(delay / D))))
+        if k > M / 2:
+            k -= M
+
+        # Fine: full rate correlation around the coarse peak
+        lags = arange(k * D - D, k * D + D + 1)
+        fine = [ dot(sweep[:N-lag], myref[lag:N]) if lag >= 0 else
+                 dot(sweep[-lag:N], myref[:N+lag])
+                 for lag in lags ]
+        offset = int( lags[argmax(abs(array(fine)))] )
+
+        # The decimated correlation to be plotted, in the former 'same' layout,
+        # i.e. the lag decreasing along the array, with zero lag at the middle.
+        X = c[ (int(M/2) - arange(M)) % M ]
+
+        print( "Computed in " + str( round(time() - timestamp, 1) ) + " s" )
+
+        print( 'Record offset: ' +  str(offset) + ' samples' + \
+              ' (' +  str( round( offset/float(self.fs), 3) ) + ' s)' )
+        if offset < 0:
+            print( '(i) Negative offset means player lags recorder!' )
+
+        Npad=int(N/4.0)
+        if abs(offset) > Npad:
+            TimeClearanceOK = False
+        else:
+            TimeClearanceOK = True
+
+        return offset, TimeClearanceOK, X
+
+
+    def fft_to_FRD(self, semiFFT, smooth_Noct=0):
+        """ semiFFT: the positive freqs half spectrum (N/2 + 1 bins) from rfft,
+                     or a stack of them (e.g. multimic) that renders a list of FRDs
+
+            The logspaced and smoothed FRD is a single sparse matrix product,
+            see get_FRD_operator()
+        """
+
+        # (i) The FFT length is not always N, e.g. in chunked mode
+        n = 2 * (semiFFT.shape[-1] - 1)
+
+        f, M = get_FRD_operator(n, self.fs, self.FRDpoints, smooth_Noct)
+
+        # Taking the magnitude
+        mag = abs( semiFFT )
+
+        # A stack of spectrums (e.g. multimic) will render a list of FRDs
+        if mag.ndim > 1:
+            return [(f, x) for x in (M @ mag.T).T]
+
+        return (f, M @ mag)
+
+
+    def get_mic_corrected_response(self, raw_frd, doplot=False, quiet=False):
+
+        # extract freq and mag arrays from the given `xfrd` tuple
+        raw_freq, raw_db = raw_frd
+
+        # extract freq and mag arrays from the `mic_response` 2D array
+        mic_freq = self.mic_response[:, 0]
+        mic_db   = self.mic_response[:, 1]
+
+        # Interpolate mic response to the given raw_freq points.
+        # preferred to interpolate over the logarithm of the frequency.
+        mic_db_interp = interp(log10(raw_freq), log10(mic_freq), mic_db)
+
+        # Finally, correct the given frd with the mic_frd
+        corrected_db = raw_db - mic_db_interp
+
+        if not quiet:
+            print(f'{Fmt.GREEN}MIC correction was applied.{Fmt.END}')
+
+        if doplot:
+            plot_mic_compensation(raw_freq, mic_db_interp, raw_db, corrected_db)
+
+        return raw_freq, corrected_db
+
+
+    def set_FRDs(self, res, plot_mic=False):
+        """ Renders DUT_FRDs, DUT_FRD and REF_FRD from the DUT_TFs and REF_TF
+        """
+
+        # Getting a smoothed FRD (freq response data) from the measured TFs (fft)
+        DUT_FRDs = self.fft_to_FRD(res['DUT_TFs'], smooth_Noct=self.Noct)
+        REF_FRD  = self.fft_to_FRD(res['REF_TF'],  smooth_Noct=self.Noct)
+
+        # Converting magnitudes to dB
+        DUT_FRDs = [(f, 20 * log10(mag)) for f, mag in DUT_FRDs]
+        ref_freq, ref_mag = REF_FRD
+        REF_FRD = (ref_freq, 20 * log10(ref_mag))
+
+        # Our default flat mic response has 0.0 dB values
+        if self.using_mic_response:
+            DUT_FRDs = [self.get_mic_corrected_response(frd, plot_mic and i == 0)
+                        for i, frd in enumerate(DUT_FRDs)]
+        else:
+            print(f'{Fmt.GRAY}(do_meas) * NO * MIC correction{Fmt.END}')
+
+        res.update( DUT_FRDs=DUT_FRDs, DUT_FRD=DUT_FRDs[0], REF_FRD=REF_FRD )
+
+
+    def set_noise_FRDs(self, res, NOISE_TFs):
+        """ From the deconvolved leading silence, a row per DUT_TFs item:
+
+                NOISE_FRDs  The noise floor (f, dB), rendered as the DUT_FRDs are,
+                            through the same cached reduction operator.
+                SNR_FRDs    (f, dB) S/N ratio by freq, DUT_FRDs minus NOISE_FRDs
+
+            and the first DUT item ones: NOISE_FRD, SNR_FRD (None if not available)
+        """
+
+        DUT_FRDs = res['DUT_FRDs']
+
+        if NOISE_TFs is None:
+            res.update( NOISE_FRDs=[None] * len(DUT_FRDs), SNR_FRDs=[None] * len(DUT_FRDs),
+                        NOISE_FRD=None, SNR_FRD=None )
+            return
+
+        NOISE_FRDs = self.fft_to_FRD(NOISE_TFs, smooth_Noct=self.Noct)
+        with errstate(divide='ignore'):
+            NOISE_FRDs = [(f, 20 * log10(mag)) for f, mag in NOISE_FRDs]
+
+        # (i) the noise floor gets the same mic correction as the DUT_FRDs,
+        #     so the S/N ratio does not depend on it
+        if self.using_mic_response:
+            NOISE_FRDs = [self.get_mic_corrected_response(frd, quiet=True)
+                          for frd in NOISE_FRDs]
+
+        SNR_FRDs = [(f, mag - nmag) for (f, mag), (_, nmag) in zip(DUT_FRDs, NOISE_FRDs)]
+
+        res.update( NOISE_FRDs=NOISE_FRDs, SNR_FRDs=SNR_FRDs,
+                    NOISE_FRD=NOISE_FRDs[0], SNR_FRD=SNR_FRDs[0] )
+
+        f, snr = SNR_FRDs[0]
+        band = (f > 20) & (f < 20000)
+        print( f'--- DUT S/N ratio 20 Hz ~ 20 KHz: min {round(snr[band].min(), 1)} dB, '
+               f'median {round(median(snr[band]), 1)} dB' )
+
+
+    def gated_FRD(self, ir, arrival, freqs):
+        """ The gated magnitude (dB) of <ir> at the given <freqs>, as per
+            the <gate_ms> or <fdw_cycles> settings.
+            The DTFT is evaluated only at the wanted freqs, so no FFT is needed,
+            and the freq dependent window can have its own length at every freq.
+        """
+
+        fs    = self.fs
+        pre   = max([1, int(self.gate_pre_ms / 1e3 * fs)])
+        w     = 2 * pi * freqs / fs
+
+        if self.fdw_cycles:
+            # the window length at every freq, up to the half IR
+            posts = clip( (self.fdw_cycles * fs / freqs).astype(int), 1, int(ir.size / 2) )
+            H = zeros(freqs.size, dtype=complex128)
+            for i, post in enumerate(posts):
+                n = arange(-pre, post)
+                seg = take(ir, arrival + n, mode='wrap') * gate_window(pre, post)
+                H[i] = dot(seg, exp(-1j * w[i] * n))
+
+        else:
+            post = max([1, int(self.gate_ms / 1e3 * fs)])
+            n = arange(-pre, post)
+            seg = take(ir, arrival + n, mode='wrap') * gate_window(pre, post)
+            H = exp(-1j * outer(w, n)) @ seg
+
+        with errstate(divide='ignore'):
+            return 20 * log10(abs(H))
+
+
+    def set_IRs(self, res):
+        """ The impulse response stage, from the same DUT_TFs spectrums:
+
+            A single complex IFFT of the analytic (one sided) spectrum renders
+            both the IR (real part) and its envelope (abs), so:
+
+                DUT_IRs         impulse responses, a row per DUT_TFs item
+                DUT_ETCs        energy time curves (dB, 0 dB at the peak)
+                DUT_arrivals    main arrival (envelope peak) sample index
+                DUT_delays      arrival delays (s), negative if wrapped at the end
+                DUT_GATED_FRDs  gated (f, dB) if <gate_ms> or <fdw_cycles>,
+                                over the same freq points as DUT_FRDs
+
+            and the first DUT item ones: DUT_IR, DUT_ETC, DUT_arrival, DUT_delay
+            and DUT_GATED_FRD (None if not gated).
+        """
+
+        DUT_TFs = res['DUT_TFs']
+        nbins   = DUT_TFs.shape[-1]
+        n       = 2 * (nbins - 1)
+
+        # analytic signal spectrum: DC and Nyquist once, positive freqs twice
+        Z = zeros((DUT_TFs.shape[0], n), dtype=DUT_TFs.dtype)
+        Z[:, 0]         = DUT_TFs[:, 0]
+        Z[:, 1:nbins-1] = 2 * DUT_TFs[:, 1:nbins-1]
+        Z[:, nbins-1]   = DUT_TFs[:, nbins-1]
+        z = ifft(Z, axis=-1)
+
+        DUT_IRs   = z.real
+        envelope  = abs(z)
+
+        DUT_arrivals = argmax(envelope, axis=-1)
+        DUT_delays   = where(DUT_arrivals < n / 2, DUT_arrivals, DUT_arrivals - n) / float(self.fs)
+
+        with errstate(divide='ignore'):
+            DUT_ETCs = 20 * log10( envelope / envelope.max(axis=-1, keepdims=True) )
+
+        DUT_GATED_FRDs = [None] * len(DUT_IRs)
+        if self.gate_ms or self.fdw_cycles:
+            freqs = res['DUT_FRDs'][0][0]
+            for i, (ir, arrival) in enumerate(zip(DUT_IRs, DUT_arrivals)):
+                frd = (freqs, self.gated_FRD(ir, arrival, freqs))
+                if self.using_mic_response:
+                    frd = self.get_mic_corrected_response(frd)
+                DUT_GATED_FRDs[i] = frd
+
+        res.update( DUT_IRs=DUT_IRs, DUT_ETCs=DUT_ETCs, DUT_arrivals=DUT_arrivals,
+                    DUT_delays=DUT_delays, DUT_GATED_FRDs=DUT_GATED_FRDs,
+                    DUT_IR=DUT_IRs[0], DUT_ETC=DUT_ETCs[0], DUT_arrival=DUT_arrivals[0],
+                    DUT_delay=DUT_delays[0], DUT_GATED_FRD=DUT_GATED_FRDs[0] )
+
+        print( f'--- DUT main arrival delay: {round(DUT_delays[0] * 1e3, 2)} ms' )
+
+
+    def set_harmonics(self, res):
+        """ Harmonic distortion from the same DUT_IR:
+
+            The exponential sweep deconvolution places the impulse response of
+            the k order harmonic Ls*ln(k) seconds before the linear one, Ls being
+            the time for the sweep freq to increase by a factor e, so they are
+            windowed out from the (circular) DUT_IR, each one up to the next one.
+
+            The k harmonic response at k*f is the distortion produced by the
+            fundamental f, so these are given over the DUT_FRD freq points:
+
+                HD_FRDs     {k: (f, dB)}    |Hk(k*f)|, k = 2...<harmonics>
+                THD_FRD     (f, dB)         sqrt( sum( |Hk(k*f)|^2 ) ) / |H1(f)|
+
+            H1 is windowed out as the H2 one, having the same length, so the
+            THD ratio compares unsmoothed and mic corrected levels alike.
+
+            (i) Not available in chunked or MESM modes, the IR does not include
+                the harmonics there, neither with periodic excitations.
+        """
+
+        res.update( HD_FRDs={}, THD_FRD=None )
+
+        harmonics = self.harmonics
+        if harmonics < 2 or self.chunked or self.mesm or self.excitation != 'sweep':
+            return
+
+        fs       = self.fs
+        DUT_IR   = res['DUT_IR']
+        f        = res['DUT_FRD'][0]
+        Ls       = self.get_sweep_plan().Ls * fs    # in samples
+        n        = arange(harmonics + 1)
+        arrivals = res['DUT_arrival'] - around(Ls * log(clip(n, 1, None))).astype(int)
+
+        # fades: 1/10 of the shortest spacing, the one between the two last ones
+        p = max([1, int(0.1 * Ls * log((harmonics + 1) / harmonics))])
+
+        power   = zeros(f.size)
+        HD_FRDs = res['HD_FRDs']
+
+        for k in range(1, harmonics + 1):
+
+            # from the k order arrival up to the k-1 order one
+            # (the linear one as long as the 2nd order one)
+            start  = arrivals[k] - p
+            length = arrivals[max([k-1, 1])] - arrivals[max([k, 2])]
+            window = ones(length)
+            window[:p]  = 0.5 * (1 - cos(pi * arange(p) / p))
+            window[-p:] = 0.5 * (1 + cos(pi * arange(p) / p))
+            seg = take(DUT_IR, arange(start, start + length), mode='wrap') * window
+
+            # the segment half spectrum, zero padded for a smooth interpolation
+            nfft = 2**int(ceil(log2(4 * length)))
+            mag  = interp(k * f, rfftfreq(nfft, d=1.0/fs), abs(rfft(seg, n=nfft)),
+                          right=nan)
+
+            with errstate(divide='ignore'):
+                mag_dB = 20 * log10(mag)
+            if self.using_mic_response:
+                mag_dB -= interp(log10(k * f), log10(self.mic_response[:, 0]),
+                                 self.mic_response[:, 1])
+
+            if k == 1:
+                H1_dB = mag_dB
+                continue
+            HD_FRDs[k] = (f, mag_dB)
+            power += nan_to_num(10**(mag_dB / 10))
+
+        # (i) THD is given up to the fundamental having its H2 below Nyquist
+        with errstate(divide='ignore', invalid='ignore'):
+            THD_FRD = (f, where(2 * f < fs / 2, 10 * log10(power) - H1_dB, nan))
+            i1k = argmin(abs(f - 1000))
+            print( f'--- THD (H2...H{harmonics}) at 1 KHz: '
+                   f'{round(100 * 10**(THD_FRD[1][i1k] / 20), 3)} %' )
+
+        res['THD_FRD'] = THD_FRD
+
+
+def get_mesm_delay():
+    """ The delay in samples of the R sweep when using MESM
+    """
+    return SweepSession().get_mesm_delay()
+
+
+def separate_mesm(TFs):
+    """ see SweepSession.separate_mesm()
+    """
+    return SweepSession().separate_mesm(TFs)
+
+
+def get_offset_xcorr(sweep, dut, ref):
+    """ see SweepSession.get_offset_xcorr()
+        returns: offset, TimeClearanceOK
+    """
+
+    global X  # global scoped for plotting later
+
+    offset, TimeClearanceOK, X = SweepSession().get_offset_xcorr(dut, ref, sweep)
+
+    return offset, TimeClearanceOK
+
+
+def probe_sweep_length():
+    """ Chooses the shortest N = 2^e that meets the <target_snr> and the
+        time clearance, from a quick probe: a silence then a short
+        2^probe_e sweep, both played in a single stream.
+
+        - The S/N of the probe comes from the deconvolved sweep vs the
+          deconvolved silence, by 1/3 oct power bands, the 10th percentile
+          between 20 Hz and 20 KHz. The longer the sweep the better the S/N,
+          +3 dB per doubling N.
+
+        - The play/rec latency comes from get_offset_xcorr().
+
+        - The room decay rate (dB/s) is fitted on the probe energy time curve,
+          so the tail needs target_snr / rate seconds to fade out, and the
+          latency plus this tail have to fit in the Npad ending silence.
+          In MESM mode the tail is the <mesm_decay>, and the latency plus
+          the R sweep delay have to fit there instead.
+
+        Returns the chosen e (N is set accordingly), or None if failed.
+    """
+
+    global N, mesm_decay
+
+    print( '--- Probing noise and room decay to choose the sweep length ...' )
+
+    session = SweepSession(N=2**probe_e)
+    plan    = session.get_sweep_plan()
+    Np      = session.N
+
+    input_channels = get_avail_input_channels()
+    x = sig_frac * plan.tapsweep
+    channels = [x] if input_channels == 1 else [x, -x]
+
+    # A silence having the probe length, then the probe sweep
+    tmp = session.play_rec( concatenate( (zeros((len(channels), Np)), array(channels)),
+                                         axis=1 ),
+                            input_channels, Np, lead_frames=Np )
+    if tmp is None:
+        print(f'{Fmt.RED}(!) Probe ABORTED: {session.abort_msg}{Fmt.END}')
+        return None
+    lead, z = tmp
+
+    noise = lead[:, 0]
+    dut   = z[:, 0]
+    ref   = z[:, 1] if input_channels > 1 else x
+
+    offset, _, _ = session.get_offset_xcorr(dut=dut, ref=ref)
+
+    # Deconvolving both the sweep and the silence
+    INVSWEEP = plan.inverse(offset)
+    DUT      = rfft(dut)   * INVSWEEP
+    NOISE    = rfft(noise) * INVSWEEP
+
+    # S/N by 1/3 oct power bands
+    f, M = get_FRD_operator(Np, fs, FRDpoints, 3)
+    with errstate(divide='ignore'):
+        snr = 10 * log10( (M @ abs(DUT)**2) / (M @ abs(NOISE)**2) )
+    probe_snr = percentile( snr[(f > 20) & (f < 20000)], 10 )
+
+    # Room decay rate, from the Schroeder backward integrated energy,
+    # once the noise floor power is subtracted, from -5 dB down to -25 dB
+    # (i.e. as T20). If the probe is too short to see such a decay, its
+    # level at the end gives a conservative (slower) rate.
+    h     = irfft(DUT, n=Np)
+    peak  = argmax(abs(h))
+    e     = take(h, arange(peak, peak + int(Np/2)), mode='wrap')**2
+    e     = clip(e - mean(e[-int(e.size / 8):]), 0, None)
+    with errstate(divide='ignore'):
+        edc = 10 * log10( cumsum(e[::-1])[::-1] / e.sum() )
+    t5    = argmax(edc < -5)                        # first crossings
+    t25   = argmax(edc < -25)
+    if t25 > t5:
+        rate = 20 / ((t25 - t5) / float(fs))
+    else:
+        tend = int(0.75 * e.size)
+        rate = -edc[tend] / (tend / float(fs))
+    tail = target_snr / rate if rate > 0 else Np / float(fs)
+
+    print( f'    probe S/N: {round(probe_snr, 1)} dB,  latency: {offset} samples,  '
+           f'decay: {round(rate, 1)} dB/s (tail {round(tail, 2)} s)' )
+
+    if mesm:
+        mesm_decay = tail
+
+    # The shortest N meeting both S/N and clearance
+    for e in range(probe_e, max_e + 1):
+        snr_ok   = probe_snr + 10 * log10(2**(e - probe_e)) >= target_snr
+        if mesm:
+            D = SweepSession(N=2**e).get_mesm_min_delay()
+            clear_ok = 2**e / 4 > abs(offset) + D
+        else:
+            clear_ok = 2**e / 4 >= abs(offset) + tail * fs
+        if snr_ok and clear_ok:
+            break
     else:
-        print(f'{Fmt.GRAY}(do_meas) * NO * MIC correction{Fmt.END}')
+        print( f'{Fmt.RED}(!) S/N {target_snr} dB or clearance not reachable, '
+               f'using the max length 2^{max_e}{Fmt.END}' )
 
-    # ** END **
-    # (i) The results are available in the global scope variables referenced above.
+    N = 2**e
+    print( f'{Fmt.BOLD}--- Chosen sweep length: 2^{e} ({round(N / fs, 1)} s){Fmt.END}' )
+
+    return e
+
+
+def do_meas(plot_mic=False):
+    """
+    Compute globals about DUT Device-Under-Test and REFerence measurements.
+
+        dut,    ref             Time domain captured waveforms
+
+        DUT_TF, REF_TF          Freq domain Transfer Functions, as half
+                                spectrums (N/2 + 1 bins) from real FFTs.
 
+        DUT_FRD, REF_FRD        Freq Response Data rendered over the configured
+                                <FRDpoints> frequency logspaced points.
+                                These are given as tuples (freq, mag)
+
+        DUT_TFs, DUT_FRDs       The same as above for every mic input, as a
+                                stack of TFs and a list of FRDs.
+                                (first ones are DUT_TF, DUT_FRD)
+                                In MESM mode, every mic renders an L and an R
+                                item: [mic1_L, mic1_R, mic2_L, mic2_R, ...]
+
+        DUT_labels              A label for every item in DUT_FRDs
+
+        NOISE_FRD(s), SNR_FRD(s)  Noise floor and S/N ratio, see SweepSession.set_noise_FRDs()
+
+        DUT_IR, DUT_ETC, ...    Impulse response stuff, see SweepSession.set_IRs()
+
+        HD_FRDs, THD_FRD        Harmonic distortion, see SweepSession.set_harmonics()
+
+        TimeClearanceOK         Boolean about the detected time clearance
+
+        X                       The time clearance xcorr (None if not computed)
+
+    All of them are computed by a SweepSession having the current module
+    parameters, then published here.
+
+    Returns False if the measurement was aborted, see <meas_abort_msg>.
+    """
 
+    global meas_abort_msg
+
+    # The sweep must have been prepared as per the current parameters
+    if excitation == 'sweep' and not chunked and \
+       (not sweep_plan or sweep_plan.key != get_sweep_key()):
+        prepare_sweep()
+
+    session = SweepSession()
+
+    capture = session.record()
+    meas_abort_msg = session.abort_msg
+    if capture is None:
+        return False
+
+    globals().update( session.analyse(capture, plot_mic) )
+
+    # ** END **
+    # (i) The results are available in the global scope variables referenced above.
+    return True
 #-------------------------------------------------------------------------------
 #--------------------------------- MAIN PROGRAM --------------------------------
 #-------------------------------------------------------------------------------
@@ -818,6 +2679,9 @@ if __name__ == "__main__":
         elif "-noclear" in opc.lower():
             checkClearence = False
 
+        elif "-single" in opc.lower():
+            precision = 'single'
+
         elif opc.lower() == "-sc":
             select_card = True
 
@@ -831,6 +2695,9 @@ if __name__ == "__main__":
                 print( __doc__ )
                 sys.exit()
 
+        elif "-eauto" in opc.lower():
+            auto_length = True
+
         elif "-e" in opc:
             N = 2**int(opc[2:])
 
@@ -840,6 +2707,42 @@ if __name__ == "__main__":
         elif "-aux" in opc.lower():
             aux_plot = True
 
+        elif "-blocking" in opc.lower():
+            use_stream = False
+
+        elif "-noabort" in opc.lower():
+            abortOnClip = False
+
+        elif "-repeats=" in opc.lower():
+            repeats = int(opc.split("=")[1])
+
+        elif "-multimic" in opc.lower():
+            multimic = True
+
+        elif "-mesm" in opc.lower():
+            mesm = True
+
+        elif "-chunked" in opc.lower():
+            chunked = True
+
+        elif "-mls" in opc.lower():
+            excitation = 'mls'
+
+        elif "-multitone" in opc.lower():
+            excitation = 'multitone'
+
+        elif "-gate=" in opc.lower():
+            gate_ms = float(opc.split("=")[1])
+
+        elif "-fdw=" in opc.lower():
+            fdw_cycles = float(opc.split("=")[1])
+
+        elif "-noise=" in opc.lower():
+            noise_secs = float(opc.split("=")[1])
+
+        elif "-thd=" in opc.lower():
+            harmonics = int(opc.split("=")[1])
+
         else:
             bad_options += opc + ' '
             opcs_OK = False
@@ -873,15 +2776,31 @@ if __name__ == "__main__":
     if printInfo:
         do_print_info()
 
+    # Choosing the sweep length
+    if auto_length and probe_sweep_length() is None:
+        sys.exit()
+
+    # The MESM R sweep delay has to fit in the sweep length
+    if mesm:
+        try:
+            get_mesm_delay()
+        except ValueError as e:
+            print(f'{Fmt.RED}(!) {e}{Fmt.END}')
+            sys.exit()
+
     # Do create the needed raw and tapered sweeps
-    prepare_sweep()
+    # (i) The chunked mode renders them on the fly, and the periodic
+    #     excitations have their own plan, see get_excitation_plan()
+    if not chunked and excitation == 'sweep':
+        prepare_sweep()
 
     # Prepare MIC response if a given mic response file
     if mic_response_path:
         set_mic_response()
 
     # MEASURE
-    do_meas(plot_mic=True)
+    if not do_meas(plot_mic=True):
+        sys.exit()
 
     # Checking TIME CLEARANCE
     if not TimeClearanceOK:
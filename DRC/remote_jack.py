@@ -37,12 +37,14 @@ try:
     with open(__file__.replace('.py', '.yml'), 'r') as f:
         CFG = yaml.safe_load(f.read())
     in_port = CFG['in']
+    in_R    = CFG.get('in_R', 'system:capture_2')
     lspk_L  = CFG['lspk_L']
     lspk_R  = CFG['lspk_R']
 
 except:
     print(f'(remote_jack) ERROR reading \'remote_jack.yml\' config file')
     in_port = 'system:capture_1'
+    in_R    = 'system:capture_2'
     lspk_L  = 'brutefir:in.L'
     lspk_R  = 'brutefir:in.R'
 
@@ -79,13 +81,14 @@ class Remote(object):
 
 
     def select_channel(self, ch=''):
-        """ selects the destination channel for system:capture_1 (LEFT ANALOG IN)
+        """ selects the destination channel for the <in_port> (LEFT ANALOG IN),
+            'LR' routes also the <in_R> one (RIGHT ANALOG IN) to the R loudspeaker
         """
         # disconnect all
-        self._run(f'jack_disconnect system:capture_1 {lspk_L}')
-        self._run(f'jack_disconnect system:capture_1 {lspk_R}')
-        self._run(f'jack_disconnect system:capture_2 {lspk_L}')
-        self._run(f'jack_disconnect system:capture_2 {lspk_R}')
+        self._run(f'jack_disconnect {in_port} {lspk_L}')
+        self._run(f'jack_disconnect {in_port} {lspk_R}')
+        self._run(f'jack_disconnect {in_R} {lspk_L}')
+        self._run(f'jack_disconnect {in_R} {lspk_R}')
         # connect to channel
         if ch.upper() == 'L':
             self._run(f'jack_connect {in_port} {lspk_L}')
@@ -93,6 +96,12 @@ class Remote(object):
         elif ch.upper() == 'R':
             self._run(f'jack_connect {in_port} {lspk_R}')
             print(f'(remote_jack) connecting analog {in_port} ----> {lspk_R}')
+        # both at once (multiple exponential sweep method)
+        elif ch.upper() == 'LR':
+            self._run(f'jack_connect {in_port} {lspk_L}')
+            self._run(f'jack_connect {in_R} {lspk_R}')
+            print(f'(remote_jack) connecting analog {in_port} ----> {lspk_L}')
+            print(f'(remote_jack) connecting analog {in_R} ----> {lspk_R}')
         return
 
 
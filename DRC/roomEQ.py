@@ -29,8 +29,14 @@
 
             -fs=        Output FIR sampling freq (default 48000 Hz)
 
-            -e=         Exponent 2^XX for FIR length in taps.
+            -e=         Exponent 2^XX for FIR length in taps, 12...20
                         (default 15, i.e. 2^15=32 Ktaps)
+                        (i) FIRs longer than 64 Ktaps are synthesized by a
+                            bounded memory FFT path, see bench_FIRsynth.py
+
+                        Several comma separated values can be given to -fs and -e,
+                        e.g. -fs=44100,48000,96000 -e=14,15,16 then every fs and
+                        length variant will be computed, each one to its own folder.
 
             -ref=       Reference level in dB (default autodetected)
 
@@ -57,6 +63,16 @@
 
             -noPos      Does not allow positive gains at all
 
+            -noplot     Headless, no graphs at all (pyplot is not even loaded),
+                        the curves are saved to 'roomEQ_drc.npz' instead.
+
+            -plot=file  Renders the graphs from a saved 'roomEQ_drc.npz'
+
+            -nocache    Does not use the cache of target and EQ curves.
+                        (they are kept in ~/.cache/roomEQ, so changing only
+                         the FIR length, fs or format does not smooth again,
+                         the last 200 used ones are kept)
+
 
 
     ABOUT POSITIVE EQ GAIN:
@@ -91,17 +107,20 @@
 """
 import os
 import sys
+import json
+import hashlib
 import numpy as np
 from scipy import signal
+from scipy.fft import rfft, irfft, next_fast_len
+from concurrent.futures import ProcessPoolExecutor
 
 # https://matplotlib.org/faq/howto_faq.html#working-with-threads
-import matplotlib
-# Later we will be able to call matplotlib.use('Agg') to replace the regular
-# display backend (e.g. 'Mac OSX') by the dummy one 'Agg' in order to avoid
-# incompatibility when threading this module, e.g. when using a Tcl/Tk GUI.
-import matplotlib.pyplot as plt
-
-from matplotlib.ticker import EngFormatter
+# (i) matplotlib.pyplot is loaded only when plotting, see get_pyplot(), so
+#     the headless FIR generation costs only the DSP. The importer can still
+#     call matplotlib.use('Agg') to replace the regular display backend
+#     (e.g. 'Mac OSX') by the dummy one 'Agg' in order to avoid incompatibility
+#     when threading this module, e.g. when using a Tcl/Tk GUI.
+plt = None
 
 ### ~/audiotools
 HOME = os.path.expanduser("~")
@@ -120,6 +139,8 @@ dev = False
 m        = 2**15     # FIR length
 fs       = 48000     # FIR fs
 viewFIRs = False
+doPlot   = True      # otherwise the plot data are saved to be plotted later
+long_fir = 2**16     # longer FIRs are synthesized by synthesize_long_fir()
 doPCM    = False
 doWAV    = False
 WAVfmt   = 'int32'
@@ -142,29 +163,168 @@ wLoct   = 5         # span in octaves for the left side of wL.
 wHoct   = 5         # span in octaves for the right side of wH.
 noPos   = False     # avoids positive gains
 
-
-def main(FRDname, ax, ref_level=None):
-
-    FRDbasename = os.path.basename(FRDname)
-    FRDdirname  = os.path.dirname(FRDname)
-
-    print( f'--- processing {FRDbasename}')
-
-    # Retreiving channel Id for naming files
-    ch = FRDbasename
-    if FRDbasename[0].upper() in ('L','R','C'):
-        ch = FRDbasename[0].upper()
-
-    if not FRDdirname:
-        FRDdirname = os.getcwd()
-
-    FRDpath = f'{FRDdirname}/{FRDbasename}'
-
-    # Reading the FRD file
-    FR, fs_FRD = tools.readFRD(FRDpath)
-    freq = FR[:, 0]     # >>>> frequencies vector <<<<
-    mag  = FR[:, 1]     # >>>> magnitudes vector  <<<<
-
+# On disk cache of the target and EQ curves ('' disables it), the least
+# recently used ones beyond <cache_max_files> are removed
+cache_folder    = f'{HOME}/.cache/roomEQ'
+cache_max_files = 200
+
+# To be increased when the target or EQ curve computing changes, so that
+# the former cached curves are not used
+CACHE_VERSION   = 1
+
+
+# The EQ parameters, any of them can be given to compute_eq()
+EQ_PARAMS = ( 'm', 'fs', 'f1', 'f2', 'Noct', 'fSchro', 'octSch', 'Tspeed',
+              'wLfc', 'wHfc', 'wLoct', 'wHoct', 'noPos' )
+
+
+def get_channel_id(FRDname):
+    """ Retreiving channel Id for naming files
+    """
+    ch = os.path.basename(FRDname)
+    if ch[0].upper() in ('L','R','C'):
+        ch = ch[0].upper()
+    return ch
+
+
+def compute_eq(freq, mag, ref_level=None, **kwargs):
+    """ Computes the room EQ from a given freq response, no files, no plots.
+        (i.e. compute_eq_curve() then synthesize_fir() as per <m> and <fs>)
+
+        freq, mag:  the freq response arrays, e.g. from tools.readFRD()
+        ref_level:  dB (default autodetected)
+        kwargs:     any of EQ_PARAMS, otherwise the module ones are used
+
+        Returns a dictionary:
+
+            freq, mag:          the given response, moved to the ref level
+            rmag:               its 1/1 oct smoothed version
+            target:             its smoothed version to be equalised
+            ref_level, autoRef: the used ref level, and if it was autodetected
+            f1_idx, f2_idx:     the freq range used to autodetect it
+            f0:                 the freq where the smoothing transition begins
+            w:                  the window to limit positive gains
+            eq:                 the EQ curve
+            newFreq, newEq:     the EQ curve interpolated for the FIR <m> and <fs>
+            imp:                the FIR impulse (minimum phase)
+
+        and also the used EQ_PARAMS.
+    """
+    res = compute_eq_curve(freq, mag, ref_level, **kwargs)
+    newFreq, newEq, imp = synthesize_fir(freq, res['eq'], res['m'], res['fs'])
+    return dict(res, newFreq=newFreq, newEq=newEq, imp=imp)
+
+
+def compute_eq_curve(freq, mag, ref_level=None, **kwargs):
+    """ The compute_eq() target and EQ curve stage, it does not depend
+        on the FIR <m> and <fs>.
+
+        The smoothed curves are cached in <cache_folder>, keyed by the given
+        freq response and the parameters it depends on.
+    """
+
+    p = { name: kwargs.pop(name, globals()[name]) for name in EQ_PARAMS }
+    if kwargs:
+        raise TypeError(f'unknown compute_eq parameters: {list(kwargs)}')
+
+    # (i) e.g. a numpy scalar, it has to be json serializable
+    if ref_level is not None:
+        ref_level = float(ref_level)
+
+    key = get_cache_key(freq, mag, ref_level, p)
+
+    res = load_cached_curve(key)
+    if res is None:
+        res = smooth_eq_curve(freq, mag, ref_level, p)
+        save_cached_curve(key, res)
+
+    return dict(p, **res)
+
+
+def get_cache_key(freq, mag, ref_level, p):
+    """ A hash of the freq response and the parameters that the target and
+        EQ curve depend on (not the FIR <m> and <fs>), also of the smoothing
+        and tools modules version, so an audiotools update is not missed,
+        and of the CACHE_VERSION.
+    """
+    h = hashlib.sha1()
+    h.update( np.ascontiguousarray(freq, dtype='float64').tobytes() )
+    h.update( np.ascontiguousarray(mag,  dtype='float64').tobytes() )
+    params = { k: v for k, v in p.items() if k not in ('m', 'fs') }
+    params['ref_level'] = ref_level
+    h.update( json.dumps(params, sort_keys=True).encode() )
+    h.update( f'roomEQ {CACHE_VERSION}'.encode() )
+    for module in (sys.modules[smooth.__module__], tools):
+        path = module.__file__
+        h.update( f'{path} {os.path.getmtime(path)}'.encode() )
+    return h.hexdigest()
+
+
+def load_cached_curve(key):
+    """ A smooth_eq_curve() result from the cache, or None
+    """
+    if not cache_folder:
+        return None
+
+    path = f'{cache_folder}/{key}.npz'
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path) as npz:
+            res = { k: npz[k] for k in npz.files if k != 'meta' }
+            res.update( json.loads( str(npz['meta']) ) )
+    except Exception as e:
+        print( f'(!) bad cache file {path}: {e}' )
+        return None
+
+    # the last used ones are kept, see trim_cache()
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    print( f'(i) using cached target and EQ curve, ref level: {res["ref_level"]} dB --> 0 dB' )
+    return res
+
+
+def save_cached_curve(key, res):
+    if not cache_folder:
+        return
+
+    arrays = { k: v for k, v in res.items() if isinstance(v, np.ndarray) }
+    meta   = { k: v for k, v in res.items() if k not in arrays }
+
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        # Replacing at once, so a concurrent reader never gets a partial file
+        tmp = f'{cache_folder}/{key}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, meta=json.dumps(meta), **arrays)
+        os.replace(tmp, f'{cache_folder}/{key}.npz')
+        trim_cache()
+    except Exception as e:
+        print( f'(!) unable to cache the EQ curve: {e}' )
+
+
+def trim_cache():
+    """ Removes the least recently used cache files beyond <cache_max_files>
+    """
+    paths = [ f'{cache_folder}/{fname}' for fname in os.listdir(cache_folder)
+              if fname.endswith('.npz') ]
+    if len(paths) <= cache_max_files:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - cache_max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def smooth_eq_curve(freq, mag, ref_level, p):
+    """ The compute_eq_curve() computing, <p> being the EQ_PARAMS
+    """
 
     ############################################################################
     # 1. TARGET CALCULATION: a smoothed version of the given freq response
@@ -173,9 +333,9 @@ def main(FRDname, ax, ref_level=None):
     # 1.1 Reference level
     # 'rmag' is a heavily smoothed curve 1/1oct useful to getting the ref level
     rmag = smooth(freq, mag, Noct=1)
+    f1_idx = (np.abs(freq - p['f1'])).argmin()
+    f2_idx = (np.abs(freq - p['f2'])).argmin()
     if ref_level == None:
-        f1_idx = (np.abs(freq - f1)).argmin()
-        f2_idx = (np.abs(freq - f2)).argmin()
         # 'r2mag' is a portion of the magnitudes within the reference range:
         r2mag = rmag[ f1_idx : f2_idx ]
         # Aux ponderation array to calculate the average, same length as 'r2mag'
@@ -191,17 +351,17 @@ def main(FRDname, ax, ref_level=None):
 
     # 1.2 'target' curve: a smoothed version of the given freq response
     # 'f0': the bottom freq to begin increasing smoothing towards 1/1 oct at Nyquist
-    f0 = 2**(-octSch) * fSchro
+    f0 = 2**(-p['octSch']) * p['fSchro']
 
     # 'Noct': starting fine somoothing in low freq (def 1/48 oct)
     # 'Tspeed': smoothing transition speed (audiotools/smoothSpectrum.py)
     print( '(i) Smoothing response for target calculation ...' )
-    target = smooth(freq, mag, Noct, f0=f0, Tspeed=Tspeed)
+    target = smooth(freq, mag, p['Noct'], f0=f0, Tspeed=p['Tspeed'])
 
-    # 1.3 Move curves to ref level
-    mag    -= ref_level   # original curve
-    rmag   -= ref_level   # the 1/1 oct version
-    target -= ref_level   # the final target to be equalised
+    # 1.3 Move curves to ref level (not in place, the given curve is kept)
+    mag    = mag - ref_level    # original curve
+    rmag   -= ref_level         # the 1/1 oct version
+    target -= ref_level         # the final target to be equalised
 
 
     ############################################################################
@@ -217,11 +377,11 @@ def main(FRDname, ax, ref_level=None):
 
     # Ponderation window for positive gains
     # window left side (low freqs) and right side (high freqs)
-    w_Low    = tools.logspaced_gauss(fc=wLfc, wideOct=wLoct * 2, freq=freq)
-    w_High   = tools.logspaced_gauss(fc=wHfc, wideOct=wHoct * 2, freq=freq)
+    w_Low    = tools.logspaced_gauss(fc=p['wLfc'], wideOct=p['wLoct'] * 2, freq=freq)
+    w_High   = tools.logspaced_gauss(fc=p['wHfc'], wideOct=p['wHoct'] * 2, freq=freq)
 
-    Lfc_idx  = len( np.where(freq < wLfc )[0] ) - 1
-    Hfc_idx  = len( np.where(freq < wHfc)[0] ) - 1
+    Lfc_idx  = len( np.where(freq < p['wLfc'])[0] ) - 1
+    Hfc_idx  = len( np.where(freq < p['wHfc'])[0] ) - 1
 
     w_Low    = w_Low [ : Lfc_idx]
     w_High   = w_High[Hfc_idx : ]
@@ -230,7 +390,7 @@ def main(FRDname, ax, ref_level=None):
     w = np.concatenate( (w_Low, w_Mid, w_High) )
 
     # Applying the window to positive gains (noPos deactivates positive gains)
-    if noPos:
+    if p['noPos']:
         eqPos.fill( 0.0 )
     else:
         eqPos *= w
@@ -239,8 +399,16 @@ def main(FRDname, ax, ref_level=None):
     eq = eqPos + eqNeg
     eq = smooth(freq, eq, Noct=24)
 
-    # Save the eq curve to a FRD text file for auxiliary pursoses
-    tools.saveFRD(f'{FRDs_dirname}/roomEQ_drc.{ch}.frd', freq, eq, comments=f'roomEQ DRC curve ({ch})')
+    return dict( freq=freq, mag=mag, rmag=rmag, target=target,
+                 ref_level=ref_level, autoRef=autoRef,
+                 f1_idx=int(f1_idx), f2_idx=int(f2_idx), f0=f0, w=w, eq=eq )
+
+
+def synthesize_fir(freq, eq, m, fs):
+    """ The FIR from an EQ curve, returns the interpolated
+        (newFreq, newEq) curve and the impulse
+    """
+
 
     ############################################################################
     # 3. The output FIR to be used in a convolver.
@@ -264,6 +432,9 @@ def main(FRDname, ax, ref_level=None):
     #   - The first bin is 0 Hz and last bin is Nyquist.
     #
     ############################################################################
+    if m > long_fir:
+        return synthesize_long_fir(freq, eq, m, fs)
+
     print( f'(i) Interpolating spectrum with m = {tools.Ktaps(m)} @ {str(fs)} Hz' )
     newFreq, newEq = pydsd.lininterp(freq, eq, m, fs)
 
@@ -272,10 +443,72 @@ def main(FRDname, ax, ref_level=None):
 
     # From now on, 'imp' has a causal response, a natural one, i.e. minimum phase
 
+    return newFreq, newEq, imp
+
+
+def synthesize_long_fir(freq, eq, m, fs):
+    """ As synthesize_fir() but for the very long FIRs (e.g. 1 Mtaps at 192 KHz)
+
+        The minimum phase is got from the real cepstrum, computed by real
+        transforms over an oversampled spectrum of fast FFT size, to keep
+        low the cepstrum time aliasing, then the impulse is truncated to <m>
+        taps. The cepstrum is float64, the final IFFT and the impulse are
+        float32, and the intermediate arrays are released on the way, so
+        the peak memory grows linearly with <m> (see bench_FIRsynth.py).
+    """
+
+    print( f'(i) Synthesizing long FIR m = {tools.Ktaps(m)} @ {str(fs)} Hz' )
+
+    # The EQ semispectrum with m taps resolution, only to be plotted
+    newFreq = np.linspace(0, fs / 2, m // 2 + 1)
+    newEq   = np.interp(newFreq, freq, eq)
+
+    # Oversampled FFT size (even), so the truncated impulse tail is negligible
+    nfft = next_fast_len(2 * m, real=True)
+    nfft += nfft % 2
+
+    # Natural log of the magnitude from dB, then the real cepstrum
+    logmag = np.interp( np.arange(nfft // 2 + 1) * (fs / nfft), freq, eq )
+    logmag *= np.log(10) / 20
+    cep = irfft(logmag, n=nfft)
+    del logmag
+
+    # Folding the cepstrum to get a causal one, i.e. the minimum phase
+    cep[1 : nfft // 2] *= 2
+    cep[nfft // 2 + 1 :] = 0
+
+    spectrum = rfft(cep)
+    del cep
+    np.exp(spectrum, out=spectrum)
+
+    # float32 is enough for the impulse (a 32 bit PCM is to be saved)
+    imp = irfft( spectrum.astype('complex64'), n=nfft )[:m]
+    del spectrum
+
+    # Fading out the last 1/16 of the truncated impulse
+    fade = m // 16
+    imp[-fade:] *= np.hanning(2 * fade)[fade:].astype('float32')
+
+    return newFreq, newEq, imp
+
+
+def get_pyplot():
+    """ Loads matplotlib.pyplot on demand
+    """
+    global plt
+    if plt is None:
+        import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_eq(ax, res, title=''):
+    """ Plots a compute_eq() result on the given pyplot axes
+    """
+    from matplotlib.ticker import EngFormatter
+
+    freq, m, fs = res['freq'], res['m'], res['fs']
+    f1_idx, f2_idx = res['f1_idx'], res['f2_idx']
 
-    ############################################################################
-    # 4. MAKE PLOTS
-    ############################################################################
     ax.set_xscale('log')
     ax.grid(True, which='both', axis='x')
     ax.grid(True, which='major', axis='y')
@@ -286,43 +519,40 @@ def main(FRDname, ax, ref_level=None):
     # auxiliary EQ plots ( -dev )
     if dev:
 
-        ax.axvline(fSchro, label='Schroeder', color='black', linestyle=':')
+        ax.axvline(res['fSchro'], label='Schroeder', color='black', linestyle=':')
 
-        ax.axvline (f0, label='f0 = -' + str(octSch) + ' oct vs Schroeder',
+        ax.axvline (res['f0'], label='f0 = -' + str(res['octSch']) + ' oct vs Schroeder',
                         color='orange', linestyle=':', linewidth=1)
 
-        ax.plot(freq, eqaux,
-                     label='eqaux', linestyle=':', color='purple')
-
     # raw response curve:
-    ax.plot(freq, mag,
+    ax.plot(freq, res['mag'],
                             label='FRD',
                             color='grey', linestyle=':', linewidth=.5)
 
     # target (smoothed) curve:
-    ax.plot(freq, target,
+    ax.plot(freq, res['target'],
                             label='FRD schoeder smoothed',
                             color='blue', linestyle='-')
 
     # the chunk curve used for getting the ref level:
-    if autoRef:
-        ax.plot(freq[ f1_idx : f2_idx], rmag[ f1_idx : f2_idx ],
+    if res['autoRef']:
+        ax.plot(freq[ f1_idx : f2_idx], res['rmag'][ f1_idx : f2_idx ],
                             label='range to estimate ref level',
                             color='black', linestyle='--', linewidth=2)
 
     # window for positive gains (scaled at level 10 for clarity)
-    if not noPos:
-        ax.plot(freq, w*10, label='positive eq unitary window',
+    if not res['noPos']:
+        ax.plot(freq, res['w']*10, label='positive eq unitary window',
                             color='grey', linestyle='dotted')
 
     # computed EQ curve:
-    ax.plot(newFreq, newEq,
+    ax.plot(res['newFreq'], res['newEq'],
                             label=f'EQ FIR ({int(m/1024)} Ktaps)',
                             color='green')
 
     # estimated result curve:
     if dev:
-        ax.plot(freq, (target + eq),
+        ax.plot(freq, (res['target'] + res['eq']),
                             label='estimated result',
                             color='green', linewidth=1.5)
 
@@ -335,7 +565,7 @@ def main(FRDname, ax, ref_level=None):
              bbox=props)
 
     # plot title
-    title = f'{FRDbasename}\n(ref. level @ {str(ref_level)} dB --> 0 dB)'
+    title = f'{title}\n(ref. level @ {str(res["ref_level"])} dB --> 0 dB)'
     ax.set_title(title)
 
     # nice engineering formatting "1 K"
@@ -350,18 +580,287 @@ def main(FRDname, ax, ref_level=None):
     ax.legend(loc='lower right')
 
 
+def get_out_folder(FRDname, fs, m):
+    """ An output folder with a meaningful name with fs and taps length,
+        beside the given FRD file
+    """
+    FRDs_dirname = os.path.dirname( FRDname )
+    if not FRDs_dirname:
+        FRDs_dirname = os.getcwd()
+    return f'{FRDs_dirname}/{str(fs)}_{tools.Ktaps(m).replace(" ","")}'
+
+
+def read_FRD(FRDname):
+    """ Returns the channel Id, the folder, and the freq and mag arrays
+        from an FRD file
+    """
+
+    FRDbasename = os.path.basename(FRDname)
+    FRDdirname  = os.path.dirname(FRDname)
+
+    print( f'--- processing {FRDbasename}')
+
+    ch = get_channel_id(FRDbasename)
+
+    if not FRDdirname:
+        FRDdirname = os.getcwd()
+
+    FRDpath = f'{FRDdirname}/{FRDbasename}'
+
+    # Reading the FRD file
+    FR, fs_FRD = tools.readFRD(FRDpath)
+    freq = FR[:, 0]     # >>>> frequencies vector <<<<
+    mag  = FR[:, 1]     # >>>> magnitudes vector  <<<<
+
+    return ch, FRDdirname, freq, mag
+
+
+def save_eq_curve(FRDdirname, ch, res):
+    # Save the eq curve to a FRD text file for auxiliary pursoses
+    tools.saveFRD(f'{FRDdirname}/roomEQ_drc.{ch}.frd', res['freq'], res['eq'],
+                  comments=f'roomEQ DRC curve ({ch})')
+
+
+def main(FRDname, ax=None, ref_level=None, out_folder='', **kwargs):
+    """ Processes an FRD file: computes its EQ then optionally plots it
+        on <ax>, and saves the FIR .pcm to <out_folder> (if doPCM).
+        Returns the compute_eq() result.
+    """
+
+    ch, FRDdirname, freq, mag = read_FRD(FRDname)
+
+    res = compute_eq(freq, mag, ref_level, **kwargs)
+
+    save_eq_curve(FRDdirname, ch, res)
+
+    # (i) process() plots all the channels later, see plot_results()
+    if ax is not None:
+        plot_eq(ax, res, title=os.path.basename(FRDname))
+
     ############################################################################
-    # 5. Saving FIR to .pcm
+    # Saving FIR to .pcm
     ############################################################################
-    if doPCM:
+    if doPCM and out_folder:
         EQpcmname = f'{out_folder}/drc.{ch}.pcm'
-        tools.savePCM32(imp, EQpcmname)
+        tools.savePCM32(res['imp'], EQpcmname)
         print( f'(i) Saving PCM: {EQpcmname}' )
 
     else:
         print( '(i) Skiping PCM saving' )
 
-    return imp
+    return res
+
+
+def synthesize_variant(job):
+    """ A process pool job (ch, freq, eq, m, fs, pcm_folder), see process_matrix()
+    """
+    ch, freq, eq, m, fs, pcm_folder = job
+
+    newFreq, newEq, imp = synthesize_fir(freq, eq, m, fs)
+
+    if pcm_folder:
+        EQpcmname = f'{pcm_folder}/drc.{ch}.pcm'
+        tools.savePCM32(imp, EQpcmname)
+        print( f'(i) Saving PCM: {EQpcmname}' )
+
+    return newFreq, newEq, imp
+
+
+def get_png_folder(FRDnames):
+    # Saving graphs by using the folder beholding the last FRD file name
+    png_folder = os.path.dirname( FRDnames[-1] )
+    if not png_folder:
+        png_folder = os.getcwd()
+    return png_folder
+
+
+def plot_results(entries, png_path=''):
+    """ Plots a list of (title, compute_eq() result, extra EQ curves), a
+        subplot for each one. The extra EQ curves are (label, freq, eq).
+        Returns the pyplot figure, it is left open so it can be shown.
+    """
+    plt = get_pyplot()
+
+    # prepare pyplot
+    plt.rcParams.update({'font.size': 8})
+
+    # prepare subplots as per the number of entries
+    nrows = len(entries)
+    fig, axs = plt.subplots( nrows=nrows, ncols=1, squeeze=False,
+                             figsize=(9, 4.5 * nrows) ) # in inches, wide aspect
+
+    for (title, res, extras), ax in zip(entries, axs[:, 0]):
+        plot_eq(ax, res, title=title)
+        for label, freq, eq in extras:
+            ax.plot(freq, eq, linewidth=.75, label=label)
+        if extras:
+            ax.legend(loc='lower right')
+
+    # Tightening plot layout
+    fig.tight_layout()
+
+    if png_path:
+        print( f'(i) Saving graph to file: {png_path}' )
+        fig.savefig(png_path)
+
+    return fig
+
+
+def save_plot_data(entries, path):
+    """ Saves the plot_results() entries to a .npz file, so they
+        can be plotted later, see load_plot_data()
+    """
+    arrays = {}
+    meta   = []
+    for i, (title, res, extras) in enumerate(entries):
+        scalars = {}
+        for k, v in res.items():
+            if k == 'imp':
+                continue
+            elif isinstance(v, np.ndarray):
+                arrays[f'{i}.{k}'] = v
+            else:
+                scalars[k] = v
+        for j, (label, freq, eq) in enumerate(extras):
+            arrays[f'{i}.extra{j}.freq'] = freq
+            arrays[f'{i}.extra{j}.eq']   = eq
+        meta.append( {'title': title, 'res': scalars,
+                      'extras': [label for label, _, _ in extras]} )
+
+    with open(path, 'wb') as f:
+        np.savez(f, meta=json.dumps(meta), **arrays)
+    print( f'(i) Saving plot data to file: {path}' )
+
+
+def load_plot_data(path):
+    """ The plot_results() entries from a save_plot_data() file
+    """
+    entries = []
+    with np.load(path) as npz:
+        for i, e in enumerate( json.loads( str(npz['meta']) ) ):
+            res = dict(e['res'])
+            prefix = f'{i}.'
+            for k in npz.files:
+                if k.startswith(prefix) and '.extra' not in k:
+                    res[k[len(prefix):]] = npz[k]
+            extras = [ ( label, npz[f'{i}.extra{j}.freq'], npz[f'{i}.extra{j}.eq'] )
+                       for j, label in enumerate(e['extras']) ]
+            entries.append( (e['title'], res, extras) )
+    return entries
+
+
+def output_plots(entries, FRDnames, doPlot=True):
+    """ Plots the entries to 'roomEQ_drc.png', or if not <doPlot> saves
+        them to 'roomEQ_drc.npz' to be plotted later (roomEQ.py -plot=)
+    """
+    png_folder = get_png_folder(FRDnames)
+    if doPlot:
+        plot_results(entries, f'{png_folder}/roomEQ_drc.png')
+    else:
+        save_plot_data(entries, f'{png_folder}/roomEQ_drc.npz')
+
+
+def process_matrix(FRDnames, fss, ms, ref_level=None, doPlot=True, **kwargs):
+    """ As process() but for every <fss> and <ms> FIR variant: the target and
+        EQ curve are computed once per channel, then the FIR synthesis of
+        every variant is spread over a process pool.
+
+        Returns a dictionary of compute_eq() results by (fs, m) then by
+        channel Id.
+    """
+
+    variants = [ (fs_out, m_out) for fs_out in fss for m_out in ms ]
+
+    # The target and EQ curve once per channel
+    curves = {}
+    for FRDname in FRDnames:
+        ch, FRDdirname, freq, mag = read_FRD(FRDname)
+        curves[ch] = compute_eq_curve(freq, mag, ref_level, **kwargs)
+        save_eq_curve(FRDdirname, ch, curves[ch])
+
+    out_folders = {}
+    for fs_out, m_out in variants:
+        out_folders[(fs_out, m_out)] = ''
+        if doPCM or doWAV:
+            out_folders[(fs_out, m_out)] = get_out_folder(FRDnames[0], fs_out, m_out)
+            os.makedirs(out_folders[(fs_out, m_out)], exist_ok=True)
+
+    jobs = [ ( ch, res['freq'], res['eq'], m_out, fs_out,
+               out_folders[(fs_out, m_out)] if doPCM else '' )
+             for fs_out, m_out in variants
+             for ch, res in curves.items() ]
+
+    with ProcessPoolExecutor() as pool:
+        firs = list( pool.map(synthesize_variant, jobs) )
+
+    results = { v: {} for v in variants }
+    for (ch, _, _, m_out, fs_out, _), (newFreq, newEq, imp) in zip(jobs, firs):
+        results[(fs_out, m_out)][ch] = dict( curves[ch], fs=fs_out, m=m_out,
+                                             newFreq=newFreq, newEq=newEq, imp=imp )
+
+    # Optional WAV files
+    if doWAV:
+        for (fs_out, m_out), chs in results.items():
+            wavfname = f'{out_folders[(fs_out, m_out)]}/drc.wav'
+            wavdata  = np.vstack( [res['imp'] for res in chs.values()] ).transpose()
+            tools.saveWAV( fname=wavfname, rate=fs_out, data=wavdata, wav_dtype=WAVfmt )
+            print(f'(i) saving WAV: {wavfname}')
+
+    # Graphs: the first variant, then the EQ curve of the others
+    entries = []
+    for FRDname in FRDnames:
+        ch = get_channel_id(FRDname)
+        extras = [ ( f'EQ FIR ({int(m_out/1024)} Ktaps @ {fs_out} Hz)',
+                     results[(fs_out, m_out)][ch]['newFreq'],
+                     results[(fs_out, m_out)][ch]['newEq'] )
+                   for fs_out, m_out in variants[1:] ]
+        entries.append( ( os.path.basename(FRDname), results[variants[0]][ch], extras ) )
+
+    output_plots(entries, FRDnames, doPlot)
+
+    return results
+
+
+def process(FRDnames, ref_level=None, doPlot=True, **kwargs):
+    """ Processes a set of FRD files as per the module options (doPCM, doWAV,
+        WAVfmt), any of EQ_PARAMS can be given as a keyword argument.
+
+        The .pcm and .wav FIRs are saved to a folder beside the first FRD
+        file, and the graphs to 'roomEQ_drc.png' beside the last one
+        (see output_plots). The pyplot figure is left open, so it can be shown.
+
+        Returns a dictionary of compute_eq() results by channel Id.
+    """
+
+    fs_out = kwargs.get('fs', fs)
+    m_out  = kwargs.get('m',  m)
+
+    out_folder = ''
+    if doPCM or doWAV:
+        out_folder = get_out_folder(FRDnames[0], fs_out, m_out)
+        os.makedirs(out_folder, exist_ok=True)
+
+    # Processing FRDs
+    results = {}
+    for FRDname in FRDnames:
+        results[get_channel_id(FRDname)] = main(FRDname, None, ref_level,
+                                                out_folder, **kwargs)
+
+    # Optional WAV file
+    IRs = [res['imp'] for res in results.values()]
+    if doWAV and IRs:
+        wavfname = f'{out_folder}/drc.wav'
+        wavdata  = np.vstack( IRs ).transpose()
+        tools.saveWAV( fname=wavfname, rate=fs_out, data=wavdata, wav_dtype=WAVfmt )
+        print(f'(i) saving WAV: {wavfname}')
+    elif not IRs:
+        print('(!) something was wrong no impulses found to save WAV :-/')
+
+    output_plots( [ (os.path.basename(FRDname), results[get_channel_id(FRDname)], [])
+                    for FRDname in FRDnames ],
+                  FRDnames, doPlot )
+
+    return results
 
 
 if __name__ == '__main__':
@@ -373,25 +872,40 @@ if __name__ == '__main__':
 
     FRDnames = []
 
+    # FIR variants
+    fss = [fs]
+    ms  = [m]
+
     opcsOK = True
 
+    # A saved plot data file to be plotted
+    plot_data = ''
+
     for opc in sys.argv[1:]:
 
         if opc[0] != '-' and opc[-4:] in ('.frd','.txt'):
             FRDnames.append(opc)
 
+        elif opc[:6] == '-plot=':
+            plot_data = opc[6:]
+
         elif opc[:4] == '-fs=':
-            if opc[4:] in ('44100', '48000', '88200', '96000'):
-                fs = int(opc[4:])
+            fss = opc[4:].split(',')
+            if all( [x in ('44100', '48000', '88200', '96000', '176400', '192000')
+                     for x in fss] ):
+                fss = [int(x) for x in fss]
+                fs = fss[0]
             else:
-                print( "fs must be in 44100 | 48000 | 88200 | 96000" )
+                print( "fs must be in 44100 | 48000 | 88200 | 96000 | 176400 | 192000" )
                 sys.exit()
 
         elif opc[:3] == '-e=':
-            if opc[3:] in ('12', '13', '14', '15', '16'):
-                m = 2**int(opc[3:])
+            ms = opc[3:].split(',')
+            if all( [x.isdigit() and 12 <= int(x) <= 20 for x in ms] ):
+                ms = [2**int(x) for x in ms]
+                m = ms[0]
             else:
-                print( "m: 12...16 (4K...64K taps)" )
+                print( "m: 12...20 (4K...1M taps)" )
                 sys.exit()
 
         elif opc[:5] == '-ref=':
@@ -434,6 +948,12 @@ if __name__ == '__main__':
         elif '-nopos' in opc.lower():
             noPos = True
 
+        elif '-noplot' in opc.lower():
+            doPlot = False
+
+        elif '-nocache' in opc.lower():
+            cache_folder = ''
+
         elif '-v' in opc:
             viewFIRs = True
 
@@ -458,63 +978,30 @@ if __name__ == '__main__':
         sys.exit()
 
 
-    # prepare pyplot
-    plt.rcParams.update({'font.size': 8})
-
-    # prepare subplots as per the number of given FRD files
-    nrows = len(FRDnames)
-    fig, axs = plt.subplots( nrows=nrows, ncols=1,
-                             figsize=(9, 4.5 * nrows) ) # in inches, wide aspect
-
-
-    # Prepare output folder with a meaningful name with fs and taps length
-    if doPCM or doWAV:
-        FRDs_dirname = os.path.dirname( FRDnames[0] )
-        if not FRDs_dirname:
-            FRDs_dirname = os.getcwd()
-        out_folder = f'{FRDs_dirname}/{str(fs)}_{tools.Ktaps(m).replace(" ","")}'
-        os.system(f'mkdir -p {out_folder}')
-
-    # Processing FRDs
-    # (if only one, plt.subplots will not return an array of axes)
-    IRs = []
-    if len(FRDnames) == 1:
-        IRs.append( main(FRDnames[0], axs, ref_level) )
-
-    elif len(FRDnames) > 1:
-        for i, FRDname in enumerate(FRDnames):
-            IRs.append( main(FRDname, axs[i], ref_level) )
+    # Deferred plotting from saved plot data, then END
+    if plot_data:
+        plot_results( load_plot_data(plot_data),
+                      plot_data.replace('.npz', '.png') )
+        plt.show()
+        sys.exit()
 
-    else:
+    if not FRDnames:
         print(__doc__)
         sys.exit()
 
-    # Optional WAV file
-    if doWAV and IRs:
-        wavfname = f'{out_folder}/drc.wav'
-        wavdata  = np.vstack( IRs ).transpose()
-        tools.saveWAV( fname=wavfname, rate=fs, data=wavdata, wav_dtype=WAVfmt )
-        print(f'(i) saving WAV: {wavfname}')
-    elif not IRs:
-        print('(!) something was wrong no impulses found to save WAV :-/')
-
-    # Tightening plot layout
-    plt.tight_layout()
-
-    # Saving graphs by using the folder beholding the last FRD file name
-    png_folder = os.path.dirname( FRDnames[-1] )
-    if not png_folder:
-        png_folder = os.getcwd()
-    png_path = f'{png_folder}/roomEQ_drc.png'
-    print( f'(i) Saving graph to file: {png_path}' )
-    fig.savefig(png_path)
+    # Processing FRDs, saving FIRs and graphs
+    if len(fss) * len(ms) > 1:
+        results = process_matrix(FRDnames, fss, ms, ref_level, doPlot)
+    else:
+        results = process(FRDnames, ref_level, doPlot)
 
     # Display plots
-    plt.show()
+    if doPlot:
+        plt.show()
 
     # ...
     if viewFIRs:
+        EQpcmname = f'{get_out_folder(FRDnames[0], fs, m)}/drc.{get_channel_id(FRDnames[0])}.pcm'
         print( "FIR plotting with audiotools/IR_tool.py ..." )
         os.system("IRs_tool.py '" + EQpcmname + "' '" +
                   + "' 20-20000 -dBrange=36 -dBtop=12 -1 " + str(int(fs)))
-
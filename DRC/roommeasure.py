@@ -26,9 +26,14 @@
 
     'CH_N.frd'              Measured response at mic location #N.
     'CH_avg.frd'            Average response from all mic locations.
+                            (bins below -minsnr are not taken into account)
     'CH_avg_smoothed.frd'   Average smoothed 1/24 oct below Schroeder freq,
                             then progressively smoothed up to 1/1 oct at Nyquist.
 
+    'captures.raw'          The raw captures from every take (float32), and
+    'captures.json'         its manifest with the sweep parameters.
+                            (only with -archive)
+
     Usage:
 
         DRC_GUI.py          Launches a Graphical User Interface
@@ -45,12 +50,67 @@
          -e=XX              Power of two 2^XX to set the log-sweep length.
                             (default 2^17 == 128 K samples ~ 2 s at fs 48KHz)
 
+         -e=auto            Choose the shortest sweep length from a quick probe
+                            of the room noise and decay at the first location.
+
          -c=X               Channel id:  L | R | LR
                             This id will form the avobe .frd filename prefix.
                             'LR' allows the measurements of both channels
                             to be interleaved at a microphone location.
                             (default 'C' will be used as filename prefix)
 
+         -multimic          Every extra sound card input (3, 4, ...) is an extra
+                            mic location, so several locations are measured
+                            with a single sweep.
+
+         -mesm              Multiple Exponential Sweep Method: both L and R
+                            channels are measured with a single sweep playback,
+                            by driving the R channel with a delayed sweep.
+                            A long enough sweep is needed, e.g. -e20 at 48 KHz.
+                            (implies -c=LR, see the MESM wiring at logsweep2TF.py -h)
+
+         -repeats=K         K back to back sweeps to be averaged at each take,
+                            gaining 10*log10(K) dB S/N in noisy rooms.
+
+         -chunked           Bounded memory mode for very long sweeps (e.g. -e=22),
+                            the capture is deconvolved on the fly block by block.
+                            (not compatible with -mesm and -repeats)
+
+         -mls               Periodic MLS or multitone excitation instead of the
+         -multitone         log sweep, quick takes e.g. for mic positioning.
+                            (not compatible with -mesm and -chunked)
+
+         -avg=mode          Estimator of the average over the mic locations:
+                              db        dB mean (default)
+                              power     power (RMS) mean
+                              median    dB median
+                              trimmed   dB mean trimming the 20% extreme values
+                              reject    dB mean rejecting the outliers per bin,
+                                        e.g. a mic location that hit a null.
+
+         -minsnr=XX         Bins having a S/N ratio below XX dB at a location are
+                            left out from the average (default 10 dB, 0 disables)
+
+         -noise=XX          Seconds of silence captured before every sweep
+                            to get the noise floor (default 0.5 s, 0 disables)
+
+         -archive           Archive every raw capture to the results folder,
+                            so the session can be processed again later.
+
+         -reprocess=path    Rebuild the .frd files of an archived session folder
+                            (see -archive) as per the given options, e.g.
+                            -sch -noct -avg -minsnr -mic. No sound card is used.
+
+         -png               Plot the -reprocess curves to .png (default none)
+
+         -noct=XX           Smoothing 1/XX oct below the Schroeder freq
+                            (default 24)
+
+         -mic=path          A mic calibration file
+
+         -single            Single precision (float32) FFT computing, saves
+                            memory and time when using long sweeps.
+
          -schro=XXX         Schroeder freq, influences the smoothing transition
                             for the resulting smoothed freq response file.
                             (default 200 Hz)
@@ -133,8 +193,13 @@
 # standard modules
 import os
 import sys
+import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from time import sleep
+import queue
+import threading
+import warnings
 
 # logsweep2TF module (logsweep to transfer function)
 try:
@@ -153,12 +218,40 @@ from smoothSpectrum import smoothSpectrum as smooth
 from matplotlib import colors as mcolors
 css4_colors = list(mcolors.CSS4_COLORS.values())    # (black is index 7)
 
-# Resulting measurements stack (all measured points for every channel)
-curves = {'freq': None, 'L': None, 'R': None}
+# Resulting measurements running statistics (all measured points for every channel),
+# and the freqs and sampling rate they were measured at
+curves = {'freq': None, 'fs': None, 'L': None, 'R': None}
+
+# Resulting measurements location x freq arrays, preallocated for <numMeas>
+# locations, their S/N ratio (None if not available), and which locations
+# (rows) have been stacked
+locations       = {'L': None, 'R': None}
+locations_snr   = {'L': None, 'R': None}
+locations_done  = {'L': None, 'R': None}
 
 # Resulting averaged curves for every channel
 channels_avg= {'L':None, 'R':None}
 
+# Recorded takes pending to be analysed by the background worker, so the
+# deconvolution and saving of a take overlaps the next mic repositioning.
+analysis_queue  = queue.Queue()
+analysis_thread = None
+
+# The takes the worker failed to analyse, see wait_for_analysis()
+analysis_errors = []
+
+# Per location plots from the worker, they will be drawn by the main thread
+# (pyplot is not thread safe)
+pending_plots   = []
+
+# The raw captures archive of the running session (if <archive>)
+capture_archive = None
+
+# Optional callback to display the averages convergence, it is called
+# as avg_callback(ch, RunningStats, delta) after every location, <delta>
+# being the RMS change in dB of the <avgMode> average
+avg_callback    = None
+
 
 ################################################################################
 # roommeasure.py DEFAULT parameters
@@ -180,11 +273,22 @@ Schro               = 200       # Schroeder freq (Hz)
 Noct                = 24        # Initial 1/Noct smoothing below Schro,
                                 # then will be changed progressively until
                                 # 1/1oct at Nyquist freq.
+minSNR              = 10.0      # dB, low S/N bins are left out from averages
+archive             = False     # Keeps the raw captures, see CaptureArchive
+reprocess           = ''        # An archived session folder to be processed again
+doPlot              = True      # Plotting the curves (and saving them to .png)
+reprocessPNG        = False     # Plotting also when reprocessing
+avgMode             = 'db'      # Averaging estimator, see AVG_MODES
+avgTrim             = 0.2       # Fraction of values to trim at each end ('trimmed')
+avgReject           = 3.0       # Deviation from the median in robust std units
+                                # to reject a location at a bin ('reject')
+
+AVG_MODES           = ('db', 'power', 'median', 'trimmed', 'reject')
 
 LS.printInfo        = True      # logsweep2TF verbose
 
-LS.checkClearence   = False     # It is assumed that the user has check
-                                # previously for soundacard and levels setup.
+LS.checkClearence   = True      # The coarse to fine xcorr is cheap enough
+                                # to check for the time clearance every take.
 
 # Remote JACK management
 jackIP              = ''
@@ -201,7 +305,8 @@ def print_help_and_exit():
 def read_command_line():
 
     global doBeep, numMeas,  channels, Schro, timer, \
-           jackIP, jackUser, folder
+           jackIP, jackUser, folder, minSNR, avgMode, archive, \
+           reprocess, reprocessPNG, Noct
 
     # an string of three comma separated numbers 'CAPdev,PBKdev,fs'
     optional_device = ''
@@ -209,7 +314,15 @@ def read_command_line():
     opcsOK = True
     for opc in sys.argv[1:]:
 
-        if "-h" in opc.lower():
+        # (i) paths go first, they could contain any other option name
+        if opc[:11].lower() == '-reprocess=':
+            reprocess = os.path.abspath( os.path.expanduser(opc[11:]) )
+
+        elif opc[:5].lower() == '-mic=':
+            LS.mic_response_path = os.path.expanduser(opc[5:])
+            LS.set_mic_response()
+
+        elif "-h" in opc.lower():
             print_help_and_exit()
 
         elif "-nobeep" in opc.lower():
@@ -234,9 +347,54 @@ def read_command_line():
         elif "-sch=" in opc:
             Schro = float(opc.split('=')[-1])
 
+        elif "-e=auto" in opc.lower():
+            LS.auto_length = True
+
         elif "-e=" in opc:
             LS.N = 2**int(opc[3:])
 
+        elif "-archive" in opc.lower():
+            archive = True
+
+        elif "-png" in opc.lower():
+            reprocessPNG = True
+
+        elif "-noct=" in opc.lower():
+            Noct = int(opc.split('=')[-1])
+
+        elif "-single" in opc.lower():
+            LS.precision = 'single'
+
+        elif "-repeats=" in opc.lower():
+            LS.repeats = int(opc.split('=')[-1])
+
+        elif "-avg=" in opc.lower():
+            avgMode = opc.split('=')[-1].lower()
+            if avgMode not in AVG_MODES:
+                print( f'(!) -avg= must be one of: {", ".join(AVG_MODES)}' )
+                sys.exit()
+
+        elif "-minsnr=" in opc.lower():
+            minSNR = float(opc.split('=')[-1])
+
+        elif "-noise=" in opc.lower():
+            LS.noise_secs = float(opc.split('=')[-1])
+
+        elif "-multimic" in opc.lower():
+            LS.multimic = True
+
+        elif "-mesm" in opc.lower():
+            LS.mesm = True
+
+        elif "-chunked" in opc.lower():
+            LS.chunked = True
+
+        elif "-mls" in opc.lower():
+            LS.excitation = 'mls'
+
+        elif "-multitone" in opc.lower():
+            LS.excitation = 'multitone'
+
         elif opc[:7].lower() == '-timer=':
             timer = int( opc[7:] )
 
@@ -255,6 +413,10 @@ def read_command_line():
     if not opcsOK:
         print_help_and_exit()
 
+    # MESM always measures both channels at once
+    if LS.mesm:
+        channels = ['L', 'R']
+
     if optional_device:
         set_sound_card(optional_device)
 
@@ -265,8 +427,14 @@ def print_info():
     print(f'fs:                 {LS.fs}')
     print(f'channels:           {channels}')
     print(f'takes per ch:       {numMeas}')
+    if LS.multimic:
+        print(f'locations per take: {get_locations_per_sweep()}')
+    if LS.mesm:
+        print('MESM:               L and R in a single take')
     print(f'Schroeder freq:     {Schro}')
     print(f'sweep length (N):   {LS.N}')
+    if LS.repeats > 1:
+        print(f'sweeps per take:    {LS.repeats}')
 
     if timer:
         print(f'auto progess timer: {timer} s')
@@ -322,6 +490,10 @@ def do_beep(ch='C', times=1, blocking=True):
         Nbeep = np.tile(beepR, times)
         LS.sd.play(Nbeep, samplerate=LS.fs, blocking=blocking)
 
+    elif ch == 'LR':
+        Nbeep = np.tile(beepL + beepR, times)
+        LS.sd.play(Nbeep, samplerate=LS.fs, blocking=blocking)
+
 
 def console_prompt(ch, seq):
     """ Promts the user through by the console
@@ -380,50 +552,465 @@ def gui_prompt(ch, seq, gui_trigger, gui_msg):
     gui_msg.set(f'computing location #{seq+1}  [ {ch} ] (please wait)')
 
 
-def LS_meas(ch, seq):
+def LS_record():
+    """ Records a take, returns a (LS.SweepSession, LS.Capture) to be analysed
+        later, or None if LS aborted the take (see LS.meas_abort_msg).
+        The time clearance is checked here, so a bad take can be repeated
+        with the mic still at its location.
+    """
+
+    session = LS.SweepSession()
+    capture = session.record()
+
+    if capture is None:
+        LS.meas_abort_msg = session.abort_msg
+        return None
 
-    # Order LS to do the measurement
-    LS.do_meas()
+    # A take that exceeds the sweep ending silence is not reliable
+    if session.checkClearence and not session.get_clearance(capture)[1]:
+        LS.meas_abort_msg = 'time clearance lost'
+        return None
 
-    f, magdB = LS.DUT_FRD
+    return session, capture
 
-    # Saving the curve to a sequenced frd filename
-    tools.saveFRD(  fname   = f'{folder}/{ch}_{str(seq)}.frd',
-                    freq    = f,
-                    mag     = magdB,
-                    fs      = LS.fs,
-                    comments= f'roommeasure.py ch:{ch} loc:{str(seq)}',
-                    verbose = False
-                  )
 
-    # Plotting
+def get_results(res, ch, seqs):
+    """ Returns a list of measured (ch, seq, freq, magdB, noisedB, snrdB), one per
+        location in <seqs> (several ones in LS.multimic mode) and per channel
+        in <ch> (both 'LR' in LS.mesm mode), from the <res> of an analysed take.
+        (noisedB and snrdB are None if LS does not capture the noise floor)
+    """
+
+    # The order of DUT_FRDs, see LS.SweepSession.analyse()
+    labels = [(c, seq) for seq in seqs for c in ch]
+
+    return [ ( c, seq, f, magdB, noise[1] if noise else None, snr[1] if snr else None )
+             for (c, seq), (f, magdB), noise, snr
+             in zip(labels, res['DUT_FRDs'], res['NOISE_FRDs'], res['SNR_FRDs']) ]
+
+
+def save_results(results, ch, fs):
+    """ Saves the get_results() curves to .frd files, and prepares their plot
+    """
+
+    plot_curves = []
+
+    for c, seq, f, magdB, noise, snr in results:
+
+        # Saving the curve to a sequenced frd filename
+        tools.saveFRD(  fname   = f'{folder}/{c}_{str(seq)}.frd',
+                        freq    = f,
+                        mag     = magdB,
+                        fs      = fs,
+                        comments= f'roommeasure.py ch:{c} loc:{str(seq)}',
+                        verbose = False
+                      )
+
+        if noise is not None:
+            tools.saveFRD(  fname   = f'{folder}/{c}_{str(seq)}_noise.frd',
+                            freq    = f,
+                            mag     = noise,
+                            fs      = fs,
+                            comments= f'roommeasure.py ch:{c} loc:{str(seq)} noise floor',
+                            verbose = False
+                          )
+
+        # Will choose a color by selecting the CSS4 color sequence, from black (index 7)
+        plot_curves.append( {   'magdB': magdB,
+                                'color': css4_colors[(7 + seq) % 148],
+                                'label': f'{c}_{str(seq)}'              } )
+
+    if not doPlot:
+        return
+
+    # Plotting is left to the main thread, see plot_pending()
     figIdx = 10
-    chs = ('L', 'R', 'C')
+    chs = ('L', 'R', 'C', 'LR')
     if ch in chs:
         figIdx += chs.index(ch)
 
-    # Will choose a color by selecting the CSS4 color sequence, from black (index 7)
-    c = {   'magdB': magdB,
-            'color': css4_colors[(7 + seq) % 148],
-            'label': f'{ch}_{str(seq)}'             }
+    pending_plots.append( ( f, plot_curves, f'{os.path.basename(folder)} ({ch})',
+                            figIdx, f'{folder}/{ch}.png' ) )
+
+
+def LS_analyse(session, capture, ch, seqs):
+    """ Analyses a recorded take, saving its curves, see get_results()
+    """
+    results = get_results( session.analyse(capture), ch, seqs )
+    save_results(results, ch, session.fs)
+    return results
+
+
+def reset_results():
+    """ Clears the <curves> statistics and <locations> of every channel,
+        before a new session is stacked
+    """
+    for c in channels:
+        curves[c]         = None
+        locations[c]      = None
+        locations_snr[c]  = None
+        locations_done[c] = None
+        channels_avg[c]   = None
+    analysis_errors.clear()
+
+
+def stack_results(results, fs):
+    """ Accumulates the LS_analyse() results into the <curves> running statistics
+    """
+
+    for c, seq, f, mag, noise, snr in results:
+        #
+        curves['freq'] = f
+        curves['fs']   = fs
+        #
+        if curves[c] is None:
+            curves[c] = RunningStats(f.size, power=True, minSNR=minSNR)
+            locations[c]     = np.full( (numMeas, f.size), np.nan )
+            locations_snr[c] = np.full( (numMeas, f.size), np.nan )
+            locations_done[c] = np.zeros(numMeas, dtype='bool')
+
+        curves[c].update(mag, snr)
+
+        locations[c][seq] = mag
+        locations_done[c][seq] = True
+        if snr is None or locations_snr[c] is None:
+            locations_snr[c] = None
+        else:
+            locations_snr[c][seq] = snr
+
+        # The convergence of the chosen <avgMode> average
+        avg   = get_channel_average(c)
+        delta = np.inf
+        if channels_avg[c] is not None:
+            delta = np.sqrt( np.nanmean( (avg - channels_avg[c])**2 ) )
+        channels_avg[c] = avg
+
+        if curves[c].n > 1:
+            print( f'{c} {avgMode} average after {curves[c].n} locations: '
+                   f'changed {delta:.2f} dB RMS, '
+                   f'std {np.mean(curves[c].std):.2f} dB' )
+
+        if avg_callback:
+            avg_callback(c, curves[c], delta)
+
+
+def analysis_worker():
+    """ Analyses the recorded takes from <analysis_queue> in FIFO order,
+        so the locations are stacked as they were measured.
+    """
+    while True:
+
+        session, capture, ch, seqs = analysis_queue.get()
+        locs = ','.join( [str(x+1) for x in seqs] )
+
+        # (i) a take that cannot be archived is analysed anyway
+        if capture_archive is not None:
+            try:
+                capture_archive.append(session, capture, ch, seqs)
+            except Exception as e:
+                print( f'(!) ERROR archiving [ {ch} ] location(s) {locs}: {e}' )
+
+        try:
+            stack_results( LS_analyse(session, capture, ch, seqs), session.fs )
+
+        except Exception as e:
+            print( f'(!) ERROR analysing [ {ch} ] location(s) {locs}: {e}' )
+            analysis_errors.append( f'[ {ch} ] location(s) {locs}: {e}' )
+
+        finally:
+            analysis_queue.task_done()
+
+
+def start_analysis_worker():
+    global analysis_thread
+    if analysis_thread is None or not analysis_thread.is_alive():
+        analysis_thread = threading.Thread( target=analysis_worker, daemon=True )
+        analysis_thread.start()
+
+
+def wait_for_analysis():
+    """ Waits for the pending takes to be analysed, then plots them.
+        Raises RuntimeError if any take failed to be analysed, so that
+        the session can be measured again.
+    """
+    if analysis_queue.unfinished_tasks:
+        print( f'Waiting for {analysis_queue.unfinished_tasks} take(s) to be analysed ...' )
+    analysis_queue.join()
+    plot_pending()
+
+    if analysis_errors:
+        msg = ( f'{len(analysis_errors)} take(s) failed to be analysed, '
+                f'please measure again: {"; ".join(analysis_errors)}' )
+        analysis_errors.clear()
+        raise RuntimeError(msg)
+
+
+def plot_pending():
+    while pending_plots:
+        f, plot_curves, title, figIdx, png_fname = pending_plots.pop(0)
+        LS.plot_FRDs( f, plot_curves,   title=title,
+                                        figure=figIdx,
+                                        png_fname=png_fname )
+
+
+class RunningStats():
+    """ Running statistics of the dB curves measured from a channel, updated
+        one location at a time (Welford), so memory is O(FRDpoints).
+
+            n:          number of locations
+            mean:       dB mean
+            min, max:   dB min and max
+            pmean:      power mean in dB (only if <power>)
+            delta:      RMS change in dB of the mean from the last update
+
+        If <minSNR> is given, bins having a S/N ratio below it are left out
+        from average(), as long as every location provides its S/N ratio.
+    """
+
+    def __init__(self, size, power=False, minSNR=None):
+        self.n      = 0
+        self.mean   = np.zeros(size)
+        self.M2     = np.zeros(size)
+        self.min    = np.full(size,  np.inf)
+        self.max    = np.full(size, -np.inf)
+        self.pow    = np.zeros(size) if power else None
+        self.delta  = np.inf
+        # S/N masked mean
+        self.minSNR = minSNR
+        self.snr_ok = bool(minSNR)
+        self.nvalid = np.zeros(size, dtype='int')
+        self.vmean  = np.zeros(size)
+
+
+    def update(self, magdB, snrdB=None):
+
+        prev_mean = self.average()
+
+        self.n += 1
+        d = magdB - self.mean
+        self.mean += d / self.n
+        self.M2   += d * (magdB - self.mean)
+        np.minimum(self.min, magdB, out=self.min)
+        np.maximum(self.max, magdB, out=self.max)
+
+        if self.pow is not None:
+            self.pow += (10**(magdB / 10) - self.pow) / self.n
+
+        if self.snr_ok and snrdB is not None:
+            valid = snrdB >= self.minSNR
+            self.nvalid += valid
+            self.vmean[valid] += (magdB[valid] - self.vmean[valid]) / self.nvalid[valid]
+        else:
+            self.snr_ok = False
+
+        if self.n > 1:
+            self.delta = np.sqrt( np.mean( (self.average() - prev_mean)**2 ) )
+
+
+    @property
+    def var(self):
+        if self.n < 2:
+            return np.zeros(self.mean.shape)
+        return self.M2 / (self.n - 1)
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+    @property
+    def pmean(self):
+        if self.pow is None:
+            return None
+        return 10 * np.log10(self.pow)
 
-    LS.plot_FRDs( f, (c,),  title=f'{os.path.basename(folder)} ({ch})',
-                            figure=figIdx,
-                            png_fname=f'{folder}/{ch}.png'
-                )
 
-    return f, magdB
+    def average(self):
+        """ The dB mean, leaving out the low S/N bins if available. Where all
+            locations are below <minSNR> the plain mean is kept.
+        """
+        if self.snr_ok and self.n:
+            return np.where(self.nvalid > 0, self.vmean, self.mean)
+        return self.mean.copy()
+
+
+    def nlow(self):
+        """ Number of bins below <minSNR> at every location
+        """
+        if self.snr_ok:
+            return int( (self.nvalid == 0).sum() )
+        return 0
+
+
+class CaptureArchive():
+    """ The raw captures of a measurement session, so it can be processed again
+        without the sound card.
+
+        The Capture arrays are appended as float32 to 'captures.raw' as every
+        take finishes, and 'captures.json' manifests every take: its channel
+        and locations, the Capture fields, the SweepSession parameters and
+        the byte offset and shape of its arrays, so that they can be read as
+        numpy memmaps.
+    """
+
+    raw_fname       = 'captures.raw'
+    manifest_fname  = 'captures.json'
+    arrays          = ('z', 'noise', 'h', 'peak')
+
+    # (i) the mic response is not archived, it can be given again when
+    #     processing the session, neither the live levels display callback
+    skip_params     = ('mic_response', 'using_mic_response', 'level_callback')
+
+
+    def __init__(self, folder, new=False):
+
+        self.folder     = folder
+        self.raw_path   = f'{folder}/{self.raw_fname}'
+        self.json_path  = f'{folder}/{self.manifest_fname}'
+
+        if new:
+            self.manifest = {'raw': self.raw_fname, 'dtype': 'float32', 'takes': []}
+            open(self.raw_path, 'wb').close()
+            self.save_manifest()
+        else:
+            with open(self.json_path, 'r') as f:
+                self.manifest = json.load(f)
+
+
+    def save_manifest(self):
+        # Replacing the manifest at once, so it is always consistent
+        with open(self.json_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.json_path + '.tmp', self.json_path)
+
+
+    def append(self, session, capture, ch, seqs):
+
+        take = {'ch':               ch,
+                'seqs':             list(seqs),
+                'kind':             capture.kind,
+                'input_channels':   capture.input_channels,
+                'mic_inputs':       list(capture.mic_inputs),
+                'params':           { p: getattr(session, p)
+                                      for p in session.params
+                                      if p not in self.skip_params },
+                'arrays':           {}
+               }
+
+        with open(self.raw_path, 'ab') as f:
+            for name in self.arrays:
+                a = getattr(capture, name)
+                if a is None:
+                    continue
+                a = np.ascontiguousarray(a, dtype='float32')
+                take['arrays'][name] = {'offset': f.tell(), 'shape': a.shape}
+                f.write(a.tobytes())
+
+        self.manifest['takes'].append(take)
+        self.save_manifest()
+
+
+    def __len__(self):
+        return len(self.manifest['takes'])
+
+
+    def get_take(self, i):
+        """ Returns the i-th archived take as (params, Capture, ch, seqs),
+            its arrays being read only memmaps.
+        """
+        take = self.manifest['takes'][i]
+
+        arrays = { name: np.memmap( self.raw_path, dtype='float32', mode='r',
+                                    offset=a['offset'], shape=tuple(a['shape']) )
+                   for name, a in take['arrays'].items() }
+
+        capture = LS.Capture( take['kind'], take['input_channels'],
+                              take['mic_inputs'], **arrays )
+
+        return take['params'], capture, take['ch'], take['seqs']
+
+
+def init_reprocess_worker(folder, mic_response, using_mic_response):
+    """ A ProcessPoolExecutor initializer, see reprocess_take()
+    """
+    global reprocess_archive, reprocess_mic
+    reprocess_archive = CaptureArchive(folder)
+    reprocess_mic     = { 'mic_response':       mic_response,
+                          'using_mic_response': using_mic_response }
+    LS.printInfo      = False
+
+
+def reprocess_take(i):
+    """ Analyses the i-th take from the archive, in a pool worker process.
+        (i) The sweep spectrum is cached by every worker, see LS.sweep_plans.
+    """
+    params, capture, ch, seqs = reprocess_archive.get_take(i)
+    session = LS.SweepSession( **params, **reprocess_mic )
+    return ch, session.fs, get_results( session.analyse(capture), ch, seqs )
+
+
+def do_reprocess():
+    """ Rebuilds the .frd files from the <reprocess> archived session folder,
+        analysing all takes in parallel.
+    """
+
+    global folder, channels, numMeas
+
+    folder  = reprocess
+
+    if not os.path.exists(f'{folder}/{CaptureArchive.manifest_fname}'):
+        print_console_msg(f'no captures archive found at \'{folder}\'')
+        return False
+
+    takes   = CaptureArchive(folder).manifest['takes']
+
+    if not takes:
+        print_console_msg(f'no captures found at \'{folder}\'')
+        return False
+
+    channels = []
+    for take in takes:
+        channels += [c for c in take['ch'] if c not in channels]
+    numMeas = 1 + max( [max(take['seqs']) for take in takes] )
+
+    print_console_msg(f'reprocessing {len(takes)} takes from \'{folder}\'')
+
+    reset_results()
+
+    initargs = (folder, LS.mic_response, LS.using_mic_response)
+
+    with ProcessPoolExecutor( initializer=init_reprocess_worker,
+                              initargs=initargs ) as pool:
+
+        # (i) the results come in order, as the locations were measured
+        for ch, fs, results in pool.map( reprocess_take, range(len(takes)) ):
+            save_results(results, ch, fs)
+            stack_results(results, fs)
+
+    plot_pending()
+
+    return True
+
+
+def get_locations_per_sweep():
+    """ Mic locations captured by a single sweep (several in LS.multimic mode)
+    """
+    return len( LS.get_mic_inputs( LS.get_avail_input_channels() ) )
 
 
 def do_meas_loop(gui_trigger=None, gui_msg=None):
-    """ Meas for every channel and stores them into the <curves> stack
+    """ Meas for every channel and stores them into the <curves> statistics
         Optional:
             gui_trigger:    a GUI.threading.Event flag that trigger to meas.
             gui_msg:        a GUI.label_string_variable to prompt the user.
+
+        (i) The takes are only recorded here, then queued to a background
+            worker to be analysed while the mic is moved to the next location.
+            Use wait_for_analysis() before accessing the <curves> statistics.
     """
 
-    # 'curves' is a numpy stack of measurements per channel
-    global curves
+    global capture_archive
 
     # Alerting the user
     if gui_msg:
@@ -437,38 +1024,64 @@ def do_meas_loop(gui_trigger=None, gui_msg=None):
             do_beep('R')
     sleep(.5)
 
+    if archive:
+        capture_archive = CaptureArchive(folder, new=True)
+        print_console_msg(f'archiving captures to \'{capture_archive.raw_path}\'')
+
+    # A new session, the former takes could be still being analysed
+    analysis_queue.join()
+    reset_results()
+
+    start_analysis_worker()
 
-    for seq in range(numMeas):
+    # In LS.multimic mode every sweep captures several mic locations
+    locs_per_sweep = get_locations_per_sweep()
+
+    for first in range(0, numMeas, locs_per_sweep):
+
+        seqs = list( range(first, min(first + locs_per_sweep, numMeas)) )
+        locs = ','.join( [str(x+1) for x in seqs] )
 
         if gui_trigger:
-            gui_msg.set(f'LOCATION: {str(seq+1)} / {str(numMeas)}')
+            gui_msg.set(f'LOCATION: {locs} / {str(numMeas)}')
             sleep(1)
         else:
-            print_console_msg(f'MIC LOCATION: {str(seq+1)}/{str(numMeas)}')
+            print_console_msg(f'MIC LOCATION: {locs}/{str(numMeas)}')
+
+        # LS.mesm measures both channels in a single take
+        takes = ['LR'] if LS.mesm else channels
 
-        for ch in channels:
+        for ch in takes:
 
             if manageJack:
                 rjack.select_channel(ch)
                 sleep(.2)
 
-            # gui
-            if gui_trigger:
-                gui_prompt(ch, seq, gui_trigger, gui_msg)
+            # (i) An aborted take (e.g. clipping) will be prompted again
+            while True:
 
-            # console
-            else:
-                console_prompt(ch, seq)
-
-            # DO MEASURE AND STACK RESULTS
-            f, mag = LS_meas(ch, seq)
-            #
-            curves['freq'] = f
-            #
-            if seq == 0:
-                curves[ch] = mag
-            else:
-                curves[ch] = np.vstack( ( curves[ch], mag ) )
+                # gui
+                if gui_trigger:
+                    gui_prompt(ch, first, gui_trigger, gui_msg)
+
+                # console
+                else:
+                    console_prompt(ch, first)
+
+                # DO MEASURE (recording only)
+                take = LS_record()
+                if take:
+                    break
+
+                tmp = f'ABORTED: {LS.meas_abort_msg}, please repeat'
+                if gui_msg:
+                    gui_msg.set(tmp)
+                    sleep(2)
+                else:
+                    print_console_msg(tmp)
+
+            # ANALYSE AND STACK RESULTS in background
+            analysis_queue.put( (*take, ch, seqs) )
 
     if manageJack:
         rjack.select_channel('')
@@ -480,21 +1093,91 @@ def do_meas_loop(gui_trigger=None, gui_msg=None):
         print_console_msg('MEASURING COMPLETED.')
 
 
+def get_average(mags, mode='db', low=None):
+    """ Average of the <mags> dB array (a row per location) by the <mode>
+        estimator (see AVG_MODES). All of them are vectorized over the bins.
+
+        <low> flags the values to be left out (e.g. low S/N bins),
+        where all locations are flagged the whole bin is taken into account.
+    """
+
+    def estimate(m):
+        """ <m> has NaN where the values are left out
+        """
+        # (i) the all NaN bins are expected, e.g. low S/N at every location
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+
+            if mode == 'power':
+                return 10 * np.log10( np.nanmean(10**(m / 10), axis=0) )
+
+            elif mode == 'median':
+                return np.nanmedian(m, axis=0)
+
+            elif mode == 'trimmed':
+                # sorting puts the NaN at the end of every bin column
+                m = np.sort(m, axis=0)
+                k = np.sum(~np.isnan(m), axis=0)
+                t = np.floor(k * avgTrim)
+                i = np.arange(m.shape[0])[:, None]
+                keep = (i >= t) & (i < k - t)
+                return np.sum(np.where(keep, m, 0), axis=0) / np.sum(keep, axis=0)
+
+            elif mode == 'reject':
+                med = np.nanmedian(m, axis=0)
+                # the median absolute deviation as a robust std estimator,
+                # (floored to 1 dB so that similar locations are not rejected)
+                mad = np.maximum( 1.4826 * np.nanmedian(abs(m - med), axis=0), 1.0 )
+                m = np.where( abs(m - med) > avgReject * mad, np.nan, m )
+                return np.nanmean(m, axis=0)
+
+            else:
+                return np.nanmean(m, axis=0)
+
+    avg = estimate(mags)
+
+    if low is not None:
+        avg_masked = estimate( np.where(low, np.nan, mags) )
+        avg = np.where( np.isnan(avg_masked), avg, avg_masked )
+
+    return avg
+
+
+def get_channel_average(ch):
+    """ The <avgMode> average of the locations stacked so far for <ch>,
+        leaving out the low S/N bins, see get_average()
+    """
+    done = locations_done[ch]
+    mags = locations[ch][done]
+
+    low = None
+    if minSNR and locations_snr[ch] is not None:
+        low = locations_snr[ch][done] < minSNR
+
+    return get_average(mags, avgMode, low)
+
+
 def do_averages():
     """ Compute the average from all raw measurements,
         saving to .frd and plotting
     """
 
+    # The last takes could be still being analysed
+    wait_for_analysis()
+
     # Computing averages if more than one measurement
     for ch in channels:
-        print( "Computing average of channel: " + ch )
-        if numMeas > 1:
-            # All meas average
-            channels_avg[ch] = np.average( curves[ch], axis=0 )
-        else:
-            channels_avg[ch] = curves[ch]
+        print( f'Computing {avgMode} average of channel: {ch}' )
+
+        # (i) the low S/N bins are left out
+        if minSNR and locations_snr[ch] is not None and curves[ch].nlow():
+            print( f'(!) {curves[ch].nlow()} bins below {minSNR} dB S/N at every location' )
+
+        channels_avg[ch] = get_channel_average(ch)
 
-    f = curves['freq']
+    # (i) the archived fs when reprocessing
+    f  = curves['freq']
+    fs = curves['fs'] or LS.fs
 
     figIdx = 0
     for ch in channels:
@@ -504,7 +1187,7 @@ def do_averages():
         tools.saveFRD(  fname       = f'{folder}/{ch}_avg.frd',
                         freq        = f,
                         mag         = avg_mag_dB,
-                        fs          = LS.fs,
+                        fs          = fs,
                         comments    = f'roommeasure.py ch:{ch} raw avg' )
 
         # Also a progressive smoothed version of average
@@ -516,7 +1199,7 @@ def do_averages():
         tools.saveFRD(  fname       = f'{folder}/{ch}_avg_smoothed.frd',
                         freq        = f,
                         mag         = avg_mag_progSmooth_dB,
-                        fs          = LS.fs,
+                        fs          = fs,
                         comments    = f'roommeasure.py ch:{ch} smoothed avg' )
 
         # Prepare the average curve ...
@@ -529,9 +1212,10 @@ def do_averages():
                 'label': f'{ch} avg smoothed',
                 'color': 'red'                  }
 
-        LS.plot_FRDs( f, (c1,c2),   title=f'{os.path.basename(folder)} ({ch})',
-                                    figure= 20 + figIdx,
-                                    png_fname=f'{folder}/{ch}_avg.png' )
+        if doPlot:
+            LS.plot_FRDs( f, (c1,c2),   title=f'{os.path.basename(folder)} ({ch})',
+                                        figure= 20 + figIdx,
+                                        png_fname=f'{folder}/{ch}_avg.png' )
 
         figIdx += 1
 
@@ -589,6 +1273,14 @@ if __name__ == "__main__":
     #   - doBeep, numMeas, channels, Schro, timer, jackIP, jackUser
     read_command_line()
 
+    # Processing again an archived session, then END
+    if reprocess:
+        doPlot = reprocessPNG
+        if not do_reprocess():
+            sys.exit()
+        do_averages()
+        sys.exit()
+
     # - Prepare output FRD folder:
     if not prepare_frd_folder():
         print_console_msg('Please check your folders tree')
@@ -606,8 +1298,26 @@ if __name__ == "__main__":
     beepL = tools.make_beep(f=880, fs=LS.fs, duration=0.05)
     beepR = tools.make_beep(f=932, fs=LS.fs, duration=0.05)
 
+    # - Choosing the sweep length (probing through the first channel)
+    if LS.auto_length:
+        if manageJack:
+            rjack.select_channel(channels[0])
+        if LS.probe_sweep_length() is None:
+            sys.exit()
+
+    # - The MESM R sweep delay has to fit in the sweep length
+    if LS.mesm:
+        try:
+            LS.get_mesm_delay()
+        except ValueError as e:
+            print(f'(!) {e}')
+            sys.exit()
+
     # - Preparing log-sweep as per the updated LS parameters
-    LS.prepare_sweep()
+    #   (i) the chunked mode renders it on the fly, the MLS and multitone
+    #       excitations are prepared by LS.get_excitation_plan()
+    if not LS.chunked and LS.excitation == 'sweep':
+        LS.prepare_sweep()
 
     # MAIN measure procedure and SAVING
     do_meas_loop()
@@ -617,7 +1327,11 @@ if __name__ == "__main__":
         rjack.select_channel('none')
 
     # COMPUTE the average from all raw measurements
-    do_averages()
+    try:
+        do_averages()
+    except RuntimeError as e:
+        print_console_msg(f'(!) {e}')
+        sys.exit()
 
     # Plotting prepared curves
     LS.plt.show()